@@ -4,19 +4,60 @@ import io
 import unicodedata
 from functools import wraps
 import pandas as pd
-from datetime import datetime
+import numpy as np
+from datetime import datetime, date, timedelta
 import warnings
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, session
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, session, abort, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.sql import text
-from sqlalchemy import or_
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy import or_, and_, not_, case, func, bindparam, select, insert, literal, union_all, inspect as sa_inspect
 from dotenv import load_dotenv
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.exceptions import RequestEntityTooLarge
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
+from openpyxl import load_workbook, Workbook
 from openpyxl.worksheet.datavalidation import DataValidation
 from openpyxl.styles import PatternFill, Font, Border, Side, Alignment
 from openpyxl.utils import get_column_letter
-import math
+import random
+import bisect
+import itertools
+import time
+import tempfile
+import secrets
+import hashlib
+import csv
+from urllib.parse import quote
+import json
+import signal
+import functools
+import threading
+from collections import OrderedDict
+import click
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+# Các reader tùy chọn cho file Excel (không bắt buộc cài đặt)
+try:
+    from python_calamine import CalamineWorkbook
+except ImportError:
+    CalamineWorkbook = None
+try:
+    import xlrd
+except ImportError:
+    xlrd = None
+try:
+    import pyxlsb
+except ImportError:
+    pyxlsb = None
+try:
+    import resource # Chỉ có trên Linux/Unix, dùng để giới hạn bộ nhớ job import
+except ImportError:
+    resource = None
 
 # Tắt cảnh báo UserWarning của openpyxl (thường gặp khi đọc file có Data Validation)
 warnings.filterwarnings('ignore', category=UserWarning, module='openpyxl')
@@ -42,6 +83,23 @@ app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
     'pool_pre_ping': True # Kiểm tra kết nối trước khi gửi lệnh
 }
 
+# Cấu hình nạp dữ liệu hàng loạt (import)
+app.config['IMPORT_BATCH_SIZE'] = int(os.getenv('IMPORT_BATCH_SIZE', '2000')) # Số dòng mỗi lần executemany
+app.config['IMPORT_LOAD_DATA_LOCAL'] = os.getenv('IMPORT_LOAD_DATA_LOCAL', '0') == '1' # Dùng LOAD DATA LOCAL INFILE nếu server cho phép
+app.config['IMPORT_JOB_WORKERS'] = int(os.getenv('IMPORT_JOB_WORKERS', '2')) # Số process chạy job import (0 = chạy trực tiếp trong request)
+app.config['IMPORT_JOB_MEMORY_MB'] = int(os.getenv('IMPORT_JOB_MEMORY_MB', '2048')) # Giới hạn bộ nhớ mỗi job
+app.config['IMPORT_JOB_TIMEOUT'] = int(os.getenv('IMPORT_JOB_TIMEOUT', '1800')) # Giới hạn thời gian mỗi job (giây)
+app.config['IMPORT_JOB_QUEUE_TIMEOUT'] = int(os.getenv('IMPORT_JOB_QUEUE_TIMEOUT', '21600')) # Job chờ trong hàng đợi quá lâu (giây, VD: server khởi động lại) thì coi như lỗi
+app.config['IMPORT_REPLACE_CHUNK_DAYS'] = int(os.getenv('IMPORT_REPLACE_CHUNK_DAYS', '1')) # Số ngày mỗi lệnh DELETE khi thay thế dữ liệu theo kỳ
+app.config['IMPORT_CONFIRM_MODE'] = os.getenv('IMPORT_CONFIRM_MODE', 'sql') # Lưu kết quả validate đã lưu trên dòng tạm: sql = INSERT ... SELECT trong DB, python = đọc rồi nạp theo lô
+app.config['IMPORT_MAX_UPLOAD_MB'] = int(os.getenv('IMPORT_MAX_UPLOAD_MB', '100')) # Dung lượng tối đa file import
+app.config['MAX_CONTENT_LENGTH'] = (app.config['IMPORT_MAX_UPLOAD_MB'] + 1) * 1024 * 1024 # Request lớn hơn bị từ chối (413) trước khi đọc body (+1 MB cho các trường form)
+app.config['IMPORT_UPLOAD_DIR'] = os.getenv('IMPORT_UPLOAD_DIR') or os.path.join(tempfile.gettempdir(), 'production_imports') # Thư mục lưu file upload chờ job đọc
+app.config['REPORT_CACHE_SIZE'] = int(os.getenv('REPORT_CACHE_SIZE', '32')) # Số kết quả báo cáo giữ trong cache mỗi process (0 = tắt cache)
+app.config['REPORT_CACHE_MAX_ROWS'] = int(os.getenv('REPORT_CACHE_MAX_ROWS', '200000')) # Tổng số dòng tối đa của mọi kết quả trong cache mỗi process
+if app.config['IMPORT_LOAD_DATA_LOCAL'] and db_url.startswith('mysql+pymysql'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS']['connect_args'] = {'local_infile': True}
+
 # Khởi tạo đối tượng DB
 db = SQLAlchemy(app)
 
@@ -60,7 +118,7 @@ class Employee(db.Model):
     employee_type = db.Column(db.String(30))
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime)
-    masl=db.Column(db.String(50))
+    masl=db.Column(db.String(50), index=True) # Tra cứu theo mã sản lượng (chính xác / bắt đầu bằng)
     info=db.Column(db.String(200))
 
 class Customer(db.Model):
@@ -101,7 +159,7 @@ class AccountConversionIndex(db.Model):
 class LaborProductivity(db.Model):
     __tablename__ = 'labor_productivity'
     id = db.Column(db.Integer, primary_key=True)
-    work_date = db.Column(db.Date)
+    work_date = db.Column(db.Date, index=True)
     ref_no = db.Column(db.String(50))
     productivity_value = db.Column(db.Float)
     tally_id = db.Column(db.String(100))
@@ -118,10 +176,42 @@ class LaborProductivity(db.Model):
     unit= db.Column(db.String(50))
     conversion_index= db.Column(db.Float)
     quantity= db.Column(db.Float)
+    row_fingerprint = db.Column(db.String(40), unique=True, index=True) # SHA1 nhận diện dòng (xem productivity_fingerprint), dùng cho import upsert
+
+class ImportBatch(db.Model):
+    __tablename__ = 'import_batches'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False, index=True) # User đã upload
+    session_key = db.Column(db.String(64), nullable=False) # Gắn với phiên đăng nhập đã upload
+    file_name = db.Column(db.String(255))
+    upload_from_date = db.Column(db.Date)
+    upload_to_date = db.Column(db.Date)
+    row_count = db.Column(db.Integer, default=0)
+    status = db.Column(db.String(20), nullable=False, default='STAGED') # STAGED / CONFIRMED / CANCELLED
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+class ImportJob(db.Model):
+    __tablename__ = 'import_jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    batch_id = db.Column(db.Integer, nullable=True, index=True) # FK tới import_batches.id (NULL với job STAFF, không gắn batch)
+    user_id = db.Column(db.Integer, nullable=False)
+    kind = db.Column(db.String(20), nullable=False) # STAGE (đọc file vào bảng tạm) / VALIDATE (kiểm tra lại) / CONFIRM (lưu chính thức) / STAFF (ghi lại staff khi sửa nhân viên)
+    status = db.Column(db.String(20), nullable=False, default='QUEUED') # QUEUED / RUNNING / DONE / FAILED
+    stage = db.Column(db.String(20), default='queued') # queued / parse / stage / validate / replace / confirm / staff / rollup / done
+    rows_total = db.Column(db.Integer)
+    rows_done = db.Column(db.Integer, default=0)
+    file_path = db.Column(db.String(500)) # File upload đã lưu tạm trên đĩa (job STAGE)
+    options = db.Column(db.Text) # JSON tham số của job (engine đọc file, chế độ lưu...)
+    messages = db.Column(db.Text) # JSON list [category, message] để hiển thị khi job kết thúc
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
 
 class LaborProductivityTemp(db.Model):
     __tablename__ = 'labor_productivity_temp'
     id = db.Column(db.Integer, primary_key=True)
+    batch_id = db.Column(db.Integer, index=True) # FK tới import_batches.id, mỗi lần upload 1 batch riêng
+    source_row = db.Column(db.Integer) # Số dòng trong file Excel gốc (để báo lỗi đúng dòng)
     date = db.Column(db.Date)
     container_no = db.Column(db.String(50))
     cbm = db.Column(db.Float)
@@ -136,15 +226,52 @@ class LaborProductivityTemp(db.Model):
     task = db.Column(db.String(100))
     account = db.Column(db.String(100))
     customer = db.Column(db.String(100))
+    # Kết quả validate lúc staging (hoặc khi sửa dòng), preview và confirm chỉ đọc lại
+    customer_id = db.Column(db.Integer) # customers.id đã tra được
+    account_id = db.Column(db.Integer) # customer_accounts.id
+    task_id = db.Column(db.Integer) # account_tasks.id (NULL nếu task không có trong danh mục)
+    conversion_index = db.Column(db.Float)
+    unit = db.Column(db.String(50))
+    quantity = db.Column(db.Float)
+    error_code = db.Column(db.String(30)) # NULL = hợp lệ, xem IMPORT_ERROR_MESSAGES
+    row_fingerprint = db.Column(db.String(40)) # Fingerprint của dòng sẽ lưu vào labor_productivity
 
 class LaborProductivityStaff(db.Model):
     __tablename__ = 'labor_productivity_staff'
+    # (employee_id, productivity_id): tra cứu các dòng sản lượng của 1 nhân viên chỉ đọc đúng số dòng của nhân viên đó
+    __table_args__ = (db.Index('ix_staff_employee_productivity', 'employee_id', 'productivity_id'),)
     id = db.Column(db.Integer, primary_key=True)
-    productivity_id = db.Column(db.Integer, nullable=False) # FK tới labor_productivity.id
-    employee_id = db.Column(db.Integer, nullable=False)
+    productivity_id = db.Column(db.Integer, nullable=False, index=True) # FK tới labor_productivity.id
+    employee_id = db.Column(db.Integer, nullable=False, index=True)
     role = db.Column(db.String(30), nullable=False)
     ratio = db.Column(db.Float, default=1.0) # Tương ứng với DEFAULT 1.0 trong SQL
 
+# Bảng tổng hợp theo ngày (dựng lại theo ngày khi dữ liệu chi tiết thay đổi, xem refresh_productivity_rollups)
+class ProductivityDailyTotal(db.Model):
+    __tablename__ = 'productivity_daily_totals'
+    __table_args__ = (db.UniqueConstraint('work_date', 'customer_id', 'account_id', 'task_id', name='uq_daily_totals_key'),)
+    id = db.Column(db.Integer, primary_key=True)
+    work_date = db.Column(db.Date, nullable=False, index=True)
+    customer_id = db.Column(db.String(100), nullable=False, default='') # Tên như labor_productivity, '' nếu trống
+    account_id = db.Column(db.String(100), nullable=False, default='')
+    task_id = db.Column(db.String(100), nullable=False, default='')
+    raw_cbm = db.Column(db.Float, default=0.0) # Tổng productivity_value (CBM chưa quy đổi)
+    quantity = db.Column(db.Float, default=0.0) # Tổng sản lượng đã quy đổi
+    row_count = db.Column(db.Integer, default=0)
+
+class ProductivityDailyStaff(db.Model):
+    __tablename__ = 'productivity_daily_staff'
+    __table_args__ = (db.UniqueConstraint('work_date', 'employee_id', 'role', 'account_id', name='uq_daily_staff_key'),
+                      db.Index('ix_daily_staff_employee_date', 'employee_id', 'work_date'))
+    id = db.Column(db.Integer, primary_key=True)
+    work_date = db.Column(db.Date, nullable=False, index=True)
+    employee_id = db.Column(db.Integer, nullable=False)
+    role = db.Column(db.String(30), nullable=False)
+    account_id = db.Column(db.String(100), nullable=False, default='') # Tên account (cột theo account trong file xuất)
+    raw_cbm = db.Column(db.Float, default=0.0)
+    quantity = db.Column(db.Float, default=0.0)
+    row_count = db.Column(db.Integer, default=0) # Số dòng sản lượng nhân viên tham gia
+
 class SystemSetting(db.Model):
     __tablename__ = 'system_settings'
     id = db.Column(db.Integer, primary_key=True)
@@ -168,6 +295,372 @@ class ChucVu(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     ten_chuc_vu = db.Column(db.String(100), nullable=False, unique=True)
 
+def get_system_setting(key_name, default=None):
+    """Đọc giá trị cấu hình trong bảng system_settings, không có thì trả về default."""
+    setting = SystemSetting.query.filter_by(key_name=key_name).first()
+    return setting.value if setting and setting.value is not None else default
+
+# --- CACHE KẾT QUẢ BÁO CÁO (khóa theo kỳ, tham số và phiên bản dữ liệu) ---
+DATA_VERSION_KEY = 'data_version'
+
+def get_data_version():
+    """Phiên bản dữ liệu báo cáo hiện tại (đổi mỗi khi có thao tác ghi ảnh hưởng báo cáo)."""
+    return get_system_setting(DATA_VERSION_KEY, '0')
+
+def bump_data_version():
+    """
+    Đổi phiên bản dữ liệu báo cáo trong transaction hiện tại (có hiệu lực khi commit), làm mọi kết quả đã cache hết hiệu lực.
+    Mỗi lần là 1 giá trị ngẫu nhiên mới (không cộng dồn) nên 2 thao tác ghi đồng thời không thể ra cùng phiên bản.
+    Gọi ở mọi đường ghi: xác nhận import, sửa/xóa sản lượng, nhân viên, account, định mức quy đổi, cài đặt loại trừ.
+    """
+    value = secrets.token_hex(8)
+    setting = SystemSetting.query.filter_by(key_name=DATA_VERSION_KEY).first()
+    if setting:
+        setting.value = value
+    else:
+        db.session.add(SystemSetting(key_name=DATA_VERSION_KEY, value=value))
+    return value
+
+class ReportCache:
+    """
+    Cache LRU cho kết quả báo cáo, giới hạn cả số phần tử lẫn tổng số dòng (count_report_rows) của mọi phần tử,
+    dùng chung các thread trong 1 process.
+    Khóa luôn chứa phiên bản dữ liệu đọc từ DB nên mỗi process giữ cache riêng mà không bao giờ trả kết quả cũ.
+    Giá trị trả ra dùng chung giữa các request: chỉ đọc, không sửa tại chỗ.
+    """
+    def __init__(self, max_size, max_rows):
+        self.max_size = max_size
+        self.max_rows = max_rows
+        self.entries = OrderedDict() # { key: (value, số dòng) }
+        self.rows = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][0]
+
+    def put(self, key, value, rows):
+        """Thêm kết quả rows dòng, đẩy các phần tử ít dùng nhất ra cho tới khi vừa cả 2 giới hạn. Lớn hơn max_rows thì bỏ qua."""
+        if self.max_size <= 0 or rows > self.max_rows:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.rows -= self.entries.pop(key)[1]
+            self.entries[key] = (value, rows)
+            self.rows += rows
+            while len(self.entries) > self.max_size or self.rows > self.max_rows:
+                self.rows -= self.entries.popitem(last=False)[1][1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.rows = 0
+
+report_cache = ReportCache(app.config['REPORT_CACHE_SIZE'], app.config['REPORT_CACHE_MAX_ROWS'])
+
+def count_report_rows(value):
+    """Số dòng ước lượng của 1 kết quả báo cáo (tổng độ dài các list lồng trong dict/tuple) để giới hạn kích thước cache."""
+    if isinstance(value, dict):
+        return sum(count_report_rows(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return len(value) + sum(count_report_rows(v) for v in value if isinstance(v, (dict, list)))
+    return 0
+
+def cached_report(name, params, compute):
+    """
+    Kết quả compute() lấy từ cache theo khóa (name, params, phiên bản dữ liệu).
+    Phiên bản đọc trong cùng transaction với truy vấn tổng hợp nên dữ liệu đã tính luôn khớp với phiên bản trong khóa;
+    sau khi có thao tác ghi, phiên bản mới làm đổi khóa nên kết quả cũ không bao giờ được trả lại (bị LRU đẩy ra dần).
+    """
+    key = (name, params, get_data_version())
+    value = report_cache.get(key)
+    if value is None:
+        value = compute()
+        report_cache.put(key, value, count_report_rows(value))
+    return value
+
+class ConversionIndexResolver:
+    """
+    Tra định mức quy đổi theo ngày làm việc (dùng chung cho import, API và báo cáo).
+    Mỗi (account_id, task_id) giữ mảng effective_from đã sắp xếp, tra bằng tìm kiếm nhị phân:
+    lấy bản ghi có effective_from mới nhất <= ngày làm việc và chưa hết hạn (effective_to), không có thì trả về None.
+    """
+    def __init__(self, account_ids=None, task_ids=None):
+        query = db.session.query(
+            AccountConversionIndex.account_id, AccountConversionIndex.task_id,
+            AccountConversionIndex.effective_from, AccountConversionIndex.id,
+            AccountConversionIndex.effective_to, AccountConversionIndex.conversion_index, AccountConversionIndex.unit
+        )
+        if account_ids is not None:
+            query = query.filter(AccountConversionIndex.account_id.in_(list(account_ids)))
+        if task_ids is not None:
+            query = query.filter(AccountConversionIndex.task_id.in_(list(task_ids)))
+
+        self._starts = {} # { (account_id, task_id): [(effective_from, id), ...] } tăng dần
+        self._entries = {} # { (account_id, task_id): [(effective_to, conversion_index, unit), ...] } cùng thứ tự
+        self._tasks_by_account = {}
+        for acc_id, task_id, eff_from, idx_id, eff_to, conv, unit in query.order_by(
+                AccountConversionIndex.account_id, AccountConversionIndex.task_id,
+                AccountConversionIndex.effective_from, AccountConversionIndex.id):
+            key = (acc_id, task_id)
+            self._starts.setdefault(key, []).append((eff_from, idx_id))
+            self._entries.setdefault(key, []).append((eff_to, float(conv), unit))
+            self._tasks_by_account.setdefault(acc_id, set()).add(task_id)
+
+    def _find(self, key, work_date):
+        """Vị trí bản ghi hiệu lực trong mảng của key tại work_date, không có thì -1."""
+        starts = self._starts.get(key)
+        if not starts or work_date is None:
+            return -1
+        i = bisect.bisect_right(starts, (work_date, float('inf'))) - 1
+        entries = self._entries[key]
+        # Bản ghi mới nhất đã hết hạn thì lùi về bản ghi trước đó còn hiệu lực (VD: định mức tạm thời chồng lên định mức dài hạn)
+        while i >= 0 and entries[i][0] is not None and entries[i][0] < work_date:
+            i -= 1
+        return i
+
+    def lookup(self, account_id, task_id, work_date):
+        """(conversion_index, unit) hiệu lực tại work_date, không có thì None."""
+        key = (account_id, task_id)
+        i = self._find(key, work_date)
+        if i < 0:
+            return None
+        _, conv, unit = self._entries[key][i]
+        return conv, unit
+
+    def lookup_many(self, account_ids, task_ids, work_dates):
+        """Tra cả 1 tập dòng trong 1 lượt (các list cùng độ dài), trả về list (conversion_index, unit) hoặc None."""
+        return [self.lookup(a, t, d) if a is not None and t is not None else None
+                for a, t, d in zip(account_ids, task_ids, work_dates)]
+
+    def account_ids(self):
+        return list(self._tasks_by_account)
+
+    def account_rate(self, account_id, on_date):
+        """Hệ số của account tại on_date (bản ghi có hiệu lực mới nhất trong các task của account), không có thì None."""
+        best = None
+        for task_id in self._tasks_by_account.get(account_id, ()):
+            key = (account_id, task_id)
+            i = self._find(key, on_date)
+            if i >= 0 and (best is None or self._starts[key][i] > best[0]):
+                best = (self._starts[key][i], self._entries[key][i][1])
+        return best[1] if best else None
+
+def _fingerprint_part(value):
+    return unicodedata.normalize('NFC', str(value)).strip().lower() if value is not None else ''
+
+def productivity_fingerprint(work_date, ref_no, task, account, customer, staff):
+    """
+    SHA1 nhận diện 1 dòng sản lượng theo (ngày, số cont/xe, task, account, khách hàng, nhân sự),
+    không phân biệt hoa thường/khoảng trắng. staff: tally, xe nâng, công nhân 1-6 theo thứ tự.
+    """
+    parts = [work_date.isoformat() if work_date else '', _fingerprint_part(ref_no), _fingerprint_part(task),
+             _fingerprint_part(account), _fingerprint_part(customer)] + [_fingerprint_part(v) for v in staff]
+    return hashlib.sha1('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+def fingerprint_of_productivity(record):
+    return productivity_fingerprint(record.work_date, record.ref_no, record.task_id, record.account_id, record.customer_id,
+                                    [getattr(record, c) for c in PRODUCTIVITY_STAFF_COLUMNS])
+
+# Cột nhân sự trên labor_productivity (tally, xe nâng, công nhân 1-6)
+PRODUCTIVITY_STAFF_COLUMNS = ['tally_id', 'xenang_id', 'congnhan1_id', 'congnhan2_id', 'congnhan3_id', 'congnhan4_id', 'congnhan5_id', 'congnhan6_id']
+# Vai trò lưu vào labor_productivity_staff.role, theo cột nhân sự trên labor_productivity
+PRODUCTIVITY_STAFF_ROLES = {c: c[:-3] for c in PRODUCTIVITY_STAFF_COLUMNS}
+PRODUCTIVITY_STAFF_INSERT_COLUMNS = ['productivity_id', 'employee_id', 'role', 'ratio']
+
+def normalize_employee_key(s):
+    """Chuẩn hóa chuỗi nhân sự để so khớp (NFC, bỏ khoảng trắng 2 đầu, chữ thường), giống các báo cáo."""
+    if not s:
+        return None
+    return unicodedata.normalize('NFC', str(s)).strip().lower() or None
+
+def is_an_chung_type(employee_type):
+    return (normalize_employee_key(employee_type) or '') in ('an_chung', 'an chung')
+
+class EmployeeResolver:
+    """
+    Tra chuỗi nhân sự trên dòng sản lượng (masl / employee_code / full_name) ra employee id.
+    Nạp danh mục nhân viên 1 lần; trùng khóa thì nhân viên khoán được ưu tiên hơn nhân viên ăn chung (như export_report).
+    """
+    def __init__(self):
+        employees = db.session.query(Employee.id, Employee.masl, Employee.employee_code, Employee.full_name, Employee.employee_type) \
+            .order_by(Employee.id).all()
+        self.by_key = {}
+        for group in (True, False):
+            for emp_id, masl, code, full_name, employee_type in employees:
+                if is_an_chung_type(employee_type) != group:
+                    continue
+                for value in (masl, code, full_name):
+                    key = normalize_employee_key(value)
+                    if key:
+                        self.by_key[key] = emp_id
+
+    def lookup(self, value):
+        key = normalize_employee_key(value)
+        return self.by_key.get(key) if key else None
+
+    def staff_rows(self, productivity_id, workers):
+        """
+        Các dòng labor_productivity_staff (tuple theo PRODUCTIVITY_STAFF_INSERT_COLUMNS) cho 1 dòng sản lượng.
+        workers: giá trị các cột PRODUCTIVITY_STAFF_COLUMNS. Mỗi nhân viên chỉ tính 1 lần/dòng (vai trò đầu tiên), ratio 1.0.
+        """
+        rows = []
+        seen = set()
+        for column, value in zip(PRODUCTIVITY_STAFF_COLUMNS, workers):
+            emp_id = self.lookup(value)
+            if emp_id is None or emp_id in seen:
+                continue
+            seen.add(emp_id)
+            rows.append((productivity_id, emp_id, PRODUCTIVITY_STAFF_ROLES[column], 1.0))
+        return rows
+
+ROLLUP_DATE_CHUNK = 31 # Số ngày mỗi lần dựng lại bảng tổng hợp
+
+def _rebuild_rollup_rows(date_filter):
+    """Xóa rồi INSERT ... SELECT ... GROUP BY 2 bảng tổng hợp cho các ngày thỏa date_filter(cột ngày)."""
+    P = LaborProductivity
+    S = LaborProductivityStaff
+    db.session.query(ProductivityDailyTotal).filter(date_filter(ProductivityDailyTotal.work_date)).delete(synchronize_session=False)
+    db.session.query(ProductivityDailyStaff).filter(date_filter(ProductivityDailyStaff.work_date)).delete(synchronize_session=False)
+
+    customer = func.coalesce(P.customer_id, '')
+    account = func.coalesce(P.account_id, '')
+    task = func.coalesce(P.task_id, '')
+    totals = select(P.work_date, customer, account, task,
+                    func.sum(func.coalesce(P.productivity_value, 0.0)), func.sum(func.coalesce(P.quantity, 0.0)), func.count(P.id)) \
+        .where(date_filter(P.work_date)).group_by(P.work_date, customer, account, task)
+    db.session.execute(insert(ProductivityDailyTotal.__table__).from_select(
+        ['work_date', 'customer_id', 'account_id', 'task_id', 'raw_cbm', 'quantity', 'row_count'], totals))
+
+    ratio = func.coalesce(S.ratio, 1.0)
+    staff = select(P.work_date, S.employee_id, S.role, account,
+                   func.sum(func.coalesce(P.productivity_value, 0.0) * ratio), func.sum(func.coalesce(P.quantity, 0.0) * ratio), func.count(S.id)) \
+        .join(P, P.id == S.productivity_id).where(date_filter(P.work_date)).group_by(P.work_date, S.employee_id, S.role, account)
+    db.session.execute(insert(ProductivityDailyStaff.__table__).from_select(
+        ['work_date', 'employee_id', 'role', 'account_id', 'raw_cbm', 'quantity', 'row_count'], staff))
+
+def refresh_productivity_rollups(dates):
+    """
+    Cập nhật bảng tổng hợp cho các ngày có dữ liệu chi tiết thay đổi: dựng lại đúng các ngày đó từ labor_productivity
+    (và labor_productivity_staff), nên không bị lệch số như cộng/trừ dồn. Chạy trong transaction hiện tại. Trả về số ngày.
+    """
+    dates = sorted({d for d in dates if d is not None})
+    for k in range(0, len(dates), ROLLUP_DATE_CHUNK):
+        chunk = dates[k:k + ROLLUP_DATE_CHUNK]
+        _rebuild_rollup_rows(lambda column: column.in_(chunk))
+    return len(dates)
+
+def rebuild_productivity_rollups(from_date=None, to_date=None, commit_each_chunk=False, progress=None):
+    """
+    Dựng lại bảng tổng hợp cho khoảng ngày, từng ROLLUP_DATE_CHUNK ngày. Mặc định toàn bộ ngày có trong dữ liệu chi tiết
+    hoặc bảng tổng hợp (để xóa cả dòng tổng hợp của ngày không còn dữ liệu). Trả về số ngày đã xử lý.
+    """
+    if from_date is None or to_date is None:
+        bounds = [db.session.query(func.min(m.work_date), func.max(m.work_date)).one()
+                  for m in (LaborProductivity, ProductivityDailyTotal, ProductivityDailyStaff)]
+        from_date = from_date or min((b[0] for b in bounds if b[0]), default=None)
+        to_date = to_date or max((b[1] for b in bounds if b[1]), default=None)
+    if from_date is None or to_date is None:
+        return 0
+    start = from_date
+    while start <= to_date:
+        end = min(start + timedelta(days=ROLLUP_DATE_CHUNK - 1), to_date)
+        _rebuild_rollup_rows(lambda column: column.between(start, end))
+        if commit_each_chunk:
+            db.session.commit()
+        if progress:
+            progress(start, end)
+        start = end + timedelta(days=1)
+    return (to_date - from_date).days + 1
+
+def write_productivity_staff(condition, resolver=None, chunk_size=None, commit_each_chunk=False, progress=None):
+    """
+    Ghi lại labor_productivity_staff cho các dòng labor_productivity thỏa condition: xóa dòng staff cũ rồi
+    bulk insert theo EmployeeResolver, duyệt keyset theo id từng chunk_size dòng. Trả về (số dòng sản lượng, số dòng staff).
+    Mặc định chạy trong transaction hiện tại; commit_each_chunk=True thì commit sau mỗi chunk (dùng cho CLI backfill).
+    """
+    resolver = resolver or EmployeeResolver()
+    chunk_size = chunk_size or IMPORT_CHUNK_SIZE
+    P = LaborProductivity
+    columns = [getattr(P, c) for c in PRODUCTIVITY_STAFF_COLUMNS]
+    last_id = 0
+    processed = 0
+    written = 0
+    while True:
+        rows = db.session.query(P.id, *columns).filter(condition, P.id > last_id).order_by(P.id).limit(chunk_size).all()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        ids = [r[0] for r in rows]
+        db.session.query(LaborProductivityStaff).filter(LaborProductivityStaff.productivity_id.in_(ids)).delete(synchronize_session=False)
+        staff = [s for r in rows for s in resolver.staff_rows(r[0], r[1:])]
+        if staff:
+            bulk_load_rows(LaborProductivityStaff, PRODUCTIVITY_STAFF_INSERT_COLUMNS, staff)
+        processed += len(rows)
+        written += len(staff)
+        if commit_each_chunk:
+            db.session.commit()
+        if progress:
+            progress(processed, written)
+    return processed, written
+
+def employee_key_set(values):
+    """Tập khóa nhân sự đã chuẩn hóa (như EmployeeResolver) của masl / mã / tên."""
+    return {k for k in (normalize_employee_key(v) for v in values) if k}
+
+def employees_sharing_keys(keys, exclude_id=None):
+    """id các nhân viên khác có masl / mã / tên trùng keys (đã chuẩn hóa): dòng sản lượng đang gán cho họ có thể đổi người."""
+    if not keys:
+        return []
+    return [emp_id for emp_id, masl, code, full_name
+            in db.session.query(Employee.id, Employee.masl, Employee.employee_code, Employee.full_name)
+            if emp_id != exclude_id and employee_key_set((masl, code, full_name)) & keys]
+
+def refresh_employee_staff(employee_ids, values=()):
+    """
+    Ghi lại labor_productivity_staff và bảng tổng hợp sau khi danh mục nhân viên thay đổi, cho các dòng sản lượng đang gán
+    cho employee_ids (tra qua ix_staff_employee_productivity) hoặc có cột nhân sự trùng 1 trong values. values chỉ cần
+    khi có khóa mới (chưa gán cho ai thì không có dòng staff để tra), và phải quét các cột nhân sự nên gọi qua job nền
+    (xem queue_employee_staff_refresh). Chạy trong transaction hiện tại. Trả về số dòng sản lượng đã ghi lại.
+    """
+    P = LaborProductivity
+    S = LaborProductivityStaff
+    conditions = []
+    if employee_ids:
+        conditions.append(P.id.in_(select(S.productivity_id).where(S.employee_id.in_(employee_ids))))
+    values = sorted({str(v).strip() for v in values if v and str(v).strip()})
+    if values:
+        conditions += [getattr(P, column).in_(values) for column in PRODUCTIVITY_STAFF_COLUMNS]
+    if not conditions:
+        return 0
+    condition = or_(*conditions)
+    dates = [d for (d,) in db.session.query(P.work_date).filter(condition).distinct()]
+    processed, _ = write_productivity_staff(condition)
+    refresh_productivity_rollups(dates)
+    return processed
+
+def queue_employee_staff_refresh(employee_ids, values=()):
+    """
+    Cập nhật staff/tổng hợp theo thay đổi danh mục nhân viên. Không có khóa mới (xóa nhân viên, đổi loại khoán/ăn chung)
+    thì chỉ tra qua index staff nên chạy luôn trong transaction hiện tại. Có khóa mới thì tạo job STAFF chạy nền
+    (như job import) và trả về job: người gọi commit rồi submit_import_job(job). Trả về None nếu đã chạy xong.
+    Người gọi vẫn tự bump_data_version() (job STAFF bump thêm lần nữa khi chạy xong).
+    """
+    if not values:
+        refresh_employee_staff(employee_ids)
+        return None
+    job = ImportJob(batch_id=None, user_id=current_user.id, kind='STAFF',
+                    options=json.dumps({'employee_ids': sorted(set(employee_ids)), 'values': [v for v in values if v]}))
+    db.session.add(job)
+    return job
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
@@ -275,7 +768,14 @@ def nhan_vien():
                 created_at=datetime.now()
             )
             db.session.add(new_emp)
+            db.session.flush()
+            keys = employee_key_set((new_emp.masl, new_emp.employee_code, new_emp.full_name))
+            job = queue_employee_staff_refresh(employees_sharing_keys(keys, new_emp.id),
+                                               [new_emp.masl, new_emp.employee_code, new_emp.full_name]) if keys else None
+            bump_data_version()
             db.session.commit()
+            if job:
+                submit_import_job(job)
             flash('Thêm nhân viên mới thành công!', 'success')
         except Exception as e:
             print(f"Lỗi thêm nhân viên: {e}")
@@ -316,6 +816,8 @@ def edit_nhan_vien(id):
         flash(f'Mã nhân viên "{new_code}" đã được sử dụng bởi một nhân viên khác.', 'danger')
         return redirect(url_for('nhan_vien'))
     try:
+        old_keys = employee_key_set((emp.masl, emp.employee_code, emp.full_name))
+        old_an_chung = is_an_chung_type(emp.employee_type)
         emp.employee_code = new_code
         emp.full_name = request.form['full_name'].title()
         emp.position = request.form.get('position')
@@ -323,7 +825,20 @@ def edit_nhan_vien(id):
         emp.masl = request.form.get('masl')
         emp.info = request.form.get('info')
         emp.is_active = True if request.form.get('is_active') else False
+        new_values = [emp.masl, emp.employee_code, emp.full_name]
+        new_keys = employee_key_set(new_values)
+        job = None
+        # Chỉ sửa vị trí / ghi chú / trạng thái thì không đổi cách gán nhân sự, không cần ghi lại staff và tổng hợp
+        if new_keys != old_keys or is_an_chung_type(emp.employee_type) != old_an_chung:
+            db.session.flush()
+            added = new_keys - old_keys
+            job = queue_employee_staff_refresh([emp.id] + employees_sharing_keys(old_keys | new_keys, emp.id),
+                                               [v for v in new_values if normalize_employee_key(v) in added])
+        # Báo cáo hiển thị cả vị trí / thông tin nhân viên nên luôn đổi phiên bản dữ liệu
+        bump_data_version()
         db.session.commit()
+        if job:
+            submit_import_job(job)
         flash('Cập nhật thông tin nhân viên thành công!', 'success')
     except Exception as e:
         print(f"Lỗi sửa nhân viên: {e}")
@@ -338,6 +853,9 @@ def delete_nhan_vien(id):
     emp = Employee.query.get_or_404(id)
     try:
         db.session.delete(emp)
+        db.session.flush()
+        queue_employee_staff_refresh([id])
+        bump_data_version()
         db.session.commit()
         flash('Đã xóa nhân viên thành công!', 'success')
     except Exception as e:
@@ -434,6 +952,7 @@ def account():
         try:
             new_acc = CustomerAccount(customer_id=customer_id, account_code=account_code, account_name=account_name, is_active=is_active)
             db.session.add(new_acc)
+            bump_data_version()
             db.session.commit()
             flash('Thêm account thành công!', 'success')
         except Exception as e:
@@ -461,6 +980,7 @@ def edit_account(id):
     acc.account_name = request.form['account_name']
     acc.customer_id = request.form['customer_id']
     acc.is_active = True if request.form.get('is_active') else False
+    bump_data_version()
     db.session.commit()
     flash('Cập nhật account thành công!', 'success')
     return redirect(url_for('account'))
@@ -471,6 +991,7 @@ def edit_account(id):
 def delete_account(id):
     acc = CustomerAccount.query.get_or_404(id)
     db.session.delete(acc)
+    bump_data_version()
     db.session.commit()
     flash('Xóa account thành công!', 'success')
     return redirect(url_for('account'))
@@ -558,6 +1079,7 @@ def account_conversion_index():
                 effective_to=effective_to
             )
             db.session.add(new_idx)
+            bump_data_version()
             db.session.commit()
             flash('Thêm định mức thành công!', 'success')
         except Exception as e:
@@ -613,7 +1135,7 @@ def edit_account_conversion_index(id):
         idx.effective_from = datetime.strptime(request.form['effective_from'], '%Y-%m-%d').date()
         effective_to_str = request.form.get('effective_to')
         idx.effective_to = datetime.strptime(effective_to_str, '%Y-%m-%d').date() if effective_to_str else None
-        
+        bump_data_version()
         db.session.commit()
         flash('Cập nhật định mức thành công!', 'success')
     except Exception as e:
@@ -628,6 +1150,7 @@ def delete_account_conversion_index(id):
     idx = AccountConversionIndex.query.get_or_404(id)
     try:
         db.session.delete(idx)
+        bump_data_version()
         db.session.commit()
         flash('Xóa định mức thành công!', 'success')
     except Exception as e:
@@ -668,6 +1191,719 @@ def next_account_code(customer_id):
     
     return jsonify({'next_code': next_code})
 
+# --- NẠP DỮ LIỆU HÀNG LOẠT (BULK LOAD) ---
+def _iter_batches(rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _load_data_value(v):
+    """Định dạng 1 giá trị theo chuẩn mặc định của LOAD DATA (tab-separated, \\N = NULL)."""
+    if v is None:
+        return '\\N'
+    if isinstance(v, bool):
+        return '1' if v else '0'
+    if isinstance(v, (datetime, date)):
+        return v.isoformat(sep=' ') if isinstance(v, datetime) else v.isoformat()
+    if isinstance(v, float):
+        return repr(v)
+    return str(v).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+def _load_data_batch(cursor, table_name, columns, batch):
+    """Ghi lô dữ liệu ra file tạm rồi nạp bằng LOAD DATA LOCAL INFILE (nhanh nhất với MySQL)."""
+    spool = tempfile.NamedTemporaryFile('w', encoding='utf-8', newline='\n', suffix='.tsv', delete=False)
+    try:
+        with spool:
+            for row in batch:
+                spool.write('\t'.join(_load_data_value(v) for v in row))
+                spool.write('\n')
+        cursor.execute(
+            f"LOAD DATA LOCAL INFILE %s INTO TABLE {table_name} CHARACTER SET utf8mb4 ({', '.join(columns)})",
+            (spool.name,)
+        )
+    finally:
+        os.remove(spool.name)
+
+def upsert_clause(columns, key_column, update_columns=None):
+    """Phần đuôi câu INSERT để ghi đè khi trùng key_column (unique): ON DUPLICATE KEY UPDATE (MySQL) / ON CONFLICT (SQLite, PostgreSQL)."""
+    update_columns = update_columns or [c for c in columns if c != key_column]
+    if db.engine.dialect.name == 'mysql':
+        return " ON DUPLICATE KEY UPDATE " + ", ".join(f"{c} = VALUES({c})" for c in update_columns)
+    return f" ON CONFLICT ({key_column}) DO UPDATE SET " + ", ".join(f"{c} = excluded.{c}" for c in update_columns)
+
+def bulk_load_rows(model, columns, rows, batch_size=None, commit_each_batch=False, use_load_data=None, upsert_key=None):
+    """
+    Nạp hàng loạt các dòng (tuple theo thứ tự columns) vào bảng của model qua cursor của driver
+    (executemany của PyMySQL), chia thành từng lô IMPORT_BATCH_SIZE dòng để không vượt
+    max_allowed_packet. Nếu bật IMPORT_LOAD_DATA_LOCAL thì thử LOAD DATA LOCAL INFILE trước,
+    lỗi thì quay về executemany.
+    Mặc định chạy trong transaction hiện tại của db.session; commit_each_batch=True thì commit sau mỗi lô.
+    upsert_key: tên cột unique, dòng trùng sẽ được cập nhật thay vì báo lỗi (không dùng LOAD DATA).
+    Trả về dict thống kê: tổng số dòng, phương thức và tốc độ (dòng/giây) từng lô.
+    Không in log theo từng lô (gọi rất nhiều lần khi import/backfill), người gọi tự in 1 dòng tổng kết.
+    """
+    table_name = model.__table__.name
+    batch_size = batch_size or app.config['IMPORT_BATCH_SIZE']
+    if use_load_data is None:
+        use_load_data = app.config['IMPORT_LOAD_DATA_LOCAL']
+    use_load_data = use_load_data and db.engine.dialect.name == 'mysql' and not upsert_key
+    placeholder = '%s' if db.engine.dialect.paramstyle in ('format', 'pyformat') else '?'
+    insert_sql = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({', '.join([placeholder] * len(columns))})"
+    if upsert_key:
+        insert_sql += upsert_clause(columns, upsert_key)
+
+    stats = {'table': table_name, 'rows': 0, 'method': 'load_data' if use_load_data else 'executemany', 'batches': []}
+    started = time.perf_counter()
+    for batch_no, batch in enumerate(_iter_batches(rows, batch_size), 1):
+        t0 = time.perf_counter()
+        cursor = db.session.connection().connection.cursor()
+        try:
+            if use_load_data:
+                try:
+                    _load_data_batch(cursor, table_name, columns, batch)
+                except Exception as e:
+                    print(f"[bulk-load] LOAD DATA LOCAL INFILE không khả dụng ({e}), chuyển sang executemany.")
+                    use_load_data = False
+                    stats['method'] = 'executemany'
+            if not use_load_data:
+                cursor.executemany(insert_sql, batch)
+        finally:
+            cursor.close()
+        if commit_each_batch:
+            db.session.commit()
+
+        elapsed = time.perf_counter() - t0
+        rate = len(batch) / elapsed if elapsed > 0 else float(len(batch))
+        stats['rows'] += len(batch)
+        stats['batches'].append({'batch': batch_no, 'rows': len(batch), 'seconds': round(elapsed, 4), 'rows_per_sec': round(rate, 1)})
+
+    total = time.perf_counter() - started
+    stats['seconds'] = round(total, 4)
+    stats['rows_per_sec'] = round(stats['rows'] / total, 1) if total > 0 else float(stats['rows'])
+    return stats
+
+# --- ĐỌC FILE IMPORT DẠNG STREAMING ---
+# Mapping tên cột trong file Excel -> tên chuẩn (Hỗ trợ nhiều cách gọi tên)
+IMPORT_COL_MAP = {
+    'date': 'date', 'ngày': 'date', 'ngay': 'date', 'work date': 'date', 'ngay lam viec': 'date',
+    'số cont/xe': 'container_no', 'container': 'container_no', 'cont': 'container_no', 'số xe': 'container_no', 'số cont': 'container_no', 'so cont': 'container_no', 'so xe': 'container_no',
+    'task': 'task', 'hạng mục': 'task', 'công việc': 'task', 'cong viec': 'task', 'ten hang muc': 'task',
+    'account': 'account', 'tài khoản': 'account', 'tai khoan': 'account',
+    'khách hàng': 'customer', 'customer': 'customer', 'khach hang': 'customer', 'ten khach hang': 'customer',
+    'cbm': 'cbm', 'sản lượng': 'cbm', 'sl': 'cbm', 'khối lượng': 'cbm', 'san luong': 'cbm', 'khoi luong': 'cbm',
+    'tally': 'tally', 'kiểm đếm': 'tally', 'kiem dem': 'tally',
+    'xe nang': 'lift_truck', 'xe nâng': 'lift_truck', 'lift truck': 'lift_truck', 'lai xe nang': 'lift_truck',
+    'cong nhan_1': 'worker_1', 'cong nhan 1': 'worker_1', 'worker 1': 'worker_1', 'công nhân 1': 'worker_1',
+    'cong nhan_2': 'worker_2', 'cong nhan 2': 'worker_2', 'worker 2': 'worker_2', 'công nhân 2': 'worker_2',
+    'cong nhan_3': 'worker_3', 'cong nhan 3': 'worker_3', 'worker 3': 'worker_3', 'công nhân 3': 'worker_3',
+    'cong nhan_4': 'worker_4', 'cong nhan 4': 'worker_4', 'worker 4': 'worker_4', 'công nhân 4': 'worker_4',
+    'cong nhan_5': 'worker_5', 'cong nhan 5': 'worker_5', 'worker 5': 'worker_5', 'công nhân 5': 'worker_5',
+    'cong nhan_6': 'worker_6', 'cong nhan 6': 'worker_6', 'worker 6': 'worker_6', 'công nhân 6': 'worker_6',
+}
+IMPORT_REQUIRED_KEYS = ['date', 'container_no', 'task', 'account', 'customer']
+IMPORT_HEADER_SCAN_ROWS = 20   # Số dòng đầu được quét để tìm dòng tiêu đề
+IMPORT_HEADER_MIN_MATCHES = 3  # Ngưỡng chấp nhận: tìm thấy ít nhất 3 cột quen thuộc
+IMPORT_DATE_FORMATS = ('%d/%m/%Y', '%d-%m-%Y', '%d.%m.%Y', '%Y-%m-%d', '%d/%m/%Y %H:%M:%S', '%Y-%m-%d %H:%M:%S', '%d/%m/%y')
+
+class ExcelImportError(Exception):
+    """Lỗi cấu trúc file import (file trống, thiếu cột bắt buộc...)."""
+    pass
+
+def normalize_header(s):
+    """Chuẩn hóa tên cột (về chữ thường, chuẩn NFC, bỏ khoảng trắng thừa)."""
+    if s is None: return ""
+    return unicodedata.normalize('NFC', str(s)).strip().lower()
+
+def _is_blank_row(row):
+    return all(v is None or (isinstance(v, str) and not v.strip()) for v in row)
+
+def _iter_rows_openpyxl(file):
+    """Duyệt từng dòng của sheet đầu tiên ở chế độ read_only (không nạp cả workbook vào RAM)."""
+    wb = load_workbook(file, read_only=True, data_only=True)
+    try:
+        ws = wb.worksheets[0]
+        for row in ws.iter_rows(values_only=True):
+            yield row
+    finally:
+        wb.close()
+
+def _iter_rows_calamine(file):
+    """Reader viết bằng Rust (python-calamine), đọc được .xlsx/.xlsm/.xls/.xlsb, nhanh hơn openpyxl nhiều lần."""
+    wb = CalamineWorkbook.from_filelike(file)
+    try:
+        for row in wb.get_sheet_by_index(0).iter_rows():
+            yield row
+    finally:
+        if hasattr(wb, 'close'):
+            wb.close()
+
+def _iter_rows_xlrd(file):
+    """Đọc file .xls (định dạng BIFF cũ) bằng xlrd, tự đổi ô kiểu ngày sang datetime."""
+    if xlrd is None:
+        raise ExcelImportError('Máy chủ chưa cài thư viện đọc file .xls (python-calamine hoặc xlrd).')
+    book = xlrd.open_workbook(file_contents=file.read(), on_demand=True)
+    try:
+        sheet = book.sheet_by_index(0)
+        for i in range(sheet.nrows):
+            row = []
+            for cell in sheet.row(i):
+                if cell.ctype == xlrd.XL_CELL_DATE:
+                    row.append(xlrd.xldate_as_datetime(cell.value, book.datemode))
+                elif cell.ctype in (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK):
+                    row.append(None)
+                else:
+                    row.append(cell.value)
+            yield row
+    finally:
+        book.release_resources()
+
+def _iter_rows_pyxlsb(file):
+    """Đọc file .xlsb bằng pyxlsb (ô ngày được trả về dạng số serial, được chuyển đổi ở bước chuẩn hóa theo cột)."""
+    if pyxlsb is None:
+        raise ExcelImportError('Máy chủ chưa cài thư viện đọc file .xlsb (python-calamine hoặc pyxlsb).')
+    with pyxlsb.open_workbook(file) as wb:
+        with wb.get_sheet(1) as sheet:
+            for row in sheet.rows(sparse=False):
+                yield [c.v for c in row]
+
+# Engine đọc file: tên -> hàm trả về iterator các dòng (tuple/list giá trị ô)
+EXCEL_ROW_READERS = {
+    'calamine': _iter_rows_calamine,
+    'openpyxl': _iter_rows_openpyxl,
+    'xlrd': _iter_rows_xlrd,
+    'pyxlsb': _iter_rows_pyxlsb,
+}
+EXCEL_ENGINE_CHOICES = ('calamine', 'openpyxl')  # Các engine cho phép chọn trên giao diện/cài đặt
+IMPORT_ALLOWED_EXTENSIONS = ('.xlsx', '.xlsm', '.xls', '.xlsb')
+
+def resolve_excel_engine(filename, requested=None):
+    """
+    Chọn engine đọc file theo thứ tự ưu tiên: lựa chọn khi upload -> SystemSetting 'import_excel_engine'
+    -> mặc định calamine. Nếu calamine chưa được cài thì dùng openpyxl; với openpyxl, file .xls/.xlsb
+    được chuyển sang reader tương ứng (xlrd/pyxlsb) vì openpyxl chỉ đọc được định dạng OOXML.
+    """
+    engine = (requested or get_system_setting('import_excel_engine') or 'calamine').strip().lower()
+    if engine not in EXCEL_ENGINE_CHOICES:
+        engine = 'calamine'
+    if engine == 'calamine' and CalamineWorkbook is None:
+        engine = 'openpyxl'
+    if engine == 'openpyxl':
+        ext = os.path.splitext(filename or '')[1].lower()
+        if ext == '.xls':
+            engine = 'xlrd'
+        elif ext == '.xlsb':
+            engine = 'pyxlsb'
+    return engine
+
+def iter_excel_rows(file, filename=None, engine=None):
+    """Duyệt các dòng của sheet đầu tiên bằng engine đã chọn (xem resolve_excel_engine)."""
+    engine = engine or resolve_excel_engine(filename)
+    return EXCEL_ROW_READERS[engine](file)
+
+def iter_excel_records(rows):
+    """
+    Quét các dòng đúng 1 lần: tìm dòng tiêu đề trong IMPORT_HEADER_SCAN_ROWS dòng đầu
+    bằng cách đếm số cột khớp IMPORT_COL_MAP, sau đó yield từng dòng dữ liệu dạng
+    (số dòng Excel, {tên cột chuẩn: giá trị thô}).
+    Raise ExcelImportError nếu file trống hoặc thiếu cột bắt buộc.
+    """
+    rows = iter(rows)
+    buffered = []
+    header_pos = -1
+    for row in rows:
+        buffered.append(row)
+        matches = sum(1 for v in row if normalize_header(v) in IMPORT_COL_MAP)
+        if matches >= IMPORT_HEADER_MIN_MATCHES:
+            header_pos = len(buffered) - 1
+            break
+        if len(buffered) >= IMPORT_HEADER_SCAN_ROWS:
+            break
+
+    if header_pos == -1 and all(_is_blank_row(r) for r in buffered):
+        raise ExcelImportError('Lỗi: File Excel không có dữ liệu hoặc bảng tính trống.')
+
+    # Không tìm thấy dòng nào đủ từ khóa -> giữ cách cũ: coi dòng đầu tiên là tiêu đề
+    if header_pos == -1:
+        header_pos = 0
+
+    # Vị trí cột -> tên chuẩn (nếu trùng tên chuẩn thì lấy cột xuất hiện đầu tiên)
+    col_positions = {}
+    for pos, col in enumerate(buffered[header_pos]):
+        key = IMPORT_COL_MAP.get(normalize_header(col))
+        if key and key not in col_positions:
+            col_positions[key] = pos
+
+    missing = [k for k in IMPORT_REQUIRED_KEYS if k not in col_positions]
+    if missing:
+        raise ExcelImportError(f'Lỗi file: Không tìm thấy các cột bắt buộc: {", ".join(missing)}.<br>Vui lòng kiểm tra lại tên cột trong file Excel.')
+
+    def to_record(row):
+        return {key: (row[pos] if pos < len(row) else None) for key, pos in col_positions.items()}
+
+    row_no = header_pos + 1
+    for row in buffered[header_pos + 1:]:
+        row_no += 1
+        if not _is_blank_row(row):
+            yield row_no, to_record(row)
+    for row in rows:
+        row_no += 1
+        if not _is_blank_row(row):
+            yield row_no, to_record(row)
+
+# --- CHUẨN HÓA THEO CỘT (VECTORIZED) ---
+# Thứ tự cột của bảng tạm, dùng chung cho chuẩn hóa theo cột và insert hàng loạt
+IMPORT_TEMP_COLUMNS = ['date', 'container_no', 'cbm', 'tally', 'lift_truck',
+                       'worker_1', 'worker_2', 'worker_3', 'worker_4', 'worker_5', 'worker_6',
+                       'task', 'account', 'customer']
+IMPORT_CHUNK_SIZE = 5000
+
+def iter_record_chunks(records, chunk_size=IMPORT_CHUNK_SIZE):
+    """Gom các dòng (row_no, record) thành từng lô để chuẩn hóa theo cột."""
+    row_nos, chunk = [], []
+    for row_no, record in records:
+        row_nos.append(row_no)
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            yield row_nos, chunk
+            row_nos, chunk = [], []
+    if chunk:
+        yield row_nos, chunk
+
+def _as_clean_str(series):
+    """Trả về (chuỗi đã strip, mask ô rỗng) cho 1 cột object. Số nguyên dạng float (123.0) -> '123'."""
+    blank = series.isna()
+    text = series.where(~blank, '').astype(str).str.strip()
+    text = text.str.replace(r'^(-?\d+)\.0$', r'\1', regex=True)
+    blank = blank | (text == '')
+    return text, blank
+
+def _detect_date_formats(text, sample_size=50):
+    """Dò định dạng ngày từ một mẫu các giá trị khác nhau, giữ thứ tự ưu tiên của IMPORT_DATE_FORMATS."""
+    sample = text.drop_duplicates().head(sample_size).tolist()
+    found = []
+    for fmt in IMPORT_DATE_FORMATS:
+        for v in sample:
+            try:
+                datetime.strptime(v, fmt)
+            except ValueError:
+                continue
+            found.append(fmt)
+            break
+    return found
+
+def _normalize_date_column(series):
+    """Chuyển cả cột ngày sang date bằng các phép toán theo cột (serial Excel, chuỗi nhiều định dạng)."""
+    text, blank = _as_clean_str(series)
+    result = pd.Series(pd.NaT, index=series.index, dtype='datetime64[ns]')
+
+    # Số serial của Excel (VD: 45000 -> 15/03/2023)
+    serial = pd.to_numeric(text.where(~blank), errors='coerce')
+    serial = serial.where((serial > 0) & (serial < 2958466))
+    if serial.notna().any():
+        result = result.fillna(pd.to_datetime(serial, unit='D', origin='1899-12-30', errors='coerce'))
+
+    # Chuỗi ngày: dò định dạng 1 lần rồi parse cả cột theo từng định dạng tìm được
+    remaining = ~blank & result.isna()
+    if remaining.any():
+        for fmt in _detect_date_formats(text[remaining]):
+            todo = ~blank & result.isna()
+            if not todo.any():
+                break
+            result = result.fillna(pd.to_datetime(text.where(todo), format=fmt, errors='coerce'))
+        todo = ~blank & result.isna()
+        if todo.any():
+            result = result.fillna(pd.to_datetime(text.where(todo), dayfirst=True, format='mixed', errors='coerce'))
+
+    dates = result.dt.date.astype(object)
+    return dates.where(result.notna(), None)
+
+def _normalize_cbm_column(series):
+    """CBM: ô trống -> None, chữ/inf/nan -> 0.0 (giống cách xử lý cũ), còn lại -> float."""
+    text, blank = _as_clean_str(series)
+    values = pd.to_numeric(text.where(~blank), errors='coerce').astype(float)
+    values = values.where(np.isfinite(values), 0.0)
+    return values.astype(object).where(~blank, None)
+
+def normalize_import_chunk(records):
+    """
+    Chuẩn hóa 1 lô dòng thô theo cột (vectorized) thay vì vòng lặp từng dòng.
+    Trả về dict {tên cột: list giá trị} theo IMPORT_TEMP_COLUMNS, None cho ô trống.
+    """
+    frame = pd.DataFrame.from_records(records, columns=IMPORT_TEMP_COLUMNS)
+    columns = {}
+    for key in IMPORT_TEMP_COLUMNS:
+        series = frame[key].astype(object)
+        if key == 'date':
+            columns[key] = _normalize_date_column(series).tolist()
+        elif key == 'cbm':
+            columns[key] = _normalize_cbm_column(series).tolist()
+        else:
+            text, blank = _as_clean_str(series)
+            columns[key] = text.astype(object).where(~blank, None).tolist()
+    return columns
+
+# --- FILE UPLOAD LƯU TẠM TRÊN ĐĨA ---
+IMPORT_UPLOAD_CHUNK_BYTES = 1024 * 1024
+IMPORT_UPLOAD_STALE_SECONDS = 3600 # File không thuộc job nào đang chạy/chờ và cũ hơn mức này sẽ bị dọn
+
+def remove_import_upload(file_path):
+    if file_path and os.path.exists(file_path):
+        try:
+            os.remove(file_path)
+        except OSError as e:
+            print(f"[upload] Không xóa được file tạm {file_path}: {e}")
+
+def sweep_import_uploads():
+    """Dọn file upload còn sót lại (process job bị kill, server khởi động lại...) không thuộc job QUEUED/RUNNING nào."""
+    upload_dir = app.config['IMPORT_UPLOAD_DIR']
+    if not os.path.isdir(upload_dir):
+        return 0
+    active = {os.path.abspath(p) for (p,) in db.session.query(ImportJob.file_path)
+              .filter(ImportJob.status.in_(('QUEUED', 'RUNNING')), ImportJob.file_path.isnot(None))}
+    cutoff = time.time() - IMPORT_UPLOAD_STALE_SECONDS
+    removed = 0
+    for name in os.listdir(upload_dir):
+        path = os.path.abspath(os.path.join(upload_dir, name))
+        if not name.startswith('import_') or path in active:
+            continue
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+        except OSError:
+            continue
+    if removed:
+        print(f"[upload] Đã dọn {removed} file upload cũ trong {upload_dir}")
+    return removed
+
+def save_import_upload(file):
+    """
+    Ghi file upload ra IMPORT_UPLOAD_DIR theo từng khối 1 MB (không đọc cả file vào RAM của worker web),
+    để job đọc lại bằng file seek được. Vượt IMPORT_MAX_UPLOAD_MB thì xóa file và raise RequestEntityTooLarge (413).
+    Trả về (đường dẫn file, số byte).
+    """
+    upload_dir = app.config['IMPORT_UPLOAD_DIR']
+    os.makedirs(upload_dir, exist_ok=True)
+    limit = app.config['IMPORT_MAX_UPLOAD_MB'] * 1024 * 1024
+    fd, file_path = tempfile.mkstemp(prefix='import_', suffix=os.path.splitext(file.filename)[1].lower(), dir=upload_dir)
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = file.stream.read(IMPORT_UPLOAD_CHUNK_BYTES)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > limit:
+                    raise RequestEntityTooLarge()
+                out.write(chunk)
+    except BaseException:
+        remove_import_upload(file_path)
+        raise
+    return file_path, size
+
+def upload_too_large_message():
+    return f"File vượt quá dung lượng cho phép ({app.config['IMPORT_MAX_UPLOAD_MB']} MB). Vui lòng chia nhỏ file."
+
+@app.errorhandler(RequestEntityTooLarge)
+def handle_upload_too_large(e):
+    """
+    Request vượt MAX_CONTENT_LENGTH: trả 413 ngay. Riêng upload file import: JSON cho upload AJAX, form thường thì báo lỗi
+    và quay lại trang import. Các trang khác trả 413 mặc định.
+    """
+    if request.endpoint != 'import_data':
+        return e
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({'error': upload_too_large_message()}), 413
+    flash(upload_too_large_message(), 'danger')
+    return redirect(url_for('import_data'))
+
+# --- BATCH IMPORT (mỗi lần upload có dữ liệu tạm riêng) ---
+def get_import_session_key():
+    """Khóa định danh phiên làm việc hiện tại (lưu trong cookie session)."""
+    if 'import_session_key' not in session:
+        session['import_session_key'] = secrets.token_hex(16)
+    return session['import_session_key']
+
+def get_current_import_batch():
+    """Batch đang xử lý (PENDING) hoặc chờ xác nhận (STAGED) của user + phiên hiện tại, không có thì trả về None."""
+    batch_id = session.get('import_batch_id')
+    if not batch_id:
+        return None
+    return ImportBatch.query.filter(
+        ImportBatch.id == batch_id,
+        ImportBatch.user_id == current_user.id,
+        ImportBatch.session_key == get_import_session_key(),
+        ImportBatch.status.in_(['PENDING', 'STAGED'])
+    ).first()
+
+def clear_import_batch(batch_id):
+    """Xóa dữ liệu tạm của 1 batch (1 lệnh DELETE theo index batch_id, không khóa cả bảng)."""
+    db.session.query(LaborProductivityTemp).filter(LaborProductivityTemp.batch_id == batch_id).delete(synchronize_session=False)
+
+# Số dòng tạm hiển thị mỗi trang khi xem trước
+IMPORT_PREVIEW_PER_PAGE = 50
+
+def import_date_valid_expr(batch):
+    """Điều kiện SQL: Ngày làm việc nằm trong khoảng thời gian đã chọn khi upload."""
+    if not batch.upload_from_date or not batch.upload_to_date:
+        return LaborProductivityTemp.date.isnot(None)
+    # Thêm điều kiện IS NOT NULL để NOT(...) vẫn đúng với dòng thiếu ngày
+    return and_(LaborProductivityTemp.date.isnot(None), LaborProductivityTemp.date.between(batch.upload_from_date, batch.upload_to_date))
+
+def get_import_preview_summary(batch):
+    """Tổng số dòng, số dòng lỗi (theo từng loại) của batch, tính bằng 1 câu SQL aggregate trên error_code đã lưu."""
+    error_code = LaborProductivityTemp.error_code
+    row = db.session.query(
+        func.count(LaborProductivityTemp.id),
+        func.sum(case((error_code.isnot(None), 1), else_=0)),
+        func.sum(case((error_code.in_(IMPORT_ACCOUNT_ERROR_CODES), 1), else_=0)),
+        func.sum(case((import_date_valid_expr(batch), 0), else_=1)),
+        func.sum(LaborProductivityTemp.cbm)
+    ).filter(LaborProductivityTemp.batch_id == batch.id).one()
+    return {
+        'total': row[0] or 0,
+        'error_count': int(row[1] or 0),
+        'account_error_count': int(row[2] or 0),
+        'date_error_count': int(row[3] or 0),
+        'total_cbm': float(row[4] or 0),
+    }
+
+def get_import_preview_page(batch, page=1, only_errors=False, customer='', account='', out_of_window=False, per_page=IMPORT_PREVIEW_PER_PAGE):
+    """
+    1 trang dữ liệu tạm của batch, hợp lệ hay không đọc từ error_code đã lưu.
+    Trả về (pagination, preview_data) với preview_data là list {'record', 'is_valid', 'error'}.
+    """
+    query = LaborProductivityTemp.query.filter(LaborProductivityTemp.batch_id == batch.id)
+    if only_errors:
+        query = query.filter(LaborProductivityTemp.error_code.isnot(None))
+    if out_of_window:
+        query = query.filter(not_(import_date_valid_expr(batch)))
+    if customer:
+        query = query.filter(func.lower(LaborProductivityTemp.customer).like(f'%{customer.strip().lower()}%'))
+    if account:
+        query = query.filter(func.lower(LaborProductivityTemp.account).like(f'%{account.strip().lower()}%'))
+    pagination = query.order_by(LaborProductivityTemp.id).paginate(page=page, per_page=per_page, error_out=False)
+    preview_data = [{'record': t, 'is_valid': t.error_code is None, 'error': import_error_message(t.error_code, t.customer, t.account)}
+                    for t in pagination.items]
+    return pagination, preview_data
+
+def get_import_preview_args():
+    """Bộ lọc xem trước dữ liệu tạm lấy từ query string."""
+    return {
+        'preview_page': request.args.get('preview_page', 1, type=int),
+        'only_errors': request.args.get('only_errors') == '1',
+        'out_of_window': request.args.get('out_of_window') == '1',
+        'preview_customer': request.args.get('preview_customer', '').strip(),
+        'preview_account': request.args.get('preview_account', '').strip(),
+    }
+
+class ImportValidationError(Exception):
+    """Dữ liệu tạm còn lỗi nên không thể lưu chính thức. errors: list (temp_id, error_code), tải chi tiết qua file lỗi."""
+    def __init__(self, errors):
+        super().__init__(f'{len(errors)} dòng dữ liệu lỗi')
+        self.errors = errors
+
+# Mã lỗi validate lưu trên từng dòng tạm (NULL = hợp lệ)
+IMPORT_ERROR_MESSAGES = {
+    'MISSING_INFO': 'Thiếu thông tin Khách hàng hoặc Account.',
+    'UNKNOWN_CUSTOMER': "Khách hàng '{customer}' không tồn tại trong hệ thống.",
+    'ACCOUNT_NOT_IN_CUSTOMER': "Account '{account}' không thuộc khách hàng '{customer}'.",
+    'DATE_OUT_OF_RANGE': 'Ngày làm việc trống hoặc nằm ngoài khoảng thời gian đã chọn.',
+    # Lỗi chỉ kiểm tra lúc lưu chính thức (không lưu trên dòng tạm)
+    'DUPLICATE_IN_FILE': 'Trùng với dòng khác trong file (cùng ngày, số cont/xe, task, account, khách hàng, nhân sự).',
+    'ALREADY_EXISTS': 'Đã tồn tại trong dữ liệu chính thức (chọn chế độ cập nhật nếu muốn ghi đè).',
+}
+IMPORT_ACCOUNT_ERROR_CODES = ('MISSING_INFO', 'UNKNOWN_CUSTOMER', 'ACCOUNT_NOT_IN_CUSTOMER')
+# Các cột kết quả validate, theo thứ tự ImportRowResolver.resolve() trả về
+IMPORT_RESOLVED_COLUMNS = ['customer_id', 'account_id', 'task_id', 'conversion_index', 'unit', 'quantity', 'error_code', 'row_fingerprint']
+# Cột nhân sự trên dòng tạm, cùng thứ tự PRODUCTIVITY_STAFF_COLUMNS
+IMPORT_STAFF_COLUMNS = ['tally', 'lift_truck', 'worker_1', 'worker_2', 'worker_3', 'worker_4', 'worker_5', 'worker_6']
+
+def import_error_message(error_code, customer=None, account=None):
+    if not error_code:
+        return None
+    return IMPORT_ERROR_MESSAGES.get(error_code, error_code).format(customer=customer or '', account=account or '')
+
+class ImportRowResolver:
+    """
+    Tra Khách hàng/Account/Task/định mức cho dòng tạm và kiểm tra ngày theo khoảng upload của batch.
+    Danh mục chỉ tải 1 lần khi khởi tạo (mỗi job staging/kiểm tra lại, hoặc mỗi lần sửa 1 dòng).
+    """
+    def __init__(self, batch):
+        self.from_date = batch.upload_from_date
+        self.to_date = batch.upload_to_date
+
+        # { 'ten_kh_lower': customer_id }, tên chuẩn theo id để tính fingerprint đúng như khi lưu
+        self.customers = {}
+        self.customer_names = {}
+        for cid, name in db.session.query(Customer.id, Customer.customer_name):
+            self.customers[name.strip().lower()] = cid
+            self.customer_names[cid] = name
+        # { (customer_id, 'ten_acc_lower'): account_id }
+        self.accounts = {}
+        self.account_names = {}
+        for aid, cust_id, name in db.session.query(CustomerAccount.id, CustomerAccount.customer_id, CustomerAccount.account_name):
+            if name:
+                self.accounts[(cust_id, name.strip().lower())] = aid
+                self.account_names[aid] = name
+        # { (account_id, 'code_or_name_lower'): task_id } - map cả code và name để tìm kiếm linh hoạt
+        self.tasks = {}
+        self.task_names = {}
+        for tid, acc_id, code, name in db.session.query(AccountTask.id, AccountTask.account_id, AccountTask.task_code, AccountTask.task_name):
+            self.tasks[(acc_id, code.strip().lower())] = tid
+            self.tasks[(acc_id, name.strip().lower())] = tid
+            self.task_names[tid] = name
+        # Định mức theo ngày hiệu lực của từng dòng
+        self.indices = ConversionIndexResolver()
+
+    def resolve(self, work_date, cbm, task, account, customer, ref_no=None, staff=()):
+        """Trả về tuple theo IMPORT_RESOLVED_COLUMNS. staff: giá trị các cột IMPORT_STAFF_COLUMNS."""
+        customer_id = account_id = task_id = None
+        conv_index = 1.0
+        unit = 'CBM'
+        quantity = cbm if cbm is not None else 0.0
+        error_code = None
+
+        if not customer or not account:
+            error_code = 'MISSING_INFO'
+        else:
+            customer_id = self.customers.get(customer.strip().lower())
+            if customer_id is None:
+                error_code = 'UNKNOWN_CUSTOMER'
+            else:
+                account_id = self.accounts.get((customer_id, account.strip().lower()))
+                if account_id is None:
+                    error_code = 'ACCOUNT_NOT_IN_CUSTOMER'
+
+        # Tìm định mức chuyển đổi dựa trên Account, Task và ngày làm việc
+        if account_id is not None and task:
+            task_id = self.tasks.get((account_id, task.strip().lower()))
+            if task_id is not None:
+                idx = self.indices.lookup(account_id, task_id, work_date)
+                if idx:
+                    conv_index, unit = idx
+                    if cbm is not None:
+                        quantity = float(cbm) * conv_index
+
+        # Kiểm tra ngày hợp lệ nằm trong khoảng đã chọn
+        if error_code is None:
+            if not work_date or (self.from_date and self.to_date and not (self.from_date <= work_date <= self.to_date)):
+                error_code = 'DATE_OUT_OF_RANGE'
+
+        # Fingerprint theo đúng giá trị sẽ lưu (tên chuẩn trong danh mục nếu tra được)
+        fingerprint = productivity_fingerprint(
+            work_date, ref_no,
+            self.task_names.get(task_id, task), self.account_names.get(account_id, account), self.customer_names.get(customer_id, customer),
+            staff
+        )
+        return customer_id, account_id, task_id, conv_index, unit, quantity, error_code, fingerprint
+
+    def resolve_columns(self, columns):
+        """Validate cả 1 lô đã chuẩn hóa (dict cột -> list), trả về dict các cột IMPORT_RESOLVED_COLUMNS."""
+        staff_rows = zip(*(columns[c] for c in IMPORT_STAFF_COLUMNS))
+        results = [self.resolve(d, cbm, task, acc, cust, ref_no, staff)
+                   for d, cbm, task, acc, cust, ref_no, staff in zip(columns['date'], columns['cbm'], columns['task'], columns['account'],
+                                                                     columns['customer'], columns['container_no'], staff_rows)]
+        return {c: [r[i] for r in results] for i, c in enumerate(IMPORT_RESOLVED_COLUMNS)}
+
+    def apply(self, temp):
+        """Validate lại 1 dòng tạm (ORM object) sau khi sửa."""
+        resolved = self.resolve(temp.date, temp.cbm, temp.task, temp.account, temp.customer, temp.container_no,
+                                [getattr(temp, c) for c in IMPORT_STAFF_COLUMNS])
+        for column, value in zip(IMPORT_RESOLVED_COLUMNS, resolved):
+            setattr(temp, column, value)
+
+def iter_batch_temp_rows(batch_id, entities, chunk_size=IMPORT_CHUNK_SIZE, query=None):
+    """
+    Đọc dòng tạm của batch theo từng lô (keyset trên id), mỗi lô là list tuple (id, *entities).
+    Không giữ cursor mở giữa các lô nên có thể ghi vào DB trong lúc duyệt.
+    """
+    base = query if query is not None else db.session.query(LaborProductivityTemp.id, *entities)
+    last_id = 0
+    while True:
+        rows = base.filter(LaborProductivityTemp.batch_id == batch_id, LaborProductivityTemp.id > last_id) \
+                   .order_by(LaborProductivityTemp.id).limit(chunk_size).all()
+        if not rows:
+            break
+        yield rows
+        last_id = rows[-1][0]
+
+def revalidate_import_batch(batch, progress=None):
+    """
+    Validate lại toàn bộ dòng tạm của batch theo danh mục hiện tại (VD: sau khi thêm Khách hàng/Account còn thiếu).
+    Cập nhật các cột kết quả theo lô bằng executemany. Trả về list (category, message).
+    """
+    resolver = ImportRowResolver(batch)
+    table = LaborProductivityTemp.__table__
+    stmt = table.update().where(table.c.id == bindparam('temp_id'))
+    done = 0
+    error_count = 0
+    T = LaborProductivityTemp
+    entities = (T.date, T.cbm, T.task, T.account, T.customer, T.container_no) + tuple(getattr(T, c) for c in IMPORT_STAFF_COLUMNS)
+    for rows in iter_batch_temp_rows(batch.id, entities):
+        params = []
+        for row in rows:
+            values = dict(zip(IMPORT_RESOLVED_COLUMNS, resolver.resolve(*row[1:7], staff=row[7:])))
+            error_count += values['error_code'] is not None
+            values['temp_id'] = row[0]
+            params.append(values)
+        db.session.execute(stmt, params)
+        done += len(rows)
+        if progress:
+            progress(done)
+    if error_count:
+        return [('warning', f'Đã kiểm tra lại {done} dòng, còn {error_count} dòng lỗi.')]
+    return [('success', f'Đã kiểm tra lại {done} dòng, dữ liệu hợp lệ.')]
+
+def stage_import_file(batch, file, engine, progress=None):
+    """
+    Đọc file upload (1 lần, theo lô) và nạp vào bảng tạm của batch trong transaction hiện tại.
+    progress(rows_done) được gọi sau mỗi lô. Trả về list (category, message) để thông báo cho người dùng.
+    Raise ExcelImportError nếu file không dùng được.
+    """
+    # Validate ngay khi nạp, kết quả lưu cùng dòng tạm
+    staging_columns = ['batch_id', 'source_row'] + IMPORT_TEMP_COLUMNS + IMPORT_RESOLVED_COLUMNS
+    resolver = ImportRowResolver(batch)
+    total_rows = 0
+    nat_count = 0
+    error_count = 0
+    t0 = time.perf_counter()
+    records = iter_excel_records(iter_excel_rows(file, engine=engine))
+    for row_nos, chunk in iter_record_chunks(records):
+        columns = normalize_import_chunk(chunk)
+        columns.update(resolver.resolve_columns(columns))
+        columns['source_row'] = row_nos
+        nat_count += sum(1 for d in columns['date'] if d is None)
+        error_count += sum(1 for code in columns['error_code'] if code is not None)
+        total_rows += len(chunk)
+        bulk_load_rows(LaborProductivityTemp, staging_columns, ((batch.id,) + row for row in zip(*(columns[c] for c in staging_columns[1:]))))
+        if progress:
+            progress(total_rows)
+
+    if total_rows == 0:
+        raise ExcelImportError('File không có dữ liệu.')
+    print(f"[stage] labor_productivity_temp: {total_rows} dòng, {error_count} dòng lỗi, {time.perf_counter() - t0:.3f}s")
+
+    # Kiểm tra xem có bao nhiêu dòng ngày tháng bị lỗi
+    if nat_count == total_rows:
+        raise ExcelImportError('Lỗi: Toàn bộ cột Ngày tháng không đúng định dạng (VD chuẩn: 25/12/2023).')
+
+    messages = []
+    if nat_count > 0:
+        messages.append(('warning', f'Cảnh báo: Phát hiện {nat_count} dòng có định dạng ngày tháng không hợp lệ.'))
+    if error_count > 0:
+        messages.append(('warning', f'Có {error_count} dòng dữ liệu lỗi, vui lòng sửa hoặc xóa trước khi lưu.'))
+    batch.row_count = total_rows
+    batch.status = 'STAGED'
+    messages.append(('success', f'Đã đọc {total_rows} dòng vào bảng tạm. Vui lòng kiểm tra và xác nhận lưu!'))
+    return messages
+
 @app.route('/import-data', methods=['GET', 'POST'])
 @login_required
 @update_required
@@ -699,203 +1935,94 @@ def import_data():
         session['upload_from_date'] = upload_from_date_str
         session['upload_to_date'] = upload_to_date_str
             
-        if file and file.filename.endswith(('.xlsx', '.xls')):
+        if file and file.filename.lower().endswith(IMPORT_ALLOWED_EXTENSIONS):
+            file_path = None
             try:
-                # Đọc file Excel bằng pandas
-                # Sử dụng engine openpyxl để đảm bảo đọc tốt file xlsx
-                df = pd.read_excel(file, engine='openpyxl', dtype=str)
-
-                if df.empty:
-                    flash('Lỗi: File Excel không có dữ liệu hoặc bảng tính trống.', 'danger')
-                    return redirect(request.url)
-
-                # --- 1. ĐỊNH NGHĨA MAPPING CỘT (Hỗ trợ nhiều cách gọi tên) ---
-                col_map = {
-                    'date': 'date', 'ngày': 'date', 'ngay': 'date', 'work date': 'date', 'ngay lam viec': 'date',
-                    'số cont/xe': 'container_no', 'container': 'container_no', 'cont': 'container_no', 'số xe': 'container_no', 'số cont': 'container_no', 'so cont': 'container_no', 'so xe': 'container_no',
-                    'task': 'task', 'hạng mục': 'task', 'công việc': 'task', 'cong viec': 'task', 'ten hang muc': 'task',
-                    'account': 'account', 'tài khoản': 'account', 'tai khoan': 'account',
-                    'khách hàng': 'customer', 'customer': 'customer', 'khach hang': 'customer', 'ten khach hang': 'customer',
-                    'cbm': 'cbm', 'sản lượng': 'cbm', 'sl': 'cbm', 'khối lượng': 'cbm', 'san luong': 'cbm', 'khoi luong': 'cbm',
-                    'tally': 'tally', 'kiểm đếm': 'tally', 'kiem dem': 'tally',
-                    'xe nang': 'lift_truck', 'xe nâng': 'lift_truck', 'lift truck': 'lift_truck', 'lai xe nang': 'lift_truck',
-                    'cong nhan_1': 'worker_1', 'cong nhan 1': 'worker_1', 'worker 1': 'worker_1', 'công nhân 1': 'worker_1',
-                    'cong nhan_2': 'worker_2', 'cong nhan 2': 'worker_2', 'worker 2': 'worker_2', 'công nhân 2': 'worker_2',
-                    'cong nhan_3': 'worker_3', 'cong nhan 3': 'worker_3', 'worker 3': 'worker_3', 'công nhân 3': 'worker_3',
-                    'cong nhan_4': 'worker_4', 'cong nhan 4': 'worker_4', 'worker 4': 'worker_4', 'công nhân 4': 'worker_4',
-                    'cong nhan_5': 'worker_5', 'cong nhan 5': 'worker_5', 'worker 5': 'worker_5', 'công nhân 5': 'worker_5',
-                    'cong nhan_6': 'worker_6', 'cong nhan 6': 'worker_6', 'worker 6': 'worker_6', 'công nhân 6': 'worker_6',
-                }
-
-                # Hàm chuẩn hóa tên cột (về chữ thường, bỏ dấu, bỏ khoảng trắng thừa)
-                def normalize_str(s):
-                    if pd.isna(s): return ""
-                    return unicodedata.normalize('NFC', str(s)).strip().lower()
-
-                # --- 2. TỰ ĐỘNG TÌM DÒNG TIÊU ĐỀ ---
-                # Nếu dòng đầu tiên không chứa đủ từ khóa quan trọng, quét 20 dòng đầu
-                current_cols = [normalize_str(c) for c in df.columns]
-                # Đếm số lượng cột khớp với mapping
-                match_count = sum(1 for c in current_cols if c in col_map)
-                
-                # Nếu ít hơn 3 cột khớp, coi như chưa tìm thấy header đúng -> Quét lại
-                if match_count < 3:
-                    file.seek(0)
-                    # Đọc header=None để lấy dữ liệu thô
-                    df_raw = pd.read_excel(file, header=None, nrows=20, engine='openpyxl', dtype=str) 
-                    found_header_idx = -1
-                    
-                    for idx, row in df_raw.iterrows():
-                        row_vals = [normalize_str(v) for v in row.astype(str)]
-                        # Kiểm tra dòng này có bao nhiêu từ khóa khớp
-                        matches = sum(1 for v in row_vals if v in col_map)
-                        if matches >= 3: # Ngưỡng chấp nhận: tìm thấy ít nhất 3 cột quen thuộc
-                            found_header_idx = idx
-                            break
-                    
-                    if found_header_idx != -1:
-                        file.seek(0)
-                        df = pd.read_excel(file, header=found_header_idx, engine='openpyxl', dtype=str)
-
-                # --- 3. ĐỔI TÊN CỘT VỀ CHUẨN (Standard Keys) ---
-                new_columns = []
-                for col in df.columns:
-                    norm_col = normalize_str(col)
-                    # Nếu tên cột nằm trong map thì lấy tên chuẩn, không thì giữ nguyên
-                    new_columns.append(col_map.get(norm_col, col))
-                df.columns = new_columns
-
-                # --- 4. KIỂM TRA CỘT BẮT BUỘC (Dùng tên chuẩn) ---
-                required_keys = ['date', 'container_no', 'task', 'account', 'customer']
-                missing = [k for k in required_keys if k not in df.columns]
-
-                if missing:
-                    flash(f'Lỗi file: Không tìm thấy các cột bắt buộc: {", ".join(missing)}.<br>Vui lòng kiểm tra lại tên cột trong file Excel.', 'danger')
-                    return redirect(request.url)
-
-                # Xử lý cột Date: chuyển đổi chuỗi sang datetime (hỗ trợ DD/MM/YYYY)
-                if 'date' in df.columns:
-                    try:
-                        df['date'] = pd.to_datetime(df['date'], dayfirst=True, errors='coerce')
-                        # Kiểm tra xem có bao nhiêu dòng ngày tháng bị lỗi (NaT)
-                        nat_count = df['date'].isna().sum()
-                        if nat_count > 0 and len(df) > nat_count:
-                            flash(f'Cảnh báo: Phát hiện {nat_count} dòng có định dạng ngày tháng không hợp lệ.', 'warning')
-                        elif nat_count == len(df):
-                             flash('Lỗi: Toàn bộ cột Ngày tháng không đúng định dạng (VD chuẩn: 25/12/2023).', 'danger')
-                             return redirect(request.url)
-                    except Exception as date_err:
-                        flash(f'Lỗi xử lý cột ngày tháng: {str(date_err)}', 'danger')
-                        return redirect(request.url)
-
-                # Xử lý NaN thành None để tránh lỗi DB (chuyển sang object để giữ None)
-                df = df.where(pd.notnull(df), None)
-
-                # Xóa dữ liệu tạm cũ trước khi import mới
-                db.session.query(LaborProductivityTemp).delete()
-                
-                # --- TỐI ƯU HÓA: CHUẨN BỊ DỮ LIỆU ĐỂ BULK INSERT ---
-                bulk_data = []
-                for row in df.to_dict('records'):
-                    # Xử lý ngày tháng
-                    d = row.get('date')
-                    # Kiểm tra kỹ hơn để tránh lỗi NaT (Not a Time) của pandas
-                    if pd.isnull(d):
-                        d = None
-                    elif hasattr(d, 'date'):
-                        d = d.date()
-                    
-                    # Xử lý an toàn cho CBM (tránh lỗi nếu file excel có chữ trong cột số)
-                    raw_cbm = row.get('cbm')
-                    safe_cbm = None
-                    if raw_cbm is not None:
-                        try:
-                            safe_cbm = float(raw_cbm)
-                            if math.isinf(safe_cbm) or math.isnan(safe_cbm):
-                                safe_cbm = 0.0
-                        except (ValueError, TypeError):
-                            safe_cbm = 0.0
-
-                    # Helper để lấy string sạch (cắt khoảng trắng thừa)
-                    def get_str(key):
-                        val = row.get(key)
-                        return str(val).strip() if val is not None else None
-
-                    bulk_data.append({
-                        'date': d,
-                        'container_no': get_str('container_no'),
-                        'cbm': safe_cbm,
-                        'tally': get_str('tally'),
-                        'lift_truck': get_str('lift_truck'),
-                        'worker_1': get_str('worker_1'),
-                        'worker_2': get_str('worker_2'),
-                        'worker_3': get_str('worker_3'),
-                        'worker_4': get_str('worker_4'),
-                        'worker_5': get_str('worker_5'),
-                        'worker_6': get_str('worker_6'),
-                        'task': get_str('task'),
-                        'account': get_str('account'),
-                        'customer': get_str('customer')
-                    })
-                
-                # Insert hàng loạt (Nhanh hơn gấp nhiều lần so với loop add)
-                if bulk_data:
-                    db.session.bulk_insert_mappings(LaborProductivityTemp, bulk_data)
-                    db.session.commit()
-                    flash(f'Đã đọc {len(df)} dòng vào bảng tạm. Vui lòng kiểm tra và xác nhận lưu!', 'success')
-                else:
-                    flash('File không có dữ liệu.', 'warning')
-
+                # Engine đọc file: chọn khi upload hoặc theo cài đặt hệ thống (mặc định calamine)
+                engine = resolve_excel_engine(file.filename, request.form.get('excel_engine'))
+
+                # Hủy batch cũ (nếu có) của chính phiên này, không ảnh hưởng dữ liệu tạm của người khác
+                old_batch = get_current_import_batch()
+                if old_batch:
+                    clear_import_batch(old_batch.id)
+                    old_batch.status = 'CANCELLED'
+
+                # Lưu file ra đĩa (từng khối) để job chạy nền đọc, request trả về ngay
+                sweep_import_uploads()
+                file_path, file_size = save_import_upload(file)
+                print(f"[upload] {file.filename}: {file_size / 1024 / 1024:.1f} MB -> {file_path}")
+
+                batch = ImportBatch(
+                    user_id=current_user.id,
+                    session_key=get_import_session_key(),
+                    file_name=file.filename,
+                    upload_from_date=upload_from_date,
+                    upload_to_date=upload_to_date,
+                    status='PENDING',
+                )
+                db.session.add(batch)
+                db.session.flush()
+                job = ImportJob(batch_id=batch.id, user_id=current_user.id, kind='STAGE',
+                                file_path=file_path, options=json.dumps({'engine': engine}))
+                db.session.add(job)
+                db.session.commit()
+                session['import_batch_id'] = batch.id
+                session['import_job_id'] = job.id
+                submit_import_job(job)
+
+            except RequestEntityTooLarge:
+                db.session.rollback()
+                raise
             except Exception as e:
                 db.session.rollback()
+                remove_import_upload(file_path)
                 flash(f'Lỗi khi đọc file: {str(e)}', 'danger')
         else:
-            flash('Vui lòng chỉ tải lên file Excel (.xlsx, .xls)', 'danger')
-            
-    # Lấy dữ liệu tạm (nếu có)
-    temp_records = LaborProductivityTemp.query.order_by(LaborProductivityTemp.id).all()
+            flash('Vui lòng chỉ tải lên file Excel (.xlsx, .xlsm, .xls, .xlsb)', 'danger')
+        return redirect(url_for('import_data'))
+
+    # Job import của phiên này: đang chạy -> trang sẽ tự theo dõi tiến độ, đã xong -> hiển thị kết quả
+    active_job = None
+    job_id = session.get('import_job_id')
+    if job_id:
+        job = db.session.get(ImportJob, job_id)
+        if job is None or job.user_id != current_user.id:
+            session.pop('import_job_id', None)
+        elif job.status in ('QUEUED', 'RUNNING'):
+            active_job = job
+        else:
+            for category, message in json.loads(job.messages or '[]'):
+                if category == 'import_errors':
+                    mode = json.loads(job.options or '{}').get('confirm_mode', 'insert')
+                    link = url_for('download_import_errors', mode=mode)
+                    flash(f'Không thể lưu do có {message} dòng lỗi. <a href="{link}">Tải file danh sách lỗi (Excel)</a> '
+                          f'hoặc <a href="{link}&format=csv">CSV</a> để xem chi tiết.', 'danger')
+                else:
+                    flash(message, category)
+            session.pop('import_job_id', None)
+            if job.kind == 'CONFIRM' and job.status == 'DONE':
+                session.pop('import_batch_id', None)
+
+    # Xem trước dữ liệu tạm của batch hiện tại: phân trang + lọc trong SQL, không tải toàn bộ bảng tạm
+    batch = get_current_import_batch()
+    preview_args = get_import_preview_args()
+    preview_summary = None
+    preview_pagination = None
     preview_data = []
     has_errors = False
 
-    if temp_records:
-        upload_from_date_str = session.get('upload_from_date')
-        upload_to_date_str = session.get('upload_to_date')
-        upload_from_date = None
-        upload_to_date = None
-        
-        try:
-            if upload_from_date_str: upload_from_date = datetime.strptime(upload_from_date_str, '%Y-%m-%d').date()
-            if upload_to_date_str: upload_to_date = datetime.strptime(upload_to_date_str, '%Y-%m-%d').date()
-        except ValueError:
-            pass
-
-        # Tạo một map để kiểm tra hiệu quả: { 'customer_name_lower': {'account_name_lower', ...} }
-        customer_accounts_map = {}
-        all_accounts = CustomerAccount.query.join(Customer).with_entities(Customer.customer_name, CustomerAccount.account_name).all()
-        for cust_name, acc_name in all_accounts:
-            cust_key = cust_name.strip().lower()
-            if cust_key not in customer_accounts_map:
-                customer_accounts_map[cust_key] = set()
-            if acc_name:
-                customer_accounts_map[cust_key].add(acc_name.strip().lower())
-
-        for t in temp_records:
-            is_row_valid = True
-            cust_name = t.customer.strip().lower() if t.customer else ''
-            acc_name = t.account.strip().lower() if t.account else ''
-
-            # Kiểm tra xem khách hàng có tồn tại và account có thuộc khách hàng đó không
-            if not cust_name or not acc_name or cust_name not in customer_accounts_map or acc_name not in customer_accounts_map.get(cust_name, set()):
-                is_row_valid = False
-                has_errors = True
-                
-            # Kiểm tra ngày hợp lệ nằm trong khoảng đã chọn
-            if upload_from_date and upload_to_date:
-                if not t.date or t.date < upload_from_date or t.date > upload_to_date:
-                    is_row_valid = False
-                    has_errors = True
-            
-            preview_data.append({'record': t, 'is_valid': is_row_valid})
+    if batch and batch.status == 'STAGED':
+        preview_summary = get_import_preview_summary(batch)
+        has_errors = preview_summary['error_count'] > 0
+        if preview_summary['total']:
+            preview_pagination, preview_data = get_import_preview_page(
+                batch,
+                page=preview_args['preview_page'],
+                only_errors=preview_args['only_errors'],
+                customer=preview_args['preview_customer'],
+                account=preview_args['preview_account'],
+                out_of_window=preview_args['out_of_window'],
+            )
     
     # Lấy dữ liệu chính thức để hiển thị (phân trang)
     page = request.args.get('page', 1, type=int)
@@ -919,201 +2046,703 @@ def import_data():
     records = query.order_by(LaborProductivity.id.desc()).paginate(page=page, per_page=20, error_out=False)
     
     today_date = datetime.now().strftime('%Y-%m-%d')
-    return render_template('importdata.html', records=records, preview_data=preview_data, has_errors=has_errors, from_date=from_date, to_date=to_date, today_date=today_date)
+    default_engine = get_system_setting('import_excel_engine', 'calamine')
+    return render_template('importdata.html', records=records, preview_data=preview_data, has_errors=has_errors, from_date=from_date, to_date=to_date, today_date=today_date, excel_engines=EXCEL_ENGINE_CHOICES, default_engine=default_engine, active_job=active_job, preview_summary=preview_summary, preview_pagination=preview_pagination, preview_args=preview_args, confirm_modes=IMPORT_CONFIRM_MODES, max_upload_mb=app.config['IMPORT_MAX_UPLOAD_MB'])
+
+# Thứ tự cột khi insert hàng loạt vào labor_productivity
+PRODUCTIVITY_INSERT_COLUMNS = ['work_date', 'ref_no', 'productivity_value', 'tally_id', 'xenang_id',
+                               'congnhan1_id', 'congnhan2_id', 'congnhan3_id', 'congnhan4_id', 'congnhan5_id', 'congnhan6_id',
+                               'task_id', 'account_id', 'customer_id', 'unit', 'conversion_index', 'quantity', 'row_fingerprint']
+# Chế độ lưu chính thức: insert = chỉ thêm mới (báo lỗi nếu dòng đã tồn tại), upsert = cập nhật dòng đã tồn tại theo fingerprint,
+# replace_period = xóa toàn bộ dữ liệu trong khoảng thời gian upload rồi lưu dữ liệu mới (cùng 1 transaction)
+IMPORT_CONFIRM_MODES = {
+    'insert': 'Thêm mới',
+    'upsert': 'Thêm mới + cập nhật dòng đã có',
+    'replace_period': 'Thay thế toàn bộ dữ liệu trong kỳ upload',
+}
+
+def delete_productivity_period(from_date, to_date, chunk_days=None, progress=None):
+    """
+    Xóa labor_productivity (và labor_productivity_staff đi kèm) có work_date trong [from_date, to_date],
+    mỗi lệnh DELETE chỉ 1 khoảng chunk_days ngày (theo index work_date) để không khóa 1 lượt quá nhiều dòng.
+    Chạy trong transaction hiện tại, không commit. Trả về số dòng đã xóa.
+    """
+    chunk_days = max(1, chunk_days or app.config['IMPORT_REPLACE_CHUNK_DAYS'])
+    deleted = 0
+    start = from_date
+    while start <= to_date:
+        end = min(start + timedelta(days=chunk_days - 1), to_date)
+        in_range = LaborProductivity.work_date.between(start, end)
+        ids_in_range = select(LaborProductivity.id).where(in_range)
+        db.session.query(LaborProductivityStaff).filter(LaborProductivityStaff.productivity_id.in_(ids_in_range)).delete(synchronize_session=False)
+        deleted += db.session.query(LaborProductivity).filter(in_range).delete(synchronize_session=False)
+        if progress:
+            progress('replace', deleted)
+        start = end + timedelta(days=1)
+    return deleted
+
+def replace_import_period(batch, progress=None):
+    """Chế độ replace_period: xóa dữ liệu cũ trong khoảng upload của batch trước khi insert. Trả về số dòng đã xóa."""
+    if not batch.upload_from_date or not batch.upload_to_date:
+        raise ValueError('Batch không có khoảng thời gian upload, không thể thay thế dữ liệu theo kỳ.')
+    deleted = delete_productivity_period(batch.upload_from_date, batch.upload_to_date, progress=progress)
+    print(f"[confirm] Đã xóa {deleted} dòng labor_productivity từ {batch.upload_from_date} đến {batch.upload_to_date}")
+    return deleted
+
+def save_import_batch_staff(batch, progress=None):
+    """
+    Ghi labor_productivity_staff cho các dòng sản lượng vừa lưu từ batch (khớp theo row_fingerprint của dòng tạm),
+    để báo cáo tổng hợp theo employee_id thay vì so khớp chuỗi nhân sự mỗi lần xem. Chạy trong transaction hiện tại.
+    """
+    if progress:
+        progress('staff', 0)
+    T = LaborProductivityTemp
+    batch_fingerprints = select(T.row_fingerprint).where(T.batch_id == batch.id, T.row_fingerprint.isnot(None))
+    t0 = time.perf_counter()
+    processed, written = write_productivity_staff(LaborProductivity.row_fingerprint.in_(batch_fingerprints),
+                                                  progress=(lambda done, _: progress('staff', done)) if progress else None)
+    print(f"[confirm] labor_productivity_staff: {written} dòng cho {processed} dòng sản lượng, {time.perf_counter() - t0:.3f}s")
+    return written
+
+def refresh_import_batch_rollups(batch, mode, progress=None):
+    """Cập nhật bảng tổng hợp theo ngày cho các ngày của batch (replace_period: cả khoảng upload, gồm ngày chỉ bị xóa)."""
+    if progress:
+        progress('rollup', 0)
+    t0 = time.perf_counter()
+    if mode == 'replace_period':
+        days = rebuild_productivity_rollups(batch.upload_from_date, batch.upload_to_date)
+    else:
+        T = LaborProductivityTemp
+        days = refresh_productivity_rollups(d for (d,) in db.session.query(T.date).filter(T.batch_id == batch.id).distinct())
+    print(f"[confirm] Bảng tổng hợp: cập nhật {days} ngày, {time.perf_counter() - t0:.3f}s")
+
+# Cột so sánh để biết dòng upsert có thay đổi hay không (các cột còn lại nằm trong fingerprint)
+IMPORT_UPSERT_COMPARE_COLUMNS = [('cbm', 'productivity_value'), ('unit', 'unit'), ('conversion_index', 'conversion_index'), ('quantity', 'quantity')]
+
+def get_import_duplicate_errors(batch, mode):
+    """
+    Kiểm tra trùng theo fingerprint (set-based), trả về list (temp_id, error_code):
+    dòng trùng nhau trong cùng file luôn là lỗi, dòng đã có trong dữ liệu chính thức là lỗi ở chế độ insert.
+    """
+    T = LaborProductivityTemp
+    dup_in_file = db.session.query(T.row_fingerprint).filter(T.batch_id == batch.id, T.row_fingerprint.isnot(None)) \
+        .group_by(T.row_fingerprint).having(func.count(T.id) > 1)
+    errors = [(temp_id, 'DUPLICATE_IN_FILE') for (temp_id,) in
+              db.session.query(T.id).filter(T.batch_id == batch.id, T.row_fingerprint.in_(dup_in_file))]
+    # replace_period: dòng cũ trong kỳ sẽ bị xóa trước (dòng tạm đều đã nằm trong kỳ) nên không cần kiểm tra
+    if mode == 'insert':
+        errors += [(temp_id, 'ALREADY_EXISTS') for (temp_id,) in
+                   db.session.query(T.id).join(LaborProductivity, LaborProductivity.row_fingerprint == T.row_fingerprint)
+                   .filter(T.batch_id == batch.id)]
+    return errors
+
+def count_import_upsert(batch):
+    """Đếm trước (inserted, updated, unchanged) khi upsert batch, bằng join theo fingerprint."""
+    T = LaborProductivityTemp
+    same = and_(*[func.coalesce(getattr(T, t), -1) == func.coalesce(getattr(LaborProductivity, p), -1) if t != 'unit'
+                  else func.coalesce(T.unit, '') == func.coalesce(LaborProductivity.unit, '')
+                  for t, p in IMPORT_UPSERT_COMPARE_COLUMNS])
+    total, matched, unchanged = db.session.query(
+        func.count(T.id),
+        func.count(LaborProductivity.id),
+        func.sum(case((and_(LaborProductivity.id.isnot(None), same), 1), else_=0))
+    ).outerjoin(LaborProductivity, LaborProductivity.row_fingerprint == T.row_fingerprint) \
+     .filter(T.batch_id == batch.id).one()
+    unchanged = int(unchanged or 0)
+    return total - matched, matched - unchanged, unchanged
+
+def import_confirm_result_message(saved, mode, counts, batch=None):
+    if mode == 'replace_period':
+        return ('success', f"Đã thay thế dữ liệu từ {batch.upload_from_date.strftime('%d/%m/%Y')} đến {batch.upload_to_date.strftime('%d/%m/%Y')}: "
+                           f"xóa {counts} dòng cũ, lưu {saved} dòng mới.")
+    if mode == 'upsert':
+        inserted, updated, unchanged = counts
+        return ('success', f'Đã lưu chính thức: {inserted} dòng mới, {updated} dòng cập nhật, {unchanged} dòng không thay đổi.')
+    return ('success', f'Đã lưu chính thức {saved} dòng dữ liệu!')
+
+def get_import_batch_errors(batch):
+    """Các dòng tạm lỗi theo error_code đã lưu lúc staging/sửa dòng, list (temp_id, error_code)."""
+    T = LaborProductivityTemp
+    return db.session.query(T.id, T.error_code).filter(T.batch_id == batch.id, T.error_code.isnot(None)).all()
+
+def collect_import_errors(batch, mode='insert'):
+    """
+    Toàn bộ lỗi của batch dạng gọn list (temp_id, error_code) sắp theo dòng: lỗi dữ liệu (error_code đã lưu lúc
+    staging/sửa dòng/kiểm tra lại) + lỗi trùng fingerprint theo chế độ lưu.
+    """
+    errors = get_import_batch_errors(batch)
+    return sorted(set(tuple(e) for e in errors) | set(get_import_duplicate_errors(batch, mode)))
+
+def import_stored_rows_select(batch):
+    """
+    SELECT các cột PRODUCTIVITY_INSERT_COLUMNS của dòng tạm theo kết quả validate đã lưu (ids, định mức, quantity),
+    lấy tên theo danh mục qua id đã lưu như confirm_import_batch, nên khớp với row_fingerprint đã tính lúc validate.
+    """
+    T = LaborProductivityTemp
+    return select(
+        T.date, T.container_no, T.cbm, T.tally, T.lift_truck,
+        T.worker_1, T.worker_2, T.worker_3, T.worker_4, T.worker_5, T.worker_6,
+        func.coalesce(AccountTask.task_name, T.task), CustomerAccount.account_name, Customer.customer_name,
+        T.unit, T.conversion_index, T.quantity, T.row_fingerprint
+    ).select_from(T) \
+     .outerjoin(Customer, Customer.id == T.customer_id) \
+     .outerjoin(CustomerAccount, CustomerAccount.id == T.account_id) \
+     .outerjoin(AccountTask, AccountTask.id == T.task_id) \
+     .where(T.batch_id == batch.id).order_by(T.id)
+
+def confirm_import_batch_sql(batch, progress=None, mode='insert'):
+    """
+    Confirm set-based: cùng dữ liệu với confirm_import_batch (kết quả validate đã lưu trên dòng tạm) nhưng lưu bằng 1 câu
+    INSERT INTO labor_productivity ... SELECT ... FROM labor_productivity_temp JOIN danh mục theo id đã lưu, không đưa dòng
+    qua Python. Không tra lại danh mục nên tên và row_fingerprint luôn khớp nhau. Raise ImportValidationError nếu còn dòng lỗi.
+    """
+    if progress:
+        progress('validate', 0)
+    errors = collect_import_errors(batch, mode)
+    if errors:
+        raise ImportValidationError(errors)
+
+    counts = None
+    if mode == 'replace_period':
+        counts = replace_import_period(batch, progress)
+    if progress:
+        progress('confirm', 0)
+    if mode == 'upsert':
+        counts = count_import_upsert(batch)
+    rows_select = import_stored_rows_select(batch)
+    t0 = time.perf_counter()
+    if mode == 'upsert':
+        # INSERT ... SELECT ... ON DUPLICATE KEY UPDATE (MySQL) / ON CONFLICT DO UPDATE (SQLite, PostgreSQL)
+        update_columns = [c for c in PRODUCTIVITY_INSERT_COLUMNS if c != 'row_fingerprint']
+        if db.engine.dialect.name == 'mysql':
+            stmt = mysql_insert(LaborProductivity.__table__).from_select(PRODUCTIVITY_INSERT_COLUMNS, rows_select)
+            stmt = stmt.on_duplicate_key_update({c: stmt.inserted[c] for c in update_columns})
+        else:
+            dialect_insert = postgresql_insert if db.engine.dialect.name == 'postgresql' else sqlite_insert
+            stmt = dialect_insert(LaborProductivity.__table__).from_select(PRODUCTIVITY_INSERT_COLUMNS, rows_select)
+            stmt = stmt.on_conflict_do_update(index_elements=['row_fingerprint'], set_={c: stmt.excluded[c] for c in update_columns})
+        result = db.session.execute(stmt)
+    else:
+        result = db.session.execute(insert(LaborProductivity.__table__).from_select(PRODUCTIVITY_INSERT_COLUMNS, rows_select))
+    saved = sum(counts) if mode == 'upsert' else result.rowcount
+    print(f"[confirm-sql] labor_productivity ({mode}): {saved} dòng, {time.perf_counter() - t0:.3f}s")
+    save_import_batch_staff(batch, progress)
+    refresh_import_batch_rollups(batch, mode, progress)
+
+    bump_data_version()
+    clear_import_batch(batch.id)
+    batch.status = 'CONFIRMED'
+    if progress:
+        progress('done', saved)
+    if not saved:
+        return [('warning', 'Không có dữ liệu tạm để lưu.')]
+    return [import_confirm_result_message(saved, mode, counts, batch)]
+
+def confirm_import_batch(batch, progress=None, mode='insert'):
+    """
+    Lưu chính thức dữ liệu tạm của batch vào labor_productivity trong transaction hiện tại.
+    Dùng kết quả validate đã lưu trên dòng tạm (ids, định mức, quantity, error_code), không tra lại danh mục.
+    progress(stage, rows_done) được gọi khi chuyển bước. Trả về list (category, message).
+    Raise ImportValidationError nếu còn dòng lỗi.
+    """
+    if not db.session.query(LaborProductivityTemp.id).filter(LaborProductivityTemp.batch_id == batch.id).first():
+        return [('warning', 'Không có dữ liệu tạm để lưu.')]
+
+    # --- BƯỚC 1: KIỂM TRA DÒNG LỖI (đã validate khi staging/sửa dòng) ---
+    if progress:
+        progress('validate', 0)
+    errors = collect_import_errors(batch, mode)
+    if errors:
+        raise ImportValidationError(errors)
+
+    # --- BƯỚC 2: LƯU DỮ LIỆU ---
+    # Lưu tên theo danh mục (Task không có trong danh mục thì giữ tên gốc từ Excel)
+    counts = None
+    if mode == 'replace_period':
+        counts = replace_import_period(batch, progress)
+    if progress:
+        progress('confirm', 0)
+    T = LaborProductivityTemp
+    query = db.session.query(
+        T.id, T.date, T.container_no, T.cbm, T.tally, T.lift_truck,
+        T.worker_1, T.worker_2, T.worker_3, T.worker_4, T.worker_5, T.worker_6,
+        func.coalesce(AccountTask.task_name, T.task), CustomerAccount.account_name, Customer.customer_name,
+        T.unit, T.conversion_index, T.quantity, T.row_fingerprint
+    ).outerjoin(Customer, Customer.id == T.customer_id) \
+     .outerjoin(CustomerAccount, CustomerAccount.id == T.account_id) \
+     .outerjoin(AccountTask, AccountTask.id == T.task_id)
+
+    if mode == 'upsert':
+        counts = count_import_upsert(batch)
+    saved = 0
+    t0 = time.perf_counter()
+    for rows in iter_batch_temp_rows(batch.id, (), query=query):
+        # Insert hàng loạt vào bảng chính (chia lô, executemany qua driver)
+        bulk_load_rows(LaborProductivity, PRODUCTIVITY_INSERT_COLUMNS, (tuple(row[1:]) for row in rows),
+                       upsert_key='row_fingerprint' if mode == 'upsert' else None)
+        saved += len(rows)
+        if progress:
+            progress('confirm', saved)
+    print(f"[confirm] labor_productivity ({mode}): {saved} dòng, {time.perf_counter() - t0:.3f}s")
+    save_import_batch_staff(batch, progress)
+    refresh_import_batch_rollups(batch, mode, progress)
+
+    # Xóa dữ liệu tạm của batch sau khi lưu thành công
+    bump_data_version()
+    clear_import_batch(batch.id)
+    batch.status = 'CONFIRMED'
+    if progress:
+        progress('done', saved)
+    return [import_confirm_result_message(saved, mode, counts, batch)]
+
+# --- JOB IMPORT CHẠY NỀN (process pool riêng, không chiếm worker của web) ---
+class ImportJobTimeout(Exception):
+    """Job import vượt quá thời gian cho phép (IMPORT_JOB_TIMEOUT)."""
+    pass
+
+_import_executor = None
+_in_import_worker = False
+_import_job_pending = set() # id các job process web này đã đưa vào pool mà chưa chạy xong
+
+def _import_worker_init(memory_mb):
+    """Khởi tạo process con: đặt giới hạn bộ nhớ cho job (mỗi process chỉ chạy 1 job)."""
+    global _in_import_worker
+    _in_import_worker = True
+    if resource is not None and memory_mb:
+        limit = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+def _import_job_timeout_handler(signum, frame):
+    raise ImportJobTimeout(f'Job vượt quá thời gian cho phép ({app.config["IMPORT_JOB_TIMEOUT"]} giây).')
+
+def get_import_executor():
+    global _import_executor
+    if _import_executor is None:
+        _import_executor = ProcessPoolExecutor(
+            max_workers=app.config['IMPORT_JOB_WORKERS'],
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_import_worker_init,
+            initargs=(app.config['IMPORT_JOB_MEMORY_MB'],),
+            max_tasks_per_child=1,
+        )
+    return _import_executor
+
+def session_holds_sqlite_write_lock():
+    """SQLite chỉ cho 1 kết nối ghi: transaction của session đã ghi dữ liệu thì kết nối khác phải chờ tới khi bị "database is locked"."""
+    if db.engine.dialect.name != 'sqlite' or not db.session().in_transaction():
+        return False
+    return db.session.connection().connection.dbapi_connection.in_transaction
+
+def set_import_job(job_id, only_status=None, **values):
+    """
+    Cập nhật trạng thái job bằng kết nối riêng, để trang theo dõi thấy ngay cả khi transaction import chưa commit.
+    Riêng SQLite khi transaction import đang giữ khóa ghi thì ghi luôn trong transaction đó (thấy khi commit) thay vì chờ khóa.
+    only_status: chỉ cập nhật nếu job đang ở trạng thái này. Trả về True nếu có dòng được cập nhật.
+    """
+    table = ImportJob.__table__
+    stmt = table.update().where(table.c.id == job_id).values(**values)
+    if only_status:
+        stmt = stmt.where(table.c.status == only_status)
+    try:
+        if session_holds_sqlite_write_lock():
+            return db.session.execute(stmt).rowcount > 0
+        with db.engine.begin() as conn:
+            return conn.execute(stmt).rowcount > 0
+    except Exception as e:
+        print(f"Lỗi cập nhật trạng thái job {job_id}: {e}")
+        return False
+
+def _run_import_job(job_id):
+    """Chạy 1 job import (trong process con của pool, hoặc trực tiếp nếu IMPORT_JOB_WORKERS=0)."""
+    with app.app_context():
+        job = db.session.get(ImportJob, job_id)
+        if job is None:
+            return
+        batch = db.session.get(ImportBatch, job.batch_id) if job.batch_id is not None else None
+        options = json.loads(job.options or '{}')
+        first_stage = {'STAGE': 'parse', 'STAFF': 'staff'}.get(job.kind, 'validate')
+        # Job đã bị đánh lỗi khi còn chờ trong hàng đợi (quá IMPORT_JOB_QUEUE_TIMEOUT) thì không chạy nữa
+        if not set_import_job(job_id, only_status='QUEUED', status='RUNNING', stage=first_stage, started_at=datetime.now()):
+            if job.kind == 'STAGE':
+                remove_import_upload(job.file_path)
+            return
+
+        use_alarm = _in_import_worker and hasattr(signal, 'SIGALRM') and app.config['IMPORT_JOB_TIMEOUT'] > 0
+        if use_alarm:
+            signal.signal(signal.SIGALRM, _import_job_timeout_handler)
+            signal.alarm(app.config['IMPORT_JOB_TIMEOUT'])
+
+        status = 'DONE'
+        try:
+            if job.kind == 'STAGE':
+                with open(job.file_path, 'rb') as f:
+                    messages = stage_import_file(batch, f, options.get('engine'), progress=lambda n: set_import_job(job_id, rows_done=n))
+                set_import_job(job_id, stage='stage')
+            elif job.kind == 'VALIDATE':
+                set_import_job(job_id, rows_total=batch.row_count)
+                messages = revalidate_import_batch(batch, progress=lambda n: set_import_job(job_id, rows_done=n))
+            elif job.kind == 'STAFF':
+                processed = refresh_employee_staff(options.get('employee_ids', []), options.get('values', []))
+                bump_data_version()
+                messages = [('success', f'Đã cập nhật {processed} dòng sản lượng theo danh mục nhân viên.')]
+            else:
+                set_import_job(job_id, rows_total=batch.row_count)
+                confirm = confirm_import_batch_sql if app.config['IMPORT_CONFIRM_MODE'] == 'sql' else confirm_import_batch
+                messages = confirm(batch, progress=lambda stage, n: set_import_job(job_id, stage=stage, rows_done=n),
+                                   mode=options.get('confirm_mode', 'insert'))
+            db.session.commit()
+        except ImportValidationError as e:
+            db.session.rollback()
+            status = 'FAILED'
+            # Chỉ lưu số dòng lỗi, chi tiết tải qua file lỗi (không đưa từng dòng vào flash/session)
+            messages = [('import_errors', str(len(e.errors)))]
+        except ExcelImportError as e:
+            db.session.rollback()
+            status = 'FAILED'
+            messages = [('danger', str(e))]
+        except ImportJobTimeout as e:
+            db.session.rollback()
+            status = 'FAILED'
+            messages = [('danger', str(e))]
+        except MemoryError:
+            db.session.rollback()
+            status = 'FAILED'
+            messages = [('danger', f'Job vượt quá giới hạn bộ nhớ ({app.config["IMPORT_JOB_MEMORY_MB"]} MB). Vui lòng chia nhỏ file.')]
+        except Exception as e:
+            db.session.rollback()
+            status = 'FAILED'
+            messages = [('danger', f'Lỗi khi xử lý dữ liệu: {str(e)}')]
+        finally:
+            if use_alarm:
+                signal.alarm(0)
+            if job.kind == 'STAGE':
+                remove_import_upload(job.file_path)
+
+        if status == 'FAILED' and job.kind == 'STAGE':
+            db.session.query(ImportBatch).filter_by(id=job.batch_id).update({'status': 'FAILED'})
+            db.session.commit()
+        values = {'status': status, 'stage': 'done', 'messages': json.dumps(messages), 'finished_at': datetime.now()}
+        if status == 'DONE' and batch is not None:
+            values['rows_total'] = batch.row_count
+            values['rows_done'] = batch.row_count
+        set_import_job(job_id, **values)
+
+def _import_job_done(job_id, future):
+    """Callback ở process web: nếu process con chết bất thường (vượt bộ nhớ, bị kill...) thì đánh dấu job lỗi."""
+    global _import_executor
+    _import_job_pending.discard(job_id)
+    error = future.exception()
+    if error is None:
+        return
+    if isinstance(error, BrokenProcessPool):
+        _import_executor = None
+    with app.app_context():
+        job = db.session.get(ImportJob, job_id)
+        if job and job.status in ('QUEUED', 'RUNNING'):
+            set_import_job(job_id, status='FAILED', stage='done', finished_at=datetime.now(),
+                           messages=json.dumps([('danger', f'Job import bị dừng bất thường: {error}')]))
+            if job.kind == 'STAGE':
+                set_import_batch_status(job.batch_id, 'FAILED')
+                remove_import_upload(job.file_path)
+
+def set_import_batch_status(batch_id, status):
+    with db.engine.begin() as conn:
+        conn.execute(ImportBatch.__table__.update().where(ImportBatch.__table__.c.id == batch_id).values(status=status))
+
+def submit_import_job(job):
+    """Đưa job vào process pool; IMPORT_JOB_WORKERS=0 thì chạy luôn trong request (dùng khi dev)."""
+    if app.config['IMPORT_JOB_WORKERS'] <= 0:
+        _run_import_job(job.id)
+        return
+    future = get_import_executor().submit(_run_import_job, job.id)
+    _import_job_pending.add(job.id)
+    future.add_done_callback(functools.partial(_import_job_done, job.id))
+
+def import_job_to_dict(job):
+    return {
+        'id': job.id,
+        'batch_id': job.batch_id,
+        'kind': job.kind,
+        'status': job.status,
+        'stage': job.stage,
+        'rows_total': job.rows_total,
+        'rows_done': job.rows_done or 0,
+        'messages': json.loads(job.messages or '[]'),
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+def get_user_import_job_or_404(id):
+    job = db.session.get(ImportJob, id)
+    if job is None or (job.user_id != current_user.id and current_user.role != 'ADMIN'):
+        abort(404)
+    return job
+
+@app.route('/import-data/jobs/<int:id>')
+@login_required
+@update_required
+def import_job_status(id):
+    job = get_user_import_job_or_404(id)
+    # Job bị bỏ dở (VD: server khởi động lại) quá thời gian cho phép -> coi như lỗi. Job đang chạy tính từ lúc bắt đầu chạy,
+    # job còn chờ tính từ lúc tạo với giới hạn riêng, trừ khi pool của process này vẫn đang giữ job đó
+    if job.status == 'RUNNING':
+        since, limit = job.started_at or job.created_at, app.config['IMPORT_JOB_TIMEOUT'] + 300
+    elif job.status == 'QUEUED' and job.id not in _import_job_pending:
+        since, limit = job.created_at, app.config['IMPORT_JOB_QUEUE_TIMEOUT']
+    else:
+        since = None
+    if since and (datetime.now() - since).total_seconds() > limit:
+        if set_import_job(job.id, only_status=job.status, status='FAILED', stage='done', finished_at=datetime.now(),
+                          messages=json.dumps([('danger', 'Job import không phản hồi, vui lòng thử lại.')])):
+            if job.kind == 'STAGE':
+                set_import_batch_status(job.batch_id, 'FAILED')
+        db.session.refresh(job)
+    return jsonify(import_job_to_dict(job))
+
+def get_running_import_job(batch):
+    """Job đang chờ/đang chạy của batch (mỗi batch chỉ chạy 1 job tại 1 thời điểm)."""
+    return ImportJob.query.filter(ImportJob.batch_id == batch.id, ImportJob.status.in_(['QUEUED', 'RUNNING'])).first()
 
 @app.route('/import-data/confirm', methods=['POST'])
 @login_required
 @update_required
 def confirm_import():
     try:
-        temps = LaborProductivityTemp.query.order_by(LaborProductivityTemp.id).all()
-        if not temps:
+        batch = get_current_import_batch()
+        if not batch or batch.status != 'STAGED' or not batch.row_count:
             flash('Không có dữ liệu tạm để lưu.', 'warning')
             return redirect(url_for('import_data'))
-            
-        # --- TỐI ƯU HÓA: TẢI TRƯỚC DỮ LIỆU VÀO RAM (CACHE) ---
-        # Thay vì query trong vòng lặp, ta query 1 lần và lưu vào Dictionary
-        
-        # 1. Cache Customers: { 'ten_kh_lower': id }
-        customers_map = {c.customer_name.strip().lower(): c for c in Customer.query.all()}
-        
-        # 2. Cache Accounts: { (customer_id, 'ten_acc_lower'): account_obj }
-        accounts_map = {}
-        for acc in CustomerAccount.query.all():
-            key = (acc.customer_id, acc.account_name.strip().lower())
-            accounts_map[key] = acc
-
-        # 3. Cache Tasks: { (account_id, 'code_or_name_lower'): task_obj }
-        tasks_map = {}
-        for t in AccountTask.query.all():
-            # Map cả code và name để tìm kiếm linh hoạt
-            tasks_map[(t.account_id, t.task_code.strip().lower())] = t
-            tasks_map[(t.account_id, t.task_name.strip().lower())] = t
-
-        # 4. Cache Conversion Indices: { (account_id, task_id): index_obj }
-        # Lấy tất cả index, sắp xếp theo ngày hiệu lực tăng dần
-        # Khi đưa vào dict, giá trị sau sẽ ghi đè giá trị trước -> Lấy được cái mới nhất
-        indices_map = {}
-        all_indices = AccountConversionIndex.query.order_by(AccountConversionIndex.effective_from).all()
-        for idx in all_indices:
-            indices_map[(idx.account_id, idx.task_id)] = idx
-
-        # Danh sách chứa dữ liệu để insert hàng loạt
-        bulk_insert_list = []
-        
-        # --- BƯỚC 1: VALIDATE DỮ LIỆU TRƯỚC KHI LƯU ---
-        errors = []
-        for i, t in enumerate(temps):
-            if not t.customer or not t.account:
-                errors.append(f"Dòng {i + 1}: Thiếu thông tin Khách hàng hoặc Account.")
-                continue
 
-            cust_key = t.customer.strip().lower()
-            acc_key = t.account.strip().lower()
-            
-            customer = customers_map.get(cust_key)
-            if not customer:
-                errors.append(f"Dòng {i + 1}: Khách hàng '{t.customer}' không tồn tại trong hệ thống.")
-                continue
-
-            acc = accounts_map.get((customer.id, acc_key))
-            if not acc:
-                errors.append(f"Dòng {i + 1}: Account '{t.account}' không thuộc khách hàng '{t.customer}'.")
-
-        if errors:
-            flash('Không thể lưu do có lỗi dữ liệu. Vui lòng kiểm tra lại:', 'danger')
-            for error in errors:
-                flash(error, 'danger')
+        running = get_running_import_job(batch)
+        if running:
+            session['import_job_id'] = running.id
+            flash('Dữ liệu đang được xử lý, vui lòng chờ.', 'info')
             return redirect(url_for('import_data'))
 
-        # --- BƯỚC 2: LƯU DỮ LIỆU NẾU KHÔNG CÓ LỖI ---
-        for t in temps:
-            # Mặc định ban đầu
-            conv_index = 1.0
-            unit = 'CBM'
-            quantity = t.cbm if t.cbm is not None else 0.0
-            
-            # Lấy object từ Cache (đã validate ở trên nên chắc chắn có Customer và Account)
-            cust_key = t.customer.strip().lower()
-            customer = customers_map[cust_key]
-            
-            acc_key = t.account.strip().lower()
-            acc = accounts_map[(customer.id, acc_key)]
-            
-            task_obj = None
-
-            # Tìm định mức chuyển đổi dựa trên Account Code và Task Code
-            if t.task:
-                task_val = t.task.strip().lower()
-                # Tìm Task trong Cache
-                task_obj = tasks_map.get((acc.id, task_val))
-
-                if task_obj:
-                    # Tìm Index trong Cache
-                    idx_index = indices_map.get((acc.id, task_obj.id))
-                    
-                    if idx_index:
-                        conv_index = float(idx_index.conversion_index)
-                        unit = idx_index.unit
-                        if t.cbm is not None:
-                            quantity = float(t.cbm) * conv_index
-            
-            # Sử dụng tên từ các object đã tìm thấy để lưu, nếu không tìm thấy thì dùng tên gốc từ Excel.
-            task_name_to_save = task_obj.task_name if task_obj else t.task
-            account_name_to_save = acc.account_name if acc else t.account
-            customer_name_to_save = customer.customer_name if customer else t.customer
-
-            bulk_insert_list.append({
-                'work_date': t.date,
-                'ref_no': t.container_no,
-                'productivity_value': t.cbm,
-                'tally_id': t.tally,
-                'xenang_id': t.lift_truck,
-                'congnhan1_id': t.worker_1,
-                'congnhan2_id': t.worker_2,
-                'congnhan3_id': t.worker_3,
-                'congnhan4_id': t.worker_4,
-                'congnhan5_id': t.worker_5,
-                'congnhan6_id': t.worker_6,
-                'task_id': task_name_to_save,
-                'account_id': account_name_to_save,
-                'customer_id': customer_name_to_save,
-                'unit': unit,
-                'conversion_index': conv_index,
-                'quantity': quantity
-            })
-        
-        # Insert hàng loạt vào bảng chính
-        if bulk_insert_list:
-            db.session.bulk_insert_mappings(LaborProductivity, bulk_insert_list)
-            
-        # Xóa dữ liệu tạm sau khi lưu thành công
-        db.session.query(LaborProductivityTemp).delete()
+        confirm_mode = request.form.get('confirm_mode', 'insert')
+        if confirm_mode not in IMPORT_CONFIRM_MODES:
+            confirm_mode = 'insert'
+        job = ImportJob(batch_id=batch.id, user_id=current_user.id, kind='CONFIRM', rows_total=batch.row_count,
+                        options=json.dumps({'confirm_mode': confirm_mode}))
+        db.session.add(job)
         db.session.commit()
-        flash(f'Đã lưu chính thức {len(bulk_insert_list)} dòng dữ liệu!', 'success')
+        session['import_job_id'] = job.id
+        submit_import_job(job)
     except Exception as e:
         db.session.rollback()
         flash(f'Lỗi khi lưu dữ liệu: {str(e)}', 'danger')
     return redirect(url_for('import_data'))
 
-@app.route('/import-data/cancel', methods=['POST'])
+@app.route('/import-data/revalidate', methods=['POST'])
 @login_required
 @update_required
-def cancel_import():
+def revalidate_import():
     try:
-        db.session.query(LaborProductivityTemp).delete()
+        batch = get_current_import_batch()
+        if not batch or batch.status != 'STAGED' or not batch.row_count:
+            flash('Không có dữ liệu tạm để kiểm tra.', 'warning')
+            return redirect(url_for('import_data'))
+
+        running = get_running_import_job(batch)
+        if running:
+            session['import_job_id'] = running.id
+            flash('Dữ liệu đang được xử lý, vui lòng chờ.', 'info')
+            return redirect(url_for('import_data'))
+
+        job = ImportJob(batch_id=batch.id, user_id=current_user.id, kind='VALIDATE', rows_total=batch.row_count)
+        db.session.add(job)
         db.session.commit()
-        flash('Đã hủy bỏ dữ liệu tạm.', 'info')
+        session['import_job_id'] = job.id
+        submit_import_job(job)
     except Exception as e:
-        flash(f'Lỗi: {str(e)}', 'danger')
+        db.session.rollback()
+        flash(f'Lỗi khi kiểm tra dữ liệu: {str(e)}', 'danger')
     return redirect(url_for('import_data'))
 
-@app.route('/import-data/update-temp/<int:id>', methods=['POST'])
+# Cột file lỗi: giữ tiêu đề như file mẫu import để sửa xong có thể upload lại
+IMPORT_ERROR_EXPORT_COLUMNS = [
+    ('date', 'Date'), ('container_no', 'số cont/xe'), ('cbm', 'cbm'), ('tally', 'tally'), ('lift_truck', 'xe nang'),
+    ('worker_1', 'cong nhan_1'), ('worker_2', 'cong nhan_2'), ('worker_3', 'cong nhan_3'),
+    ('worker_4', 'cong nhan_4'), ('worker_5', 'cong nhan_5'), ('worker_6', 'cong nhan_6'),
+    ('task', 'task'), ('account', 'account'), ('customer', 'khách hàng'),
+]
+
+def iter_import_error_rows(errors, chunk_size=1000):
+    """Từ list (temp_id, error_code) sinh các dòng file lỗi: dòng Excel, mã lỗi, lý do, dữ liệu gốc. Đọc dòng tạm theo lô id."""
+    codes_by_id = {}
+    for temp_id, code in errors:
+        codes_by_id.setdefault(temp_id, []).append(code)
+    ids = sorted(codes_by_id)
+    for start in range(0, len(ids), chunk_size):
+        temps = LaborProductivityTemp.query.filter(LaborProductivityTemp.id.in_(ids[start:start + chunk_size])) \
+            .order_by(LaborProductivityTemp.id).all()
+        for t in temps:
+            codes = codes_by_id[t.id]
+            values = [getattr(t, attr) for attr, _ in IMPORT_ERROR_EXPORT_COLUMNS]
+            values[0] = t.date.strftime('%d/%m/%Y') if t.date else ''
+            yield [t.source_row, ', '.join(codes), '; '.join(import_error_message(c, t.customer, t.account) for c in codes)] + values
+
+@app.route('/import-data/errors')
+@login_required
+@update_required
+def download_import_errors():
+    batch = get_current_import_batch()
+    if not batch or batch.status != 'STAGED':
+        flash('Không có dữ liệu tạm để kiểm tra.', 'warning')
+        return redirect(url_for('import_data'))
+    mode = request.args.get('mode', 'insert')
+    if mode not in IMPORT_CONFIRM_MODES:
+        mode = 'insert'
+    errors = collect_import_errors(batch, mode)
+    header = ['Dòng Excel', 'Mã lỗi', 'Lý do'] + [label for _, label in IMPORT_ERROR_EXPORT_COLUMNS]
+    base_name = f"loi_import_{os.path.splitext(batch.file_name or 'file')[0]}"
+
+    if request.args.get('format') == 'csv':
+        def generate():
+            yield '\ufeff' # BOM để Excel mở đúng tiếng Việt
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(header)
+            for row in iter_import_error_rows(errors):
+                writer.writerow(['' if v is None else v for v in row])
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate(0)
+            yield buffer.getvalue()
+        return Response(stream_with_context(generate()), mimetype='text/csv; charset=utf-8',
+                        headers={'Content-Disposition': f"attachment; filename*=UTF-8''{quote(base_name)}.csv"})
+
+    # Workbook write_only ghi thẳng ra file tạm, không giữ toàn bộ dòng trong bộ nhớ
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('Loi import')
+    ws.append(header)
+    for row in iter_import_error_rows(errors):
+        ws.append(row)
+    output = tempfile.SpooledTemporaryFile(max_size=10 * 1024 * 1024)
+    wb.save(output)
+    output.seek(0)
+    return send_file(output, as_attachment=True, download_name=f'{base_name}.xlsx',
+                     mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
+@app.route('/import-data/cancel', methods=['POST'])
 @login_required
 @update_required
-def update_temp_data(id):
+def cancel_import():
     try:
-        temp = LaborProductivityTemp.query.get_or_404(id)
-        
-        # Cập nhật dữ liệu từ form
-        date_str = request.form.get('date')
-        if date_str:
-            temp.date = datetime.strptime(date_str, '%Y-%m-%d').date()
-            
-        temp.container_no = request.form.get('container_no')
-        temp.cbm = request.form.get('cbm')
-        temp.tally = request.form.get('tally')
-        temp.lift_truck = request.form.get('lift_truck')
-        temp.worker_1 = request.form.get('worker_1')
-        temp.worker_2 = request.form.get('worker_2')
-        temp.worker_3 = request.form.get('worker_3')
-        temp.worker_4 = request.form.get('worker_4')
-        temp.worker_5 = request.form.get('worker_5')
-        temp.worker_6 = request.form.get('worker_6')
-        temp.task = request.form.get('task')
-        temp.account = request.form.get('account')
-        temp.customer = request.form.get('customer')
-        
-        db.session.commit()
-        flash('Cập nhật dòng dữ liệu tạm thành công!', 'success')
+        batch = get_current_import_batch()
+        if batch:
+            clear_import_batch(batch.id)
+            batch.status = 'CANCELLED'
+            db.session.commit()
+        session.pop('import_batch_id', None)
+        flash('Đã hủy bỏ dữ liệu tạm.', 'info')
     except Exception as e:
         db.session.rollback()
-        flash(f'Lỗi cập nhật: {str(e)}', 'danger')
+        flash(f'Lỗi: {str(e)}', 'danger')
     return redirect(url_for('import_data'))
 
-@app.route('/import-data/delete-temp/<int:id>', methods=['POST'])
+def import_temp_to_dict(t):
+    """Dòng tạm dạng JSON cho lưới xem trước (cập nhật tại chỗ sau khi sửa)."""
+    data = {c: getattr(t, c) for c in IMPORT_TEMP_COLUMNS}
+    data['date'] = t.date.isoformat() if t.date else None
+    data.update({
+        'id': t.id,
+        'source_row': t.source_row,
+        'is_valid': t.error_code is None,
+        'error_code': t.error_code,
+        'error': import_error_message(t.error_code, t.customer, t.account),
+        'quantity': t.quantity,
+        'unit': t.unit,
+    })
+    return data
+
+def parse_import_temp_value(column, value):
+    """Chuyển giá trị JSON của 1 cột dòng tạm về kiểu lưu DB. Raise ValueError nếu sai định dạng."""
+    if value is None or (isinstance(value, str) and value.strip() == ''):
+        return None
+    if column == 'date':
+        return datetime.strptime(str(value).strip(), '%Y-%m-%d').date()
+    if column == 'cbm':
+        return float(value)
+    return str(value).strip()
+
+@app.route('/import-data/temp-rows', methods=['PATCH'])
 @login_required
 @update_required
-def delete_temp_data(id):
+def patch_temp_rows():
+    """
+    Sửa/xóa nhiều dòng tạm trong 1 transaction.
+    Body: {"updates": [{"id": 1, "cbm": 12.5, ...}], "deletes": [2, 3]}
+    Chỉ validate lại các dòng được sửa; trả về trạng thái mới của các dòng đó và số liệu tổng của batch.
+    """
+    batch = get_current_import_batch()
+    if not batch or batch.status != 'STAGED':
+        return jsonify({'error': 'Không có dữ liệu tạm để sửa.'}), 404
+    if get_running_import_job(batch):
+        return jsonify({'error': 'Dữ liệu đang được xử lý, vui lòng chờ.'}), 409
+
+    payload = request.get_json(silent=True) or {}
+    updates = payload.get('updates') or []
+    deletes = payload.get('deletes') or []
+    if not isinstance(updates, list) or not isinstance(deletes, list):
+        return jsonify({'error': 'Dữ liệu gửi lên không hợp lệ.'}), 400
+
     try:
-        temp = LaborProductivityTemp.query.get_or_404(id)
-        db.session.delete(temp)
+        update_ids = [int(u['id']) for u in updates]
+        delete_ids = [int(i) for i in deletes]
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'Thiếu hoặc sai id dòng.'}), 400
+
+    try:
+        temps = {}
+        if update_ids:
+            temps = {t.id: t for t in LaborProductivityTemp.query.filter(
+                LaborProductivityTemp.batch_id == batch.id, LaborProductivityTemp.id.in_(update_ids))}
+        missing = [i for i in update_ids if i not in temps]
+        if missing:
+            return jsonify({'error': f'Không tìm thấy dòng: {missing}'}), 404
+
+        # Áp dụng thay đổi (chỉ các cột dữ liệu gốc, cột kết quả validate do server tính)
+        errors = []
+        for diff in updates:
+            temp = temps[int(diff['id'])]
+            for column, value in diff.items():
+                if column not in IMPORT_TEMP_COLUMNS:
+                    continue
+                try:
+                    setattr(temp, column, parse_import_temp_value(column, value))
+                except ValueError:
+                    errors.append(f"Dòng {temp.source_row or temp.id}: giá trị '{value}' của cột {column} không hợp lệ.")
+        if errors:
+            db.session.rollback()
+            return jsonify({'error': ' '.join(errors)}), 400
+
+        if temps:
+            resolver = ImportRowResolver(batch)
+            for temp in temps.values():
+                resolver.apply(temp)
+
+        deleted = 0
+        if delete_ids:
+            deleted = LaborProductivityTemp.query.filter(
+                LaborProductivityTemp.batch_id == batch.id, LaborProductivityTemp.id.in_(delete_ids)
+            ).delete(synchronize_session=False)
+            batch.row_count = max(0, (batch.row_count or 0) - deleted)
+
         db.session.commit()
-        flash('Đã xóa dòng dữ liệu tạm.', 'success')
     except Exception as e:
         db.session.rollback()
-        flash(f'Lỗi xóa: {str(e)}', 'danger')
-    return redirect(url_for('import_data'))
+        return jsonify({'error': f'Lỗi cập nhật: {str(e)}'}), 500
+
+    summary = get_import_preview_summary(batch)
+    return jsonify({
+        'rows': [import_temp_to_dict(t) for t in temps.values() if t.id not in delete_ids],
+        'deleted': delete_ids,
+        'deleted_count': deleted,
+        'summary': summary,
+        'has_errors': summary['error_count'] > 0,
+    })
 
 @app.route('/settings', methods=['GET', 'POST'])
 @login_required
@@ -1128,11 +2757,22 @@ def settings():
         prefixes_clean = ",".join([p.strip().upper() for p in prefixes_input.split(',') if p.strip()])
         
         setting = SystemSetting.query.filter_by(key_name='exclusion_prefixes').first()
+        if not setting or setting.value != prefixes_clean:
+            bump_data_version() # Tiền tố loại trừ ảnh hưởng bảng tổng hợp nhân sự
         if not setting:
             setting = SystemSetting(key_name='exclusion_prefixes', value=prefixes_clean)
             db.session.add(setting)
         else:
             setting.value = prefixes_clean
+
+        # Engine đọc file Excel mặc định khi import
+        excel_engine = request.form.get('import_excel_engine', '').strip().lower()
+        if excel_engine in EXCEL_ENGINE_CHOICES:
+            engine_setting = SystemSetting.query.filter_by(key_name='import_excel_engine').first()
+            if not engine_setting:
+                db.session.add(SystemSetting(key_name='import_excel_engine', value=excel_engine))
+            else:
+                engine_setting.value = excel_engine
         
         db.session.commit()
         flash('Cập nhật cài đặt thành công!', 'success')
@@ -1140,7 +2780,8 @@ def settings():
 
     setting = SystemSetting.query.filter_by(key_name='exclusion_prefixes').first()
     current_prefixes = setting.value if setting else "TB, IF, HB" # Giá trị mặc định nếu chưa cấu hình
-    return render_template('settings.html', current_prefixes=current_prefixes)
+    current_engine = get_system_setting('import_excel_engine', 'calamine')
+    return render_template('settings.html', current_prefixes=current_prefixes, current_engine=current_engine, excel_engines=EXCEL_ENGINE_CHOICES)
 
 @app.route('/users', methods=['GET', 'POST'])
 @login_required
@@ -1272,14 +2913,13 @@ def get_conversion_info():
         ).first()
         if not task: return default_response
 
-        # Lấy index mới nhất, bỏ qua ngày hiệu lực để nhất quán với logic import
-        index = AccountConversionIndex.query.filter(
-            AccountConversionIndex.account_id == account.id,
-            AccountConversionIndex.task_id == task.id
-        ).order_by(AccountConversionIndex.effective_from.desc()).first()
+        # Lấy index có hiệu lực tại ngày làm việc (mặc định hôm nay), cùng quy tắc với import
+        work_date_str = request.args.get('work_date')
+        work_date = datetime.strptime(work_date_str, '%Y-%m-%d').date() if work_date_str else date.today()
+        index = ConversionIndexResolver(account_ids=[account.id], task_ids=[task.id]).lookup(account.id, task.id, work_date)
 
         if index:
-            return jsonify({'conversion_index': float(index.conversion_index), 'unit': index.unit})
+            return jsonify({'conversion_index': index[0], 'unit': index[1]})
         else:
             return default_response
     except Exception:
@@ -1320,6 +2960,7 @@ def manage_productivity():
 def edit_productivity(id):
     record = LaborProductivity.query.get_or_404(id)
     try:
+        old_date = record.work_date
         record.work_date = datetime.strptime(request.form['work_date'], '%Y-%m-%d').date()
         record.ref_no = request.form['ref_no']
         record.customer_id = request.form['customer_id']
@@ -1330,6 +2971,10 @@ def edit_productivity(id):
         # Cập nhật CBM gốc nếu cần (productivity_value)
         if request.form.get('productivity_value'):
             record.productivity_value = float(request.form['productivity_value'])
+        record.row_fingerprint = fingerprint_of_productivity(record)
+        db.session.flush()
+        refresh_productivity_rollups([old_date, record.work_date])
+        bump_data_version()
             
         db.session.commit()
         flash('Cập nhật sản lượng thành công!', 'success')
@@ -1344,7 +2989,11 @@ def edit_productivity(id):
 def delete_productivity(id):
     record = LaborProductivity.query.get_or_404(id)
     try:
+        LaborProductivityStaff.query.filter_by(productivity_id=record.id).delete(synchronize_session=False)
         db.session.delete(record)
+        db.session.flush()
+        refresh_productivity_rollups([record.work_date])
+        bump_data_version()
         db.session.commit()
         flash('Xóa bản ghi thành công!', 'success')
     except Exception as e:
@@ -1352,17 +3001,300 @@ def delete_productivity(id):
         flash(f'Lỗi xóa: {e}', 'danger')
     return redirect(url_for('manage_productivity'))
 
-@app.route('/report', methods=['GET', 'POST'])
-@login_required
-@view_required
-def report():
+# --- TRUY VẤN TỔNG HỢP CHO BÁO CÁO (GROUP BY trong DB) ---
+# Vai trò hiển thị theo cột nhân sự trên labor_productivity
+REPORT_STAFF_ROLES = [('tally_id', 'Tally'), ('xenang_id', 'Xe nâng')] + [(f'congnhan{i}_id', 'Công nhân') for i in range(1, 7)]
+
+def get_exclusion_prefixes():
+    """Các tiền tố mã nhân sự bị loại khỏi báo cáo (cài đặt 'exclusion_prefixes', mặc định TB,IF,HB)."""
+    setting = SystemSetting.query.filter_by(key_name='exclusion_prefixes').first()
+    prefixes_str = setting.value if setting else "TB,IF,HB"
+    return tuple(p.strip() for p in prefixes_str.split(',') if p.strip())
+
+def _like_prefix(prefix):
+    """Mẫu LIKE 'prefix%' (escape ký tự đặc biệt của LIKE trong prefix)."""
+    return prefix.replace('/', '//').replace('%', '/%').replace('_', '/_') + '%'
+
+def _date_range_conditions(column, from_date, to_date):
+    conditions = []
+    if from_date:
+        conditions.append(column >= from_date)
+    if to_date:
+        conditions.append(column <= to_date)
+    return conditions
+
+class RollupNotReadyError(Exception):
+    """Kỳ báo cáo có dữ liệu chi tiết nhưng bảng tổng hợp / labor_productivity_staff chưa được dựng (VD: vừa upgrade-db)."""
+    pass
+
+def ensure_rollups_ready(from_date, to_date, staff=False):
+    """
+    Báo lỗi thay vì trả số 0 khi kỳ có dòng sản lượng mà productivity_daily_totals chưa có dòng nào
+    (staff=True: hoặc labor_productivity_staff còn trống). Chỉ là vài truy vấn EXISTS theo index work_date.
+    """
+    P = LaborProductivity
+    has_detail = db.session.query(select(P.id).where(*_date_range_conditions(P.work_date, from_date, to_date)).exists()).scalar()
+    if not has_detail:
+        return
+    DT = ProductivityDailyTotal
+    if not db.session.query(select(DT.id).where(*_date_range_conditions(DT.work_date, from_date, to_date)).exists()).scalar():
+        raise RollupNotReadyError('Bảng tổng hợp chưa có dữ liệu cho kỳ này. Vui lòng chạy "flask rebuild-rollups" (hoặc "flask upgrade-db").')
+    if staff and not db.session.query(select(LaborProductivityStaff.id).exists()).scalar():
+        raise RollupNotReadyError('Chưa có dữ liệu nhân sự theo dòng. Vui lòng chạy "flask backfill-staff" (hoặc "flask upgrade-db").')
+
+def query_staff_summary(from_date, to_date):
+    """
+    Tổng sản lượng theo (mã nhân sự ghi trên dòng, vai trò): UNION ALL 8 cột nhân sự rồi GROUP BY trong DB.
+    Mỗi lần xuất hiện ở 1 cột tính 1 lượt. Loại mã theo tiền tố cài đặt (NOT LIKE), đánh dấu mã không có
+    trong danh mục (so với Employee.masl) bằng subquery. Trả về list dict name/role/total_qty/count/remark.
+    """
+    P = LaborProductivity
+    period = _date_range_conditions(P.work_date, from_date, to_date)
+    parts = []
+    for column, role in REPORT_STAFF_ROLES:
+        col = getattr(P, column)
+        parts.append(select(col.label('name'), literal(role).label('role'), P.quantity.label('quantity'))
+                     .where(col.isnot(None), col != '', *period))
+    workers = union_all(*parts).subquery()
+
+    excluded = [func.upper(workers.c.name).like(_like_prefix(prefix.upper()), escape='/') for prefix in get_exclusion_prefixes()]
+    valid_codes = select(Employee.masl).where(Employee.masl.isnot(None), Employee.masl != '')
+    query = select(
+        workers.c.name, workers.c.role,
+        func.sum(func.coalesce(workers.c.quantity, 0.0)), func.count(),
+        func.max(case((workers.c.name.in_(valid_codes), 1), else_=0))
+    ).group_by(workers.c.name, workers.c.role)
+    if excluded:
+        query = query.where(not_(or_(*excluded)))
+    return [{'name': name, 'role': role, 'total_qty': float(qty or 0.0), 'count': int(count),
+             'remark': "" if is_valid else "Không có trong danh sách"}
+            for name, role, qty, count, is_valid in db.session.execute(query)]
+
+def query_customer_summary(from_date, to_date):
+    """Tổng sản lượng theo khách hàng từ bảng tổng hợp theo ngày, sắp theo sản lượng giảm dần."""
+    DT = ProductivityDailyTotal
+    query = db.session.query(DT.customer_id, func.sum(DT.quantity), func.sum(DT.row_count)) \
+        .filter(*_date_range_conditions(DT.work_date, from_date, to_date)).group_by(DT.customer_id)
+    customer_summary = [{'name': name or "Khác", 'total_qty': float(qty or 0.0), 'count': int(count or 0)}
+                        for name, qty, count in query]
+    customer_summary.sort(key=lambda x: x['total_qty'], reverse=True)
+    return customer_summary
+
+# --- BỘ MÁY TỔNG HỢP SẢN LƯỢNG DÙNG CHUNG (/report, /report/export, /report/export-anchung) ---
+REPORT_OUTPUTS = ('staff_summary', 'customer_summary', 'account_columns', 'employee_groups', 'detail_rows', 'employee_detail')
+# Output theo từng dòng sản lượng: chỉ file xuất dùng và đọc 1 lần, không đưa vào cache báo cáo (quá lớn so với lợi ích)
+REPORT_ROW_OUTPUTS = frozenset(('detail_rows', 'employee_detail'))
+REPORT_DETAIL_COLUMNS = ('id', 'work_date', 'ref_no', 'customer_id', 'account_id', 'task_id', 'quantity', 'unit',
+                         'productivity_value', 'conversion_index') + tuple(PRODUCTIVITY_STAFF_COLUMNS)
+REPORT_STREAM_CHUNK = 2000 # Số dòng mỗi lần lấy từ cursor khi duyệt dữ liệu chi tiết
+REPORT_ACCOUNT_PALETTE = ['FF00B050', 'FF00B0F0', 'FF70AD47', 'FF92D050', 'FFFFC000', 'FFED7D31', 'FFC00000', 'FF7030A0']
+
+def get_report_account_columns(to_date):
+    """
+    Cột theo account cho file xuất: các account có hệ số hiệu lực tại cuối kỳ (không chọn ngày thì lấy hôm nay),
+    sắp theo tên, bỏ trùng tên. Trả về list dict title/coef/color.
+    """
+    try:
+        rate_date = datetime.strptime(to_date, '%Y-%m-%d').date() if to_date else date.today()
+    except ValueError:
+        rate_date = date.today()
+    index_resolver = ConversionIndexResolver()
+    latest_index_by_account = {}
+    for acc_id in index_resolver.account_ids():
+        rate = index_resolver.account_rate(acc_id, rate_date)
+        if rate is not None:
+            latest_index_by_account[acc_id] = rate
+
+    account_columns = []
+    seen_account_names = set()
+    if latest_index_by_account:
+        accounts = CustomerAccount.query.filter(
+            CustomerAccount.id.in_(latest_index_by_account.keys())
+        ).order_by(CustomerAccount.account_name.asc()).all()
+        for i, acc in enumerate(accounts):
+            name_key = normalize_employee_key(acc.account_name)
+            if not name_key or name_key in seen_account_names:
+                continue
+            seen_account_names.add(name_key)
+            account_columns.append({
+                'title': acc.account_name.strip(),
+                'coef': latest_index_by_account.get(acc.id, 1.0),
+                'color': REPORT_ACCOUNT_PALETTE[i % len(REPORT_ACCOUNT_PALETTE)],
+            })
+    return account_columns
+
+def query_employee_group_summary(from_date, to_date, account_columns=()):
+    """
+    Tổng hợp cho TẤT CẢ nhân viên (kể cả chưa có sản lượng) từ bảng tổng hợp theo nhân viên, chia 2 nhóm khoán / ăn chung.
+    Mỗi dòng gồm total_raw, total_converted, count (số lượt tham gia) và accounts = {title: CBM chưa quy đổi} theo account_columns.
+    Trả về {'khoan': [...], 'an_chung': [...]}, sắp theo tên.
+    """
+    DS = ProductivityDailyStaff
+    column_by_key = {normalize_employee_key(cfg['title']): cfg['title'] for cfg in account_columns}
+    query = db.session.query(DS.employee_id, DS.account_id, func.sum(DS.raw_cbm), func.sum(DS.quantity), func.sum(DS.row_count)) \
+        .filter(*_date_range_conditions(DS.work_date, from_date, to_date)).group_by(DS.employee_id, DS.account_id)
+    # Mỗi nhân viên chỉ có 1 vai trò trên 1 dòng sản lượng nên tổng row_count = số lượt tham gia
+    totals = {}
+    for emp_id, account, raw, qty, count in query:
+        item = totals.setdefault(emp_id, {'total_raw': 0.0, 'total_converted': 0.0, 'count': 0, 'accounts': {}})
+        item['total_raw'] += float(raw or 0.0)
+        item['total_converted'] += float(qty or 0.0)
+        item['count'] += int(count or 0)
+        title = column_by_key.get(normalize_employee_key(account))
+        if title:
+            item['accounts'][title] = item['accounts'].get(title, 0.0) + float(raw or 0.0)
+
+    groups = {'khoan': [], 'an_chung': []}
+    employees = db.session.query(Employee.id, Employee.employee_code, Employee.masl, Employee.full_name,
+                                 Employee.position, Employee.employee_type).order_by(Employee.id)
+    for emp_id, code, masl, full_name, position, employee_type in employees:
+        item = totals.get(emp_id) or {'total_raw': 0.0, 'total_converted': 0.0, 'count': 0, 'accounts': {}}
+        groups['an_chung' if is_an_chung_type(employee_type) else 'khoan'].append({
+            'employee_code': code or '',
+            'masl': masl or '',
+            'full_name': full_name or '',
+            'position': position or '',
+            **item,
+        })
+    for rows in groups.values():
+        rows.sort(key=lambda x: x['full_name'].lower())
+    return groups
+
+def stream_productivity_rows(from_date, to_date, detail_rows=True, employee_detail=False, chunk_size=REPORT_STREAM_CHUNK):
+    """
+    1 lần duyệt cursor stream (yield_per, không tạo ORM object) trên labor_productivity trong kỳ, sắp theo ngày giảm dần.
+    employee_detail=True thì LEFT JOIN labor_productivity_staff để lấy luôn (dòng, nhân viên) trong cùng lần duyệt.
+    Trả về dict detail_rows (list Row theo REPORT_DETAIL_COLUMNS) / employee_detail ({'khoan'|'an_chung': [(row, emp)]}).
+    """
+    P = LaborProductivity
+    S = LaborProductivityStaff
+    query = select(*[getattr(P, c) for c in REPORT_DETAIL_COLUMNS]) \
+        .where(*_date_range_conditions(P.work_date, from_date, to_date)).order_by(P.work_date.desc(), P.id.desc())
+    employees = {}
+    if employee_detail:
+        # Nạp danh mục trước khi mở cursor stream (MySQL không cho chạy truy vấn khác trên kết nối đang stream)
+        employees = {emp.id: emp for emp in db.session.query(
+            Employee.id, Employee.employee_code, Employee.masl, Employee.full_name, Employee.position, Employee.employee_type)}
+        query = query.add_columns(S.employee_id).outerjoin(S, S.productivity_id == P.id).order_by(S.id)
+
+    result = {}
+    rows = result['detail_rows'] = [] if detail_rows else None
+    groups = result['employee_detail'] = {'khoan': [], 'an_chung': []} if employee_detail else None
+    last_id = None
+    for row in db.session.execute(query.execution_options(yield_per=chunk_size)):
+        if rows is not None and row.id != last_id:
+            rows.append(row)
+            last_id = row.id
+        if groups is not None:
+            emp = employees.get(row.employee_id)
+            if emp:
+                groups['an_chung' if is_an_chung_type(emp.employee_type) else 'khoan'].append((row, emp))
+    return {key: value for key, value in result.items() if value is not None}
+
+def aggregate_productivity(from_date, to_date, outputs, use_cache=True):
+    """
+    Bộ máy tổng hợp dùng chung cho báo cáo và các file xuất. outputs: tập con REPORT_OUTPUTS.
+    Các bảng tổng hợp lấy bằng GROUP BY trong DB (bảng tổng hợp theo ngày / theo nhân viên); dữ liệu theo dòng
+    (detail_rows, employee_detail) tính chung trong 1 lần duyệt cursor stream. Trả về dict theo tên output,
+    lấy từ cache báo cáo nếu kỳ / outputs / phiên bản dữ liệu đã được tính (use_cache=False để tính lại);
+    có output theo dòng (REPORT_ROW_OUTPUTS) thì luôn tính lại.
+    """
+    outputs = frozenset(outputs)
+    unknown = outputs - set(REPORT_OUTPUTS)
+    if unknown:
+        raise ValueError(f"Output không hợp lệ: {', '.join(sorted(unknown))}")
+    if use_cache and not outputs & REPORT_ROW_OUTPUTS:
+        return cached_report('aggregate', (from_date, to_date, outputs),
+                             lambda: aggregate_productivity(from_date, to_date, outputs, use_cache=False))
+
+    if outputs & {'customer_summary', 'employee_groups'}:
+        ensure_rollups_ready(from_date, to_date, staff='employee_groups' in outputs)
+    result = {}
+    if 'staff_summary' in outputs:
+        result['staff_summary'] = query_staff_summary(from_date, to_date)
+    if 'customer_summary' in outputs:
+        result['customer_summary'] = query_customer_summary(from_date, to_date)
+    if 'account_columns' in outputs:
+        result['account_columns'] = get_report_account_columns(to_date)
+    if 'employee_groups' in outputs:
+        result['employee_groups'] = query_employee_group_summary(from_date, to_date, result.get('account_columns', ()))
+    if outputs & {'detail_rows', 'employee_detail'}:
+        result.update(stream_productivity_rows(from_date, to_date, 'detail_rows' in outputs, 'employee_detail' in outputs))
+    return result
+
+# Kiểu tra cứu nhân sự ở tab Tra cứu: exact / prefix đi qua index (danh mục nhân viên + labor_productivity_staff),
+# contains giữ cách cũ (so chuỗi trên 8 cột nhân sự, quét toàn bảng, tìm được cả mã/tên không có trong danh mục) và là mặc định
+REPORT_SEARCH_MODES = ('exact', 'prefix', 'contains')
+REPORT_SEARCH_DEFAULT_MODE = 'contains'
+
+REPORT_SEARCH_EMPLOYEE_LIMIT = 20 # Số nhân viên khớp được liệt kê trên trang (tra cứu vẫn lấy dòng của tất cả)
+
+def search_employee_condition(term, mode):
+    """Điều kiện mã NV, MSL hoặc họ tên khớp term (exact: bằng, prefix: bắt đầu bằng, contains: chứa) trên danh mục nhân viên."""
+    term = unicodedata.normalize('NFC', term).strip()
+    if mode == 'exact':
+        return or_(Employee.employee_code == term, Employee.masl == term, Employee.full_name == term)
+    if mode == 'contains':
+        pattern = _like_contains(term)
+        return or_(Employee.employee_code.ilike(pattern, escape='/'), Employee.masl.ilike(pattern, escape='/'),
+                   Employee.full_name.ilike(pattern, escape='/'))
+    pattern = _like_prefix(term)
+    return or_(Employee.employee_code.like(pattern, escape='/'), Employee.masl.like(pattern, escape='/'),
+               Employee.full_name.like(pattern, escape='/'))
+
+def query_report_search(from_date, to_date, search_emp_code, search_account_id, mode=REPORT_SEARCH_DEFAULT_MODE):
+    """
+    Tra cứu chuyên sâu: các dòng sản lượng theo nhân sự / account trong kỳ, kèm tổng sản lượng và tổng theo ngày.
+    Kiểu exact / prefix tìm nhân viên trong danh mục rồi lấy dòng sản lượng qua labor_productivity_staff
+    (index (employee_id, productivity_id)), nên thời gian phụ thuộc số dòng của nhân viên chứ không phụ thuộc kích thước bảng.
+    Kiểu contains lấy cả dòng có cột nhân sự chứa chuỗi (quét bảng, gồm mã/tên không có trong danh mục) lẫn dòng của các
+    nhân viên trong danh mục khớp chuỗi, nên không ra ít dòng hơn exact / prefix.
+    """
+    P = LaborProductivity
+    S = LaborProductivityStaff
+    query = select(*[getattr(P, c) for c in REPORT_DETAIL_COLUMNS]).where(*_date_range_conditions(P.work_date, from_date, to_date))
+    if search_account_id:
+        query = query.where(P.account_id == search_account_id)
+    employees = []
+    if search_emp_code:
+        ensure_rollups_ready(from_date, to_date, staff=True)
+        condition = search_employee_condition(search_emp_code, mode)
+        employees = db.session.query(Employee.employee_code, Employee.masl, Employee.full_name) \
+            .filter(condition).order_by(Employee.employee_code).limit(REPORT_SEARCH_EMPLOYEE_LIMIT + 1).all()
+        if not employees and mode != 'contains':
+            return {'results': [], 'total_qty': 0.0, 'daily': [], 'employees': [], 'employees_more': False}
+        matched_ids = select(Employee.id).where(condition)
+        by_staff = P.id.in_(select(S.productivity_id).where(S.employee_id.in_(matched_ids)))
+        if mode == 'contains':
+            pattern = _like_contains(unicodedata.normalize('NFC', search_emp_code).strip())
+            query = query.where(or_(by_staff, *[getattr(P, column).ilike(pattern, escape='/') for column in PRODUCTIVITY_STAFF_COLUMNS]))
+        else:
+            query = query.where(by_staff)
+    results = db.session.execute(query.order_by(P.work_date.desc(), P.id.desc())).all()
+
+    total_qty = 0.0
+    daily_dict = {}
+    for r in results:
+        qty = r.quantity if r.quantity is not None else 0.0
+        total_qty += qty
+
+        d_key = r.work_date.strftime('%Y-%m-%d') if r.work_date else 'N/A'
+        d_display = r.work_date.strftime('%d/%m/%Y') if r.work_date else 'N/A'
+        if d_key not in daily_dict:
+            daily_dict[d_key] = {'date': d_display, 'sort_key': d_key, 'total_qty': 0.0, 'count': 0}
+        daily_dict[d_key]['total_qty'] += qty
+        daily_dict[d_key]['count'] += 1
+
+    daily = sorted(daily_dict.values(), key=lambda x: x['sort_key'], reverse=True)
+    employees_more = len(employees) > REPORT_SEARCH_EMPLOYEE_LIMIT
+    employees = [{'employee_code': e.employee_code, 'masl': e.masl or '', 'full_name': e.full_name}
+                 for e in employees[:REPORT_SEARCH_EMPLOYEE_LIMIT]]
+    return {'results': results, 'total_qty': total_qty, 'daily': daily, 'employees': employees, 'employees_more': employees_more}
+
+def get_report_period():
+    """Kỳ báo cáo từ query string; không chọn ngày thì mặc định từ 26 tháng trước đến 25 tháng hiện tại."""
     from_date = request.args.get('from_date')
     to_date = request.args.get('to_date')
-    active_tab = request.args.get('active_tab', 'tab-employee')
-    search_emp_code = request.args.get('search_emp_code', '').strip()
-    search_account_id = request.args.get('search_account_id', '').strip()
-    
-    # Nếu không chọn ngày, mặc định từ 26 tháng trước đến 25 tháng hiện tại
     if not from_date and not to_date:
         today = datetime.now()
         if today.month == 1:
@@ -1374,204 +3306,265 @@ def report():
             
         from_date = f"{prev_year}-{prev_month:02d}-26"
         to_date = f"{today.year}-{today.month:02d}-25"
+    return from_date, to_date
+
+def report_row_to_dict(r):
+    """1 dòng sản lượng (Row theo REPORT_DETAIL_COLUMNS) cho bảng chi tiết / tra cứu trên trang báo cáo."""
+    return {
+        'id': r.id,
+        'work_date': r.work_date.strftime('%d/%m/%Y') if r.work_date else '',
+        'ref_no': r.ref_no,
+        'task_id': r.task_id,
+        'account_id': r.account_id,
+        'customer_id': r.customer_id,
+        'quantity': r.quantity,
+        'unit': r.unit,
+        'tally_id': r.tally_id,
+        'xenang_id': r.xenang_id,
+        'workers': [w for w in (r.congnhan1_id, r.congnhan2_id, r.congnhan3_id, r.congnhan4_id, r.congnhan5_id, r.congnhan6_id) if w],
+    }
+
+def report_employees_data(from_date, to_date):
+    summary = aggregate_productivity(from_date, to_date, ('staff_summary',))['staff_summary']
+    return {'summary': sorted(summary, key=lambda x: x['name'])}
+
+def report_top_employees_data(from_date, to_date, limit=5):
+    summary = aggregate_productivity(from_date, to_date, ('staff_summary',))['staff_summary']
+    return {'top_employees': sorted(summary, key=lambda x: x['total_qty'], reverse=True)[:limit]}
+
+def report_customers_data(from_date, to_date):
+    return {'customer_summary': aggregate_productivity(from_date, to_date, ('customer_summary',))['customer_summary']}
+
+def report_an_chung_data(from_date, to_date):
+    groups = aggregate_productivity(from_date, to_date, ('employee_groups',))['employee_groups']
+    return {'an_chung_summary': [{k: v for k, v in item.items() if k != 'accounts'} for item in groups['an_chung']]}
+
+def report_search_data(from_date, to_date, search_emp_code, search_account_id, search_mode=REPORT_SEARCH_DEFAULT_MODE):
+    if not (search_emp_code or search_account_id):
+        return {'results': [], 'total_qty': 0.0, 'daily': [], 'employees': [], 'employees_more': False, 'searched': False}
+    search = cached_report('search', (from_date, to_date, search_emp_code, search_account_id, search_mode),
+                           lambda: query_report_search(from_date, to_date, search_emp_code, search_account_id, search_mode))
+    return {'results': [report_row_to_dict(r) for r in search['results']], 'total_qty': search['total_qty'],
+            'daily': search['daily'], 'employees': search['employees'], 'employees_more': search['employees_more'], 'searched': True}
+
+def get_report_search_args():
+    """(search_emp_code, search_account_id, search_mode) từ query string; kiểu tra cứu mặc định là contains (chứa chuỗi)."""
+    search_mode = request.args.get('search_mode', REPORT_SEARCH_DEFAULT_MODE)
+    if search_mode not in REPORT_SEARCH_MODES:
+        search_mode = REPORT_SEARCH_DEFAULT_MODE
+    return request.args.get('search_emp_code', '').strip(), request.args.get('search_account_id', '').strip(), search_mode
+
+# --- BẢNG CHI TIẾT BÁO CÁO (phân trang phía server, keyset theo (cột sắp xếp, id)) ---
+REPORT_DETAIL_PAGE_SIZES = (25, 50, 100, 200)
+REPORT_DETAIL_DEFAULT_PAGE_SIZE = 50
+# Cột được phép sắp xếp -> kiểu giá trị trong cursor. Mặc định (work_date, id) giảm dần, đi theo index work_date
+# (index phụ của InnoDB / SQLite đã kèm khóa chính nên không cần index ghép riêng)
+REPORT_DETAIL_SORT_COLUMNS = {'work_date': 'date', 'ref_no': 'str', 'task_id': 'str', 'account_id': 'str',
+                              'customer_id': 'str', 'quantity': 'float', 'unit': 'str'}
+# Bộ lọc theo cột (chứa chuỗi, không phân biệt hoa thường) -> các cột labor_productivity được so khớp
+REPORT_DETAIL_FILTERS = {
+    'ref_no': ('ref_no',), 'task_id': ('task_id',), 'account_id': ('account_id',), 'customer_id': ('customer_id',),
+    'unit': ('unit',), 'tally_id': ('tally_id',), 'xenang_id': ('xenang_id',),
+    'workers': ('congnhan1_id', 'congnhan2_id', 'congnhan3_id', 'congnhan4_id', 'congnhan5_id', 'congnhan6_id'),
+}
 
-    query = LaborProductivity.query
-    
-    if from_date:
-        query = query.filter(LaborProductivity.work_date >= from_date)
-    if to_date:
-        query = query.filter(LaborProductivity.work_date <= to_date)
-        
-    # Lấy dữ liệu chi tiết
-    records = query.order_by(LaborProductivity.work_date.desc()).all()
-    
-    # --- TỔNG HỢP DỮ LIỆU THEO NHÂN VIÊN ---
-    # Dictionary để lưu tổng hợp: { 'Tên NV': {'role': 'Vai trò', 'total_qty': 0.0, 'count': 0} }
-    staff_stats = {}
-    
-    # Lấy cấu hình loại trừ từ DB
-    setting = SystemSetting.query.filter_by(key_name='exclusion_prefixes').first()
-    # Chuyển chuỗi "TB,IF,HB" thành tuple ('TB', 'IF', 'HB') để dùng cho startswith
-    prefixes_str = setting.value if setting else "TB,IF,HB"
-    exclusion_prefixes = tuple(p.strip() for p in prefixes_str.split(',') if p.strip())
+def _like_contains(value):
+    """Mẫu LIKE '%value%' (escape ký tự đặc biệt của LIKE bằng '/')."""
+    return '%' + _like_prefix(value)
+
+def report_detail_sort_expr(sort):
+    column = getattr(LaborProductivity, sort)
+    if sort == 'work_date':
+        return column # Trong kỳ báo cáo work_date luôn có giá trị, giữ nguyên cột để dùng index
+    if REPORT_DETAIL_SORT_COLUMNS[sort] == 'float':
+        # Làm tròn để giá trị trong cursor so sánh bằng được với cột FLOAT (MySQL trả FLOAT dạng text đã làm tròn)
+        return func.round(func.coalesce(column, 0.0), 4)
+    return func.coalesce(column, '')
+
+def encode_report_cursor(row, sort):
+    """Cursor từ giá trị sort_key do DB trả về (đúng biểu thức dùng để so sánh) và id của dòng."""
+    value = row.sort_key
+    if REPORT_DETAIL_SORT_COLUMNS[sort] == 'date':
+        value = value.isoformat()
+    return json.dumps([value, row.id])
+
+def decode_report_cursor(cursor, sort):
+    """Cursor '[giá trị cột sắp xếp, id]' -> (value, id); sai định dạng thì trả về None (coi như trang đầu)."""
+    try:
+        value, row_id = json.loads(cursor)
+        kind = REPORT_DETAIL_SORT_COLUMNS[sort]
+        if kind == 'date':
+            value = date.fromisoformat(value)
+        elif kind == 'float':
+            value = float(value)
+        else:
+            value = str(value)
+        return value, int(row_id)
+    except (TypeError, ValueError):
+        return None
+
+def get_report_detail_args():
+    """Tham số bảng chi tiết từ query string: draw, length, sort, dir, after/before (cursor), filter_<cột>."""
+    sort = request.args.get('sort', 'work_date')
+    if sort not in REPORT_DETAIL_SORT_COLUMNS:
+        sort = 'work_date'
+    length = request.args.get('length', REPORT_DETAIL_DEFAULT_PAGE_SIZE, type=int)
+    if length not in REPORT_DETAIL_PAGE_SIZES:
+        length = REPORT_DETAIL_DEFAULT_PAGE_SIZE
+    filters = {}
+    for key in REPORT_DETAIL_FILTERS:
+        value = request.args.get(f'filter_{key}', '').strip()
+        if value:
+            filters[key] = value
+    return {
+        'draw': request.args.get('draw', 0, type=int),
+        'length': length,
+        'sort': sort,
+        'dir': 'asc' if request.args.get('dir') == 'asc' else 'desc',
+        'after': request.args.get('after') or None,
+        'before': request.args.get('before') or None,
+        'filters': filters,
+    }
+
+def count_report_detail_rows(from_date, to_date, filters):
+    """Số dòng trong kỳ (lấy từ bảng tổng hợp theo ngày) và số dòng sau khi lọc (COUNT trong DB, có cache)."""
+    def compute():
+        ensure_rollups_ready(from_date, to_date)
+        DT = ProductivityDailyTotal
+        total = db.session.query(func.coalesce(func.sum(DT.row_count), 0)) \
+            .filter(*_date_range_conditions(DT.work_date, from_date, to_date)).scalar()
+        filtered = total
+        if filters:
+            filtered = db.session.query(func.count(LaborProductivity.id)) \
+                .filter(*report_detail_conditions(from_date, to_date, filters)).scalar()
+        return {'total': int(total or 0), 'filtered': int(filtered or 0)}
+    return cached_report('detail_count', (from_date, to_date, tuple(sorted(filters.items()))), compute)
+
+def report_detail_conditions(from_date, to_date, filters):
+    P = LaborProductivity
+    conditions = _date_range_conditions(P.work_date, from_date, to_date)
+    for key, value in filters.items():
+        pattern = _like_contains(value)
+        conditions.append(or_(*[getattr(P, column).ilike(pattern, escape='/') for column in REPORT_DETAIL_FILTERS[key]]))
+    return conditions
+
+def report_detail_page(from_date, to_date, args):
+    """
+    1 trang bảng chi tiết theo kiểu DataTables server-side: lọc, sắp xếp và phân trang keyset (cột sắp xếp, id) trong DB,
+    nên mỗi trang chỉ đọc length + 1 dòng dù kỳ dài bao nhiêu. Trả về draw, recordsTotal, recordsFiltered, data,
+    next / prev (cursor trang sau / trang trước, None nếu không còn).
+    """
+    P = LaborProductivity
+    sort, length = args['sort'], args['length']
+    sort_expr = report_detail_sort_expr(sort)
+    descending = args['dir'] == 'desc'
+    query = select(*[getattr(P, c) for c in REPORT_DETAIL_COLUMNS], sort_expr.label('sort_key')) \
+        .where(*report_detail_conditions(from_date, to_date, args['filters']))
+
+    after = decode_report_cursor(args['after'], sort) if args['after'] else None
+    before = decode_report_cursor(args['before'], sort) if args['before'] and not after else None
+    # Trang trước: đi ngược thứ tự từ cursor rồi đảo lại kết quả
+    backward = before is not None
+    forward_desc = descending != backward
+    cursor = before or after
+    if cursor:
+        value, row_id = cursor
+        if forward_desc:
+            query = query.where(or_(sort_expr < value, and_(sort_expr == value, P.id < row_id)))
+        else:
+            query = query.where(or_(sort_expr > value, and_(sort_expr == value, P.id > row_id)))
+    if forward_desc:
+        query = query.order_by(sort_expr.desc(), P.id.desc())
+    else:
+        query = query.order_by(sort_expr.asc(), P.id.asc())
+
+    rows = db.session.execute(query.limit(length + 1)).all()
+    has_more = len(rows) > length
+    rows = rows[:length]
+    if backward:
+        rows.reverse()
+    has_next = (not backward and has_more) or backward
+    has_prev = (backward and has_more) or (not backward and after is not None)
+
+    counts = count_report_detail_rows(from_date, to_date, args['filters'])
+    return {
+        'draw': args['draw'],
+        'recordsTotal': counts['total'],
+        'recordsFiltered': counts['filtered'],
+        'data': [report_row_to_dict(r) for r in rows],
+        'next': encode_report_cursor(rows[-1], sort) if rows and has_next else None,
+        'prev': encode_report_cursor(rows[0], sort) if rows and has_prev else None,
+    }
+
+# Dữ liệu từng tab trang báo cáo (tab đang mở nhúng sẵn vào trang, các tab khác tải qua API khi bấm vào)
+REPORT_TAB_LOADERS = {
+    'tab-employee': lambda from_date, to_date: {**report_employees_data(from_date, to_date), **report_top_employees_data(from_date, to_date)},
+    'tab-customer': report_customers_data,
+    'tab-anchung': report_an_chung_data,
+    'tab-detail': lambda from_date, to_date: report_detail_page(from_date, to_date, get_report_detail_args()),
+    'tab-search': lambda from_date, to_date: report_search_data(from_date, to_date, *get_report_search_args()),
+}
 
-    # Lấy danh sách mã nhân viên hợp lệ từ bảng Employee để kiểm tra
-    valid_codes = set(r[0] for r in db.session.query(Employee.masl).filter(Employee.masl != None, Employee.masl != "").all())
+@app.route('/report', methods=['GET', 'POST'])
+@login_required
+@view_required
+def report():
+    from_date, to_date = get_report_period()
+    active_tab = request.args.get('active_tab', 'tab-employee')
+    if active_tab not in REPORT_TAB_LOADERS:
+        active_tab = 'tab-employee'
+    search_emp_code, search_account_id, search_mode = get_report_search_args()
+
+    # Chỉ tính dữ liệu của tab đang mở, các tab khác tải qua /report/api/... khi người dùng bấm vào
+    initial_data = REPORT_TAB_LOADERS[active_tab](from_date, to_date)
+    return render_template('report.html', from_date=from_date, to_date=to_date, active_tab=active_tab, initial_data=initial_data,
+                           search_emp_code=search_emp_code, search_account_id=search_account_id, search_mode=search_mode)
+
+@app.errorhandler(RollupNotReadyError)
+def handle_rollup_not_ready(e):
+    """Báo cáo đọc bảng tổng hợp chưa dựng: báo lỗi rõ ràng (JSON cho các tab tải qua API) thay vì hiển thị số 0."""
+    print(f"Lỗi báo cáo: {e}")
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({'error': str(e)}), 503
+    flash(str(e), 'danger')
+    return redirect(url_for('index'))
+
+@app.route('/report/api/employees')
+@login_required
+@view_required
+def report_api_employees():
+    return jsonify(report_employees_data(*get_report_period()))
 
-    def add_stat(name, role, qty):
-        if not name: return
-        
-        # Bỏ qua các mã bắt đầu bằng prefix cấu hình
-        if str(name).upper().startswith(exclusion_prefixes):
-            return
-            
-        # Tạo key duy nhất là (Tên, Vai trò) để phân biệt nếu 1 người làm nhiều vai trò
-        key = (name, role)
-        if key not in staff_stats:
-            # Kiểm tra xem mã nhân viên có trong danh sách không
-            is_valid = name in valid_codes
-            remark = "" if is_valid else "Không có trong danh sách"
-            
-            staff_stats[key] = {'name': name, 'role': role, 'total_qty': 0.0, 'count': 0, 'remark': remark}
-        
-        staff_stats[key]['total_qty'] += (qty or 0.0)
-        staff_stats[key]['count'] += 1
+@app.route('/report/api/top-employees')
+@login_required
+@view_required
+def report_api_top_employees():
+    limit = min(max(request.args.get('limit', 5, type=int), 1), 50)
+    return jsonify(report_top_employees_data(*get_report_period(), limit=limit))
 
-    for r in records:
-        qty = r.quantity if r.quantity is not None else 0.0
-        
-        # Cộng dồn cho từng vị trí
-        add_stat(r.tally_id, 'Tally', qty)
-        add_stat(r.xenang_id, 'Xe nâng', qty)
-        add_stat(r.congnhan1_id, 'Công nhân', qty)
-        add_stat(r.congnhan2_id, 'Công nhân', qty)
-        add_stat(r.congnhan3_id, 'Công nhân', qty)
-        add_stat(r.congnhan4_id, 'Công nhân', qty)
-        add_stat(r.congnhan5_id, 'Công nhân', qty)
-        add_stat(r.congnhan6_id, 'Công nhân', qty)
-    
-    # Chuyển đổi sang list để hiển thị và sắp xếp
-    summary = list(staff_stats.values())
-    
-    # Lấy Top 5 nhân viên có năng suất cao nhất cho biểu đồ
-    top_employees = sorted(summary, key=lambda x: x['total_qty'], reverse=True)[:5]
-    
-    # Sắp xếp danh sách hiển thị bảng theo tên (A-Z)
-    summary.sort(key=lambda x: x['name'])
-    
-    # --- TỔNG HỢP THEO KHÁCH HÀNG ---
-    customer_stats = {}
-    for r in records:
-        qty = r.quantity if r.quantity is not None else 0.0
-        c_name = r.customer_id if r.customer_id else "Khác"
-        
-        if c_name not in customer_stats:
-            customer_stats[c_name] = {'name': c_name, 'total_qty': 0.0, 'count': 0}
-        customer_stats[c_name]['total_qty'] += qty
-        customer_stats[c_name]['count'] += 1
-        
-    customer_summary = list(customer_stats.values())
-    customer_summary.sort(key=lambda x: x['total_qty'], reverse=True)
-    
-    # --- TỔNG HỢP CHO NHÂN VIÊN AN_CHUNG ---
-    an_chung_data = []
-    an_chung_emps = Employee.query.filter_by(employee_type='An_chung').all()
-    
-    # Hàm chuẩn hóa chuỗi để so sánh chính xác hơn
-    def normalize_key(s):
-        if not s: return None
-        return unicodedata.normalize('NFC', str(s)).strip().lower()
-
-    # Map để tra cứu nhanh: key -> Employee Object
-    ac_map = {}
-    # Map để tổng hợp số liệu (bao gồm cả nhân viên chưa có sản lượng)
-    summary_map = {}
-
-    for emp in an_chung_emps:
-        if emp.masl: ac_map[normalize_key(emp.masl)] = emp
-        if emp.employee_code: ac_map[normalize_key(emp.employee_code)] = emp
-        if emp.full_name: ac_map[normalize_key(emp.full_name)] = emp
-        
-        # Khởi tạo dữ liệu tổng hợp cho TẤT CẢ nhân viên An Chung
-        summary_map[emp.employee_code] = {
-            'employee_code': emp.employee_code,
-            'masl': emp.masl,
-            'full_name': emp.full_name,
-            'position': emp.position,
-            'total_productivity': 0.0,
-            'total_quantity': 0.0,
-            'count': 0
-        }
-
-    for r in records:
-        workers = [
-            r.tally_id, r.xenang_id, 
-            r.congnhan1_id, r.congnhan2_id, r.congnhan3_id, 
-            r.congnhan4_id, r.congnhan5_id, r.congnhan6_id
-        ]
-        seen_in_row = set()
-        for w_str in workers:
-            if not w_str: continue
-            w_key = normalize_key(w_str)
-            if w_key in ac_map:
-                emp = ac_map[w_key]
-                if emp.id in seen_in_row: continue
-                seen_in_row.add(emp.id)
-                
-                an_chung_data.append({
-                    'work_date': r.work_date,
-                    'employee_code': emp.employee_code,
-                    'masl': emp.masl,
-                    'full_name': emp.full_name,
-                    'position': emp.position,
-                    'task_id': r.task_id,
-                    'productivity_value': r.productivity_value,
-                    'conversion_index': r.conversion_index,
-                    'quantity': r.quantity
-                })
-
-    # Cập nhật số liệu từ dữ liệu chi tiết vào bảng tổng hợp
-    for item in an_chung_data:
-        code = item['employee_code']
-        if code in summary_map:
-            
-            p_val = item['productivity_value'] if item['productivity_value'] is not None else 0.0
-            q_val = item['quantity'] if item['quantity'] is not None else 0.0
-            
-            summary_map[code]['total_productivity'] += p_val
-            summary_map[code]['total_quantity'] += q_val
-            summary_map[code]['count'] += 1
-        
-    an_chung_summary_list = list(summary_map.values())
-    an_chung_summary_list.sort(key=lambda x: x['full_name'])
-
-    # --- TỔNG HỢP CHO TAB SEARCH (TRA CỨU CHUYÊN SÂU) ---
-    search_results = []
-    total_search_qty = 0.0
-    daily_search_summary = []
-    if search_emp_code or search_account_id:
-        search_query = LaborProductivity.query
-        
-        if from_date:
-            search_query = search_query.filter(LaborProductivity.work_date >= from_date)
-        if to_date:
-            search_query = search_query.filter(LaborProductivity.work_date <= to_date)
-            
-        if search_account_id:
-            search_query = search_query.filter(LaborProductivity.account_id == search_account_id)
-            
-        if search_emp_code:
-            search_query = search_query.filter(
-                or_(
-                    LaborProductivity.tally_id.ilike(f'%{search_emp_code}%'),
-                    LaborProductivity.xenang_id.ilike(f'%{search_emp_code}%'),
-                    LaborProductivity.congnhan1_id.ilike(f'%{search_emp_code}%'),
-                    LaborProductivity.congnhan2_id.ilike(f'%{search_emp_code}%'),
-                    LaborProductivity.congnhan3_id.ilike(f'%{search_emp_code}%'),
-                    LaborProductivity.congnhan4_id.ilike(f'%{search_emp_code}%'),
-                    LaborProductivity.congnhan5_id.ilike(f'%{search_emp_code}%'),
-                    LaborProductivity.congnhan6_id.ilike(f'%{search_emp_code}%')
-                )
-            )
-            
-        search_results = search_query.order_by(LaborProductivity.work_date.desc()).all()
-        
-        daily_dict = {}
-        for r in search_results:
-            qty = r.quantity if r.quantity is not None else 0.0
-            total_search_qty += qty
-            
-            d_key = r.work_date.strftime('%Y-%m-%d') if r.work_date else 'N/A'
-            d_display = r.work_date.strftime('%d/%m/%Y') if r.work_date else 'N/A'
-            if d_key not in daily_dict:
-                daily_dict[d_key] = {'date': d_display, 'sort_key': d_key, 'total_qty': 0.0, 'count': 0}
-            daily_dict[d_key]['total_qty'] += qty
-            daily_dict[d_key]['count'] += 1
-            
-        daily_search_summary = list(daily_dict.values())
-        daily_search_summary.sort(key=lambda x: x['sort_key'], reverse=True)
+@app.route('/report/api/customers')
+@login_required
+@view_required
+def report_api_customers():
+    return jsonify(report_customers_data(*get_report_period()))
 
-    return render_template('report.html', records=records, summary=summary, top_employees=top_employees, customer_summary=customer_summary, an_chung_data=an_chung_data, an_chung_summary_list=an_chung_summary_list, from_date=from_date, to_date=to_date, active_tab=active_tab, search_emp_code=search_emp_code, search_account_id=search_account_id, search_results=search_results, total_search_qty=total_search_qty, daily_search_summary=daily_search_summary)
+@app.route('/report/api/an-chung')
+@login_required
+@view_required
+def report_api_an_chung():
+    return jsonify(report_an_chung_data(*get_report_period()))
+
+@app.route('/report/api/detail')
+@login_required
+@view_required
+def report_api_detail():
+    return jsonify(report_detail_page(*get_report_period(), get_report_detail_args()))
+
+@app.route('/report/api/search')
+@login_required
+@view_required
+def report_api_search():
+    return jsonify(report_search_data(*get_report_period(), *get_report_search_args()))
 
 @app.route('/report/export')
 @login_required
@@ -1584,170 +3577,10 @@ def export_report():
     from_date = request.args.get('from_date')
     to_date = request.args.get('to_date')
 
-    query = LaborProductivity.query
-    if from_date:
-        query = query.filter(LaborProductivity.work_date >= from_date)
-    if to_date:
-        query = query.filter(LaborProductivity.work_date <= to_date)
-
-    records = query.order_by(LaborProductivity.work_date.desc()).all()
-
-    def normalize_key(s):
-        if not s:
-            return None
-        return unicodedata.normalize('NFC', str(s)).strip().lower()
-
-    palette = [
-        'FF00B050', 'FF00B0F0', 'FF70AD47', 'FF92D050',
-        'FFFFC000', 'FFED7D31', 'FFC00000', 'FF7030A0'
-    ]
-
-    # Lấy index mới nhất theo account_id (ưu tiên effective_from mới nhất, sau đó id mới nhất)
-    latest_index_by_account = {}
-    idx_rows = AccountConversionIndex.query.order_by(
-        AccountConversionIndex.account_id.asc(),
-        AccountConversionIndex.effective_from.desc(),
-        AccountConversionIndex.id.desc(),
-    ).all()
-    for idx in idx_rows:
-        if idx.account_id not in latest_index_by_account:
-            latest_index_by_account[idx.account_id] = float(idx.conversion_index or 1.0)
-
-    account_configs = []
-    seen_account_names = set()
-    if latest_index_by_account:
-        accounts = CustomerAccount.query.filter(
-            CustomerAccount.id.in_(latest_index_by_account.keys())
-        ).order_by(CustomerAccount.account_name.asc()).all()
-
-        for i, acc in enumerate(accounts):
-            account_name = (acc.account_name or '').strip()
-            if not account_name:
-                continue
-            name_key = normalize_key(account_name)
-            if name_key in seen_account_names:
-                continue
-            seen_account_names.add(name_key)
-            account_configs.append({
-                'title': account_name,
-                'coef': latest_index_by_account.get(acc.id, 1.0),
-                'color': palette[i % len(palette)],
-            })
-
-    def is_an_chung(employee_type):
-        t = normalize_key(employee_type) or ''
-        return t in ('an_chung', 'an chung')
-
-    all_emps = Employee.query.all()
-    an_chung_emps = [e for e in all_emps if is_an_chung(e.employee_type)]
-    khoan_emps = [e for e in all_emps if not is_an_chung(e.employee_type)]
-
-    def build_maps(employees):
-        worker_map = {}
-        summary_map = {}
-        for emp in employees:
-            if emp.masl:
-                worker_map[normalize_key(emp.masl)] = emp
-            if emp.employee_code:
-                worker_map[normalize_key(emp.employee_code)] = emp
-            if emp.full_name:
-                worker_map[normalize_key(emp.full_name)] = emp
-
-            row_key = emp.employee_code or f"EMP_{emp.id}"
-            summary_map[row_key] = {
-                'employee_code': emp.employee_code or '',
-                'masl': emp.masl or '',
-                'full_name': emp.full_name or '',
-                'position': emp.position or '',
-                'total_raw': 0.0,
-                'total_converted': 0.0,
-            }
-            for cfg in account_configs:
-                summary_map[row_key][cfg['title']] = 0.0
-        return worker_map, summary_map
-
-    khoan_map, khoan_summary_map = build_maps(khoan_emps)
-    ac_map, an_chung_summary_map = build_maps(an_chung_emps)
-
-    an_chung_detail_data = []
-    khoan_detail_data = []
-    for r in records:
-        workers = [
-            r.tally_id,
-            r.xenang_id,
-            r.congnhan1_id,
-            r.congnhan2_id,
-            r.congnhan3_id,
-            r.congnhan4_id,
-            r.congnhan5_id,
-            r.congnhan6_id,
-        ]
-
-        raw_cbm = float(r.productivity_value or 0.0)
-        converted_cbm = float(r.quantity or 0.0)
-        matched_account = None
-        record_account_key = normalize_key(r.account_id)
-        if record_account_key:
-            for cfg in account_configs:
-                if normalize_key(cfg['title']) == record_account_key:
-                    matched_account = cfg['title']
-                    break
-
-        seen_in_row = set()
-        for worker in workers:
-            worker_key = normalize_key(worker)
-            if not worker_key:
-                continue
-
-            group = None
-            emp = None
-            summary_map = None
-            if worker_key in khoan_map:
-                group = 'khoan'
-                emp = khoan_map[worker_key]
-                summary_map = khoan_summary_map
-            elif worker_key in ac_map:
-                group = 'an_chung'
-                emp = ac_map[worker_key]
-                summary_map = an_chung_summary_map
-            else:
-                continue
-
-            if emp.id in seen_in_row:
-                continue
-            seen_in_row.add(emp.id)
-
-            row_key = emp.employee_code or f"EMP_{emp.id}"
-            if row_key not in summary_map:
-                continue
-
-            summary_map[row_key]['total_raw'] += raw_cbm
-            summary_map[row_key]['total_converted'] += converted_cbm
-            if matched_account:
-                summary_map[row_key][matched_account] += raw_cbm
-
-            detail_item = {
-                'Ngày': r.work_date,
-                'Mã NV': emp.employee_code,
-                'MS': emp.masl,
-                'Họ và tên': emp.full_name,
-                'Vị trí': emp.position,
-                'Task': r.task_id,
-                'Account': r.account_id,
-                'Khách hàng': r.customer_id,
-                'CBM chưa hệ số': raw_cbm,
-                'CBM có hệ số': converted_cbm,
-            }
-
-            if group == 'an_chung':
-                an_chung_detail_data.append(detail_item)
-            elif group == 'khoan':
-                khoan_detail_data.append(detail_item)
-
-    summary_rows_khoan = list(khoan_summary_map.values())
-    summary_rows_khoan.sort(key=lambda x: (x['full_name'] or '').lower())
-    summary_rows_an_chung = list(an_chung_summary_map.values())
-    summary_rows_an_chung.sort(key=lambda x: (x['full_name'] or '').lower())
+    aggregated = aggregate_productivity(from_date, to_date, ('account_columns', 'employee_groups', 'detail_rows', 'employee_detail'))
+    account_configs = aggregated['account_columns']
+    summary_rows_khoan = aggregated['employee_groups']['khoan']
+    summary_rows_an_chung = aggregated['employee_groups']['an_chung']
 
     def make_summary_df(summary_rows):
         return pd.DataFrame([
@@ -1759,7 +3592,7 @@ def export_report():
                 'HỌ VÀ TÊN': item['full_name'],
                 'Tổng CBM CÓ HỆ SỐ': item['total_converted'],
                 'Tổng CBM CHƯA HỆ SỐ': item['total_raw'],
-                **{cfg['title']: item[cfg['title']] for cfg in account_configs},
+                **{cfg['title']: item['accounts'].get(cfg['title'], 0.0) for cfg in account_configs},
             }
             for idx, item in enumerate(summary_rows, 1)
         ])
@@ -1767,8 +3600,25 @@ def export_report():
     df_summary_template_khoan = make_summary_df(summary_rows_khoan)
     df_summary_template_an_chung = make_summary_df(summary_rows_an_chung)
 
+    def make_employee_detail_df(items):
+        return pd.DataFrame([
+            {
+                'Ngày': r.work_date,
+                'Mã NV': emp.employee_code,
+                'MS': emp.masl,
+                'Họ và tên': emp.full_name,
+                'Vị trí': emp.position,
+                'Task': r.task_id,
+                'Account': r.account_id,
+                'Khách hàng': r.customer_id,
+                'CBM chưa hệ số': float(r.productivity_value or 0.0),
+                'CBM có hệ số': float(r.quantity or 0.0),
+            }
+            for r, emp in items
+        ])
+
     detail_data = []
-    for idx, r in enumerate(records, 1):
+    for idx, r in enumerate(aggregated['detail_rows'], 1):
         workers = [r.congnhan1_id, r.congnhan2_id, r.congnhan3_id, r.congnhan4_id, r.congnhan5_id, r.congnhan6_id]
         has_worker = any(w for w in workers if w)
         cbm_val = r.productivity_value if has_worker else ''
@@ -1793,8 +3643,8 @@ def export_report():
         })
 
     df_detail = pd.DataFrame(detail_data)
-    df_anchung = pd.DataFrame(an_chung_detail_data)
-    df_khoan_chitiet = pd.DataFrame(khoan_detail_data)
+    df_anchung = make_employee_detail_df(aggregated['employee_detail']['an_chung'])
+    df_khoan_chitiet = make_employee_detail_df(aggregated['employee_detail']['khoan'])
 
     output = io.BytesIO()
     with pd.ExcelWriter(output, engine='openpyxl') as writer:
@@ -1854,7 +3704,7 @@ def export_report():
                 ws.cell(row=row_no, column=7, value=row_data['total_raw'] if row_data else 0)
 
                 for j, cfg in enumerate(account_configs, start=8):
-                    ws.cell(row=row_no, column=j, value=(row_data[cfg['title']] if row_data else 0))
+                    ws.cell(row=row_no, column=j, value=(row_data['accounts'].get(cfg['title'], 0.0) if row_data else 0))
 
                 for c in range(1, total_data_cols + 1):
                     cell = ws.cell(row=row_no, column=c)
@@ -1928,79 +3778,33 @@ def export_anchung():
         
     from_date = request.args.get('from_date')
     to_date = request.args.get('to_date')
-    
-    query = LaborProductivity.query
-    if from_date: query = query.filter(LaborProductivity.work_date >= from_date)
-    if to_date: query = query.filter(LaborProductivity.work_date <= to_date)
-    
-    records = query.order_by(LaborProductivity.work_date.desc()).all()
-    
-    an_chung_data = []
-    an_chung_emps = Employee.query.filter_by(employee_type='An_chung').all()
-    
-    def normalize_key(s):
-        if not s: return None
-        return unicodedata.normalize('NFC', str(s)).strip().lower()
-
-    ac_map = {}
-    summary_map = {} # Map tổng hợp cho Excel
-
-    for emp in an_chung_emps:
-        if emp.masl: ac_map[normalize_key(emp.masl)] = emp
-        if emp.employee_code: ac_map[normalize_key(emp.employee_code)] = emp
-        if emp.full_name: ac_map[normalize_key(emp.full_name)] = emp
-        
-        # Khởi tạo dòng cho Excel
-        summary_map[emp.employee_code] = {
-            'Mã NV': emp.employee_code,
-            'Mã SL': emp.masl,
-            'Họ và tên': emp.full_name,
-            'Vị trí': emp.position,
-            'Số lượt tham gia': 0,
-            'Số CBM chưa quy đổi': 0.0,
-            'Số cbm đã quy đổi': 0.0
-        }
-        
-    for r in records:
-        workers = [
-            r.tally_id, r.xenang_id, 
-            r.congnhan1_id, r.congnhan2_id, r.congnhan3_id, 
-            r.congnhan4_id, r.congnhan5_id, r.congnhan6_id
-        ]
-        seen_in_row = set()
-        for w_str in workers:
-            if not w_str: continue
-            w_key = normalize_key(w_str)
-            if w_key in ac_map:
-                emp = ac_map[w_key]
-                if emp.id in seen_in_row: continue
-                seen_in_row.add(emp.id)
-                
-                an_chung_data.append({
-                    'Ngày': r.work_date,
-                    'Mã NV': emp.employee_code,
-                    'Mã SL': emp.masl,
-                    'Họ và tên': emp.full_name,
-                    'Vị trí': emp.position,
-                    'Task': r.task_id,
-                    'Số CBM chưa quy đổi': r.productivity_value,
-                    'Chỉ số quy đổi': r.conversion_index,
-                    'Số cbm đã quy đổi': r.quantity
-                })
-                
-                # Cộng dồn vào summary_map
-                code = emp.employee_code
-                if code in summary_map:
-                    summary_map[code]['Số lượt tham gia'] += 1
-                    summary_map[code]['Số CBM chưa quy đổi'] += (r.productivity_value or 0.0)
-                    summary_map[code]['Số cbm đã quy đổi'] += (r.quantity or 0.0)
 
+    aggregated = aggregate_productivity(from_date, to_date, ('employee_groups', 'employee_detail'))
+
+    an_chung_data = [{
+        'Ngày': r.work_date,
+        'Mã NV': emp.employee_code,
+        'Mã SL': emp.masl,
+        'Họ và tên': emp.full_name,
+        'Vị trí': emp.position,
+        'Task': r.task_id,
+        'Số CBM chưa quy đổi': r.productivity_value,
+        'Chỉ số quy đổi': r.conversion_index,
+        'Số cbm đã quy đổi': r.quantity
+    } for r, emp in aggregated['employee_detail']['an_chung']]
     df_anchung = pd.DataFrame(an_chung_data)
     
-    # Tạo DataFrame tổng hợp từ summary_map (đầy đủ nhân viên)
-    summary_list = list(summary_map.values())
-    summary_list.sort(key=lambda x: x['Họ và tên'])
-    df_summary = pd.DataFrame(summary_list)
+    # Tổng hợp đầy đủ nhân viên ăn chung (kể cả chưa có sản lượng), đã sắp theo tên
+    df_summary = pd.DataFrame([{
+        'Mã NV': item['employee_code'],
+        'Mã SL': item['masl'],
+        'Họ và tên': item['full_name'],
+        'Vị trí': item['position'],
+        'Số lượt tham gia': item['count'],
+        'Số CBM chưa quy đổi': item['total_raw'],
+        'Số cbm đã quy đổi': item['total_converted']
+    } for item in aggregated['employee_groups']['an_chung']],
+        columns=['Mã NV', 'Mã SL', 'Họ và tên', 'Vị trí', 'Số lượt tham gia', 'Số CBM chưa quy đổi', 'Số cbm đã quy đổi'])
     
     output = io.BytesIO()
     
@@ -2133,6 +3937,359 @@ def download_template():
 def import_data_view():
     return redirect(url_for('import_data'))
 
+def allow_null_columns(table, columns):
+    """Bỏ NOT NULL của các cột trên bảng đã có. SQLite không sửa được cột nên tạo lại bảng theo model rồi chép dữ liệu."""
+    dialect = db.engine.dialect.name
+    with db.engine.begin() as conn:
+        if dialect == 'sqlite':
+            old_name = f'{table.name}_old'
+            old_indexes = [i['name'] for i in sa_inspect(conn).get_indexes(table.name)]
+            conn.execute(text(f"ALTER TABLE {table.name} RENAME TO {old_name}"))
+            for name in old_indexes:
+                conn.execute(text(f"DROP INDEX {name}"))
+            table.create(conn)
+            names = ', '.join(c.name for c in table.columns)
+            conn.execute(text(f"INSERT INTO {table.name} ({names}) SELECT {names} FROM {old_name}"))
+            conn.execute(text(f"DROP TABLE {old_name}"))
+            return
+        for column in columns:
+            if dialect == 'mysql':
+                col_type = column.type.compile(dialect=db.engine.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} MODIFY COLUMN {column.name} {col_type} NULL"))
+            else:
+                conn.execute(text(f"ALTER TABLE {table.name} ALTER COLUMN {column.name} DROP NOT NULL"))
+
+@app.cli.command("upgrade-db")
+@click.option('--skip-backfill', is_flag=True, help='Không ghi staff / dựng bảng tổng hợp cho dữ liệu cũ (chạy sau bằng backfill-staff).')
+def upgrade_db(skip_backfill):
+    """
+    Tạo bảng mới và bổ sung cột/index còn thiếu cho các bảng đã có (không xóa dữ liệu).
+    Có dữ liệu sản lượng mà bảng staff / tổng hợp còn trống thì chạy luôn backfill-staff (gồm dựng lại bảng tổng hợp).
+    """
+    db.create_all()
+    inspector = sa_inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            existing_cols = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_cols:
+                    continue
+                col_type = column.type.compile(dialect=db.engine.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}"))
+                print(f"  -> Đã thêm cột: {table.name}.{column.name}")
+    # Cột đã đổi sang cho phép NULL (VD: import_jobs.batch_id cho job STAFF)
+    inspector = sa_inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        not_null = {c['name'] for c in inspector.get_columns(table.name) if not c['nullable']}
+        columns = [c for c in table.columns if c.nullable and not c.primary_key and c.name in not_null]
+        if columns:
+            allow_null_columns(table, columns)
+            print(f"  -> Đã cho phép NULL: {', '.join(f'{table.name}.{c.name}' for c in columns)}")
+    with db.engine.begin() as conn:
+        conn.execute(ImportJob.__table__.update().where(ImportJob.__table__.c.kind == 'STAFF', ImportJob.__table__.c.batch_id == 0)
+                     .values(batch_id=None))
+    inspector = sa_inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing_idx = {i['name'] for i in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_idx:
+                index.create(db.engine)
+                print(f"  -> Đã tạo index: {index.name}")
+    # DB cũ nâng cấp lên: bảng staff / tổng hợp vừa tạo còn trống thì báo cáo sẽ ra 0, nên dựng luôn
+    if db.session.query(LaborProductivity.id).first() is not None:
+        if db.session.query(LaborProductivityStaff.id).first() is None or db.session.query(ProductivityDailyTotal.id).first() is None:
+            if skip_backfill:
+                print('  -> Bảng staff / tổng hợp còn trống: chạy "flask backfill-staff" trước khi dùng báo cáo.')
+            else:
+                print("Đang ghi labor_productivity_staff cho dữ liệu cũ...")
+                backfill_productivity_staff()
+                return
+    print("Hoàn tất!")
+
+@app.cli.command("backfill-fingerprints")
+def backfill_fingerprints():
+    """Tính row_fingerprint cho dữ liệu cũ; dòng trùng với dòng đã có fingerprint thì để NULL (báo số lượng để xử lý tay)."""
+    duplicates = 0
+    filled = 0
+    last_id = 0
+    while True:
+        records = LaborProductivity.query.filter(LaborProductivity.row_fingerprint.is_(None), LaborProductivity.id > last_id) \
+            .order_by(LaborProductivity.id).limit(IMPORT_CHUNK_SIZE).all()
+        if not records:
+            break
+        last_id = records[-1].id
+        fingerprints = {r.id: fingerprint_of_productivity(r) for r in records}
+        taken = {fp for (fp,) in db.session.query(LaborProductivity.row_fingerprint)
+                 .filter(LaborProductivity.row_fingerprint.in_(set(fingerprints.values())))}
+        for r in records:
+            fp = fingerprints[r.id]
+            if fp in taken:
+                duplicates += 1
+                continue
+            r.row_fingerprint = fp
+            taken.add(fp)
+            filled += 1
+        db.session.commit()
+        print(f"  -> Đã xử lý đến id {last_id}: {filled} dòng có fingerprint, {duplicates} dòng trùng")
+    print(f"Hoàn tất! {filled} dòng đã có fingerprint, {duplicates} dòng trùng (để NULL).")
+
+def backfill_productivity_staff(rebuild=False):
+    """Ghi labor_productivity_staff (rebuild=False: chỉ dòng chưa có staff) rồi dựng lại bảng tổng hợp, commit từng chunk."""
+    condition = LaborProductivity.id.isnot(None)
+    if not rebuild:
+        has_staff = select(LaborProductivityStaff.id).where(LaborProductivityStaff.productivity_id == LaborProductivity.id).exists()
+        condition = not_(has_staff)
+    processed, written = write_productivity_staff(
+        condition, commit_each_chunk=True,
+        progress=lambda done, staff: print(f"  -> Đã xử lý {done} dòng sản lượng, {staff} dòng staff"))
+    print(f"Hoàn tất! {processed} dòng sản lượng, {written} dòng labor_productivity_staff.")
+    print("Đang dựng lại bảng tổng hợp theo ngày...")
+    rebuild_productivity_rollups(commit_each_chunk=True)
+    bump_data_version()
+    db.session.commit()
+    print("Hoàn tất!")
+
+@app.cli.command("backfill-staff")
+@click.option('--rebuild', is_flag=True, help='Ghi lại cho toàn bộ dữ liệu (khi danh mục nhân viên thay đổi).')
+def backfill_staff(rebuild):
+    """Ghi labor_productivity_staff cho dữ liệu sản lượng cũ (mặc định chỉ các dòng chưa có dòng staff nào)."""
+    backfill_productivity_staff(rebuild)
+
+@app.cli.command("rebuild-rollups")
+@click.option('--from-date', default=None, help='Từ ngày (YYYY-MM-DD), mặc định ngày đầu tiên có dữ liệu.')
+@click.option('--to-date', default=None, help='Đến ngày (YYYY-MM-DD), mặc định ngày cuối cùng có dữ liệu.')
+def rebuild_rollups(from_date, to_date):
+    """Dựng lại bảng tổng hợp theo ngày (productivity_daily_totals, productivity_daily_staff) từ dữ liệu chi tiết."""
+    from_date = datetime.strptime(from_date, '%Y-%m-%d').date() if from_date else None
+    to_date = datetime.strptime(to_date, '%Y-%m-%d').date() if to_date else None
+    t0 = time.perf_counter()
+    days = rebuild_productivity_rollups(from_date, to_date, commit_each_chunk=True,
+                                        progress=lambda start, end: print(f"  -> Đã dựng lại {start} -> {end}"))
+    bump_data_version()
+    db.session.commit()
+    print(f"Hoàn tất! {days} ngày, {time.perf_counter() - t0:.1f}s.")
+
+# --- DỮ LIỆU TỔNG HỢP CHO KIỂM THỬ TẢI (flask seed-synthetic) ---
+SYNTHETIC_LAST_NAMES = ['Nguyễn', 'Trần', 'Lê', 'Phạm', 'Hoàng', 'Huỳnh', 'Phan', 'Vũ', 'Võ', 'Đặng', 'Bùi', 'Đỗ', 'Hồ', 'Ngô', 'Dương', 'Lý']
+SYNTHETIC_MIDDLE_NAMES = ['Văn', 'Thị', 'Hữu', 'Đức', 'Minh', 'Thanh', 'Quốc', 'Ngọc', 'Xuân', 'Hoàng', 'Công', 'Đình']
+SYNTHETIC_FIRST_NAMES = ['An', 'Bình', 'Cường', 'Dũng', 'Giang', 'Hải', 'Hùng', 'Khánh', 'Long', 'Minh', 'Nam', 'Phong',
+                         'Quân', 'Sơn', 'Tâm', 'Thắng', 'Trung', 'Tuấn', 'Việt', 'Vinh', 'Hà', 'Lan', 'Mai', 'Thảo']
+SYNTHETIC_TASKS = [('BX', 'Bốc xếp'), ('DC', 'Đóng cont'), ('RC', 'Rút cont'), ('DH', 'Đảo hàng'),
+                   ('DN', 'Dán nhãn'), ('QB', 'Quấn màng'), ('PL', 'Phân loại'), ('SX', 'Sắp xếp kho')]
+SYNTHETIC_CUSTOMER_WORDS = ['Logistics', 'Trading', 'Foods', 'Textile', 'Electronics', 'Furniture', 'Pharma', 'Retail']
+
+def _synthetic_name(rng):
+    return f"{rng.choice(SYNTHETIC_LAST_NAMES)} {rng.choice(SYNTHETIC_MIDDLE_NAMES)} {rng.choice(SYNTHETIC_FIRST_NAMES)}"
+
+def delete_synthetic_data(prefix):
+    """Xóa dữ liệu do seed-synthetic tạo với prefix (sản lượng theo số cont, danh mục theo mã), xóa theo lô id."""
+    P = LaborProductivity
+    deleted = 0
+    while True:
+        ids = [i for (i,) in db.session.query(P.id).filter(P.ref_no.like(f'{prefix}U%')).limit(IMPORT_CHUNK_SIZE)]
+        if not ids:
+            break
+        db.session.query(LaborProductivityStaff).filter(LaborProductivityStaff.productivity_id.in_(ids)).delete(synchronize_session=False)
+        deleted += db.session.query(P).filter(P.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+    customer_ids = select(Customer.id).where(Customer.customer_code.like(f'{prefix}%'))
+    account_ids = select(CustomerAccount.id).where(CustomerAccount.customer_id.in_(customer_ids))
+    db.session.query(AccountConversionIndex).filter(AccountConversionIndex.account_id.in_(account_ids)).delete(synchronize_session=False)
+    db.session.query(AccountTask).filter(AccountTask.account_id.in_(account_ids)).delete(synchronize_session=False)
+    db.session.query(CustomerAccount).filter(CustomerAccount.customer_id.in_(customer_ids)).delete(synchronize_session=False)
+    db.session.query(Customer).filter(Customer.customer_code.like(f'{prefix}%')).delete(synchronize_session=False)
+    db.session.query(Employee).filter(Employee.employee_code.like(f'{prefix}%')).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+def build_synthetic_master(prefix, rng, customers, accounts_per_customer, tasks_per_account, employees, an_chung_ratio, from_date, to_date):
+    """
+    Tạo danh mục tổng hợp: Khách hàng/Account/Task, lịch sử định mức theo ngày hiệu lực và nhân viên (khoán + An_chung).
+    Trả về plan (chỉ gồm kiểu dữ liệu đơn giản) để các process con sinh dòng sản lượng.
+    """
+    # Nhân viên: mỗi người có masl riêng, dòng sản lượng chủ yếu ghi masl (đôi khi mã NV hoặc họ tên như dữ liệu thật)
+    emp_rows = []
+    for i in range(1, employees + 1):
+        an_chung = rng.random() < an_chung_ratio
+        emp_rows.append(Employee(employee_code=f'{prefix}NV{i:05d}', full_name=_synthetic_name(rng), masl=f'{prefix}L{i:05d}',
+                                 position='Kiểm đếm' if an_chung else 'Bốc xếp', employee_type='An_chung' if an_chung else 'Khoan',
+                                 is_active=True, created_at=datetime.now()))
+    db.session.add_all(emp_rows)
+    db.session.flush()
+    khoan = [[e.masl, e.employee_code, e.full_name] for e in emp_rows if e.employee_type == 'Khoan']
+    an_chung = [[e.masl, e.employee_code, e.full_name] for e in emp_rows if e.employee_type == 'An_chung'] or khoan
+
+    # Lịch sử định mức: 1-4 mốc hiệu lực trải đều trong kỳ, mốc trước kết thúc ngay trước mốc sau
+    span = max(1, (to_date - from_date).days)
+    accounts = []
+    for c in range(1, customers + 1):
+        customer = Customer(customer_code=f'{prefix}KH{c:03d}',
+                            customer_name=f'{prefix} {rng.choice(SYNTHETIC_CUSTOMER_WORDS)} {c:03d}')
+        db.session.add(customer)
+        db.session.flush()
+        for a in range(1, accounts_per_customer + 1):
+            account = CustomerAccount(customer_id=customer.id, account_code=f'{customer.customer_code}-{a:02d}',
+                                      account_name=f'{customer.customer_name} - Kho {a}', is_active=True)
+            db.session.add(account)
+            db.session.flush()
+            tasks = []
+            for code, name in rng.sample(SYNTHETIC_TASKS, min(tasks_per_account, len(SYNTHETIC_TASKS))):
+                task = AccountTask(account_id=account.id, task_code=code, task_name=name)
+                db.session.add(task)
+                db.session.flush()
+                starts = sorted({from_date} | {from_date + timedelta(days=rng.randrange(span)) for _ in range(rng.randint(0, 3))})
+                rates = []
+                index = round(rng.uniform(0.8, 1.5), 3)
+                for k, start in enumerate(starts):
+                    end = starts[k + 1] - timedelta(days=1) if k + 1 < len(starts) else None
+                    db.session.add(AccountConversionIndex(account_id=account.id, task_id=task.id, conversion_index=index,
+                                                          unit='CBM', effective_from=start, effective_to=end))
+                    rates.append([start.toordinal(), end.toordinal() if end else None, index, 'CBM'])
+                    index = round(index * rng.uniform(1.0, 1.15), 3)
+                tasks.append({'name': name, 'rates': rates})
+            accounts.append({'customer': customer.customer_name, 'account': account.account_name, 'tasks': tasks,
+                             'weight': rng.uniform(0.2, 3.0)})
+    db.session.commit()
+
+    # Tổ đội cố định theo account: mỗi account có nhóm công nhân khoán và kiểm đếm/xe nâng An_chung riêng (có giao nhau)
+    crew_size = max(8, len(khoan) * 2 // max(1, len(accounts)))
+    lead_size = max(2, len(an_chung) * 2 // max(1, len(accounts)))
+    for account in accounts:
+        account['crew'] = rng.sample(khoan, min(crew_size, len(khoan)))
+        account['leads'] = rng.sample(an_chung, min(lead_size, len(an_chung)))
+
+    # Ngày làm việc: Chủ nhật ít việc hơn
+    days = []
+    weights = []
+    day = from_date
+    while day <= to_date:
+        days.append(day.toordinal())
+        weights.append(0.3 if day.weekday() == 6 else 1.0)
+        day += timedelta(days=1)
+    return {'prefix': prefix, 'accounts': accounts, 'days': days,
+            'day_cum': list(itertools.accumulate(weights)), 'account_cum': list(itertools.accumulate(a['weight'] for a in accounts))}
+
+def _synthetic_worker_value(rng, person):
+    """Chuỗi nhân sự ghi trên dòng: 90% masl, 5% mã NV, 5% họ tên."""
+    roll = rng.random()
+    return person[0] if roll < 0.9 else person[1] if roll < 0.95 else person[2]
+
+def generate_synthetic_rows(plan, start_index, rows, seed):
+    """Sinh rows dòng labor_productivity (tuple theo PRODUCTIVITY_INSERT_COLUMNS), tái lập được theo (seed, start_index)."""
+    rng = random.Random(seed * 1_000_003 + start_index)
+    prefix = plan['prefix']
+    result = []
+    for i in range(start_index, start_index + rows):
+        account = rng.choices(plan['accounts'], cum_weights=plan['account_cum'])[0]
+        task = rng.choice(account['tasks'])
+        ordinal = rng.choices(plan['days'], cum_weights=plan['day_cum'])[0]
+        work_date = date.fromordinal(ordinal)
+        rates = task['rates']
+        pos = bisect.bisect_right([r[0] for r in rates], ordinal) - 1
+        rate = rates[pos] if pos >= 0 and (rates[pos][1] is None or rates[pos][1] >= ordinal) else None
+        conv_index, unit = (rate[2], rate[3]) if rate else (1.0, 'CBM')
+        cbm = round(rng.lognormvariate(2.7, 0.6), 2)
+
+        leads = rng.sample(account['leads'], min(2, len(account['leads'])))
+        tally = _synthetic_worker_value(rng, leads[0]) if rng.random() < 0.9 else None
+        xenang = _synthetic_worker_value(rng, leads[-1]) if len(leads) > 1 and rng.random() < 0.6 else None
+        crew = [_synthetic_worker_value(rng, p) for p in rng.sample(account['crew'], min(rng.randint(2, 6), len(account['crew'])))]
+        staff = [tally, xenang] + crew + [None] * (6 - len(crew))
+
+        ref_no = f'{prefix}U{i:08d}'
+        result.append((work_date, ref_no, cbm, *staff, task['name'], account['account'], account['customer'], unit, conv_index,
+                       cbm * conv_index, # Không làm tròn: cùng công thức với ImportRowResolver để file xuất nạp lại không bị coi là thay đổi
+                       productivity_fingerprint(work_date, ref_no, task['name'], account['account'], account['customer'], staff)))
+    return result
+
+_synthetic_employee_resolver = None
+
+def seed_synthetic_chunk(plan, start_index, rows, seed):
+    """Sinh và ghi 1 lô dòng sản lượng tổng hợp (kèm labor_productivity_staff), chạy được trong process con. Trả về số dòng."""
+    global _synthetic_employee_resolver
+    with app.app_context():
+        if _synthetic_employee_resolver is None:
+            _synthetic_employee_resolver = EmployeeResolver()
+        data = generate_synthetic_rows(plan, start_index, rows, seed)
+        bulk_load_rows(LaborProductivity, PRODUCTIVITY_INSERT_COLUMNS, data)
+        # Lấy id vừa insert theo fingerprint (unique index) để ghi bảng nhân sự theo dòng
+        staff_by_fp = {row[-1]: row[3:11] for row in data}
+        fingerprints = list(staff_by_fp)
+        staff = []
+        for k in range(0, len(fingerprints), 1000):
+            for productivity_id, fp in db.session.query(LaborProductivity.id, LaborProductivity.row_fingerprint) \
+                    .filter(LaborProductivity.row_fingerprint.in_(fingerprints[k:k + 1000])):
+                staff.extend(_synthetic_employee_resolver.staff_rows(productivity_id, staff_by_fp[fp]))
+        if staff:
+            bulk_load_rows(LaborProductivityStaff, PRODUCTIVITY_STAFF_INSERT_COLUMNS, staff)
+        db.session.commit()
+        return len(data)
+
+@app.cli.command("seed-synthetic")
+@click.option('--rows', default=1_000_000, show_default=True, help='Số dòng labor_productivity cần sinh.')
+@click.option('--years', default=2.0, show_default=True, help='Số năm dữ liệu, tính lùi từ --to-date.')
+@click.option('--to-date', default=None, help='Ngày cuối của dữ liệu (YYYY-MM-DD), mặc định hôm nay.')
+@click.option('--customers', default=20, show_default=True)
+@click.option('--accounts-per-customer', default=3, show_default=True)
+@click.option('--tasks-per-account', default=4, show_default=True)
+@click.option('--employees', default=3000, show_default=True)
+@click.option('--an-chung-ratio', default=0.15, show_default=True, help='Tỉ lệ nhân viên An_chung (còn lại là khoán).')
+@click.option('--workers', default=None, type=int, help='Số process ghi song song (mặc định theo số CPU, SQLite luôn 1).')
+@click.option('--chunk-size', default=20000, show_default=True, help='Số dòng mỗi lô ghi.')
+@click.option('--seed', default=42, show_default=True, help='Seed ngẫu nhiên (cùng seed + tham số -> cùng dữ liệu).')
+@click.option('--prefix', default='SYN', show_default=True, help='Tiền tố mã danh mục/số cont để nhận diện dữ liệu tổng hợp.')
+@click.option('--reset', is_flag=True, help='Xóa dữ liệu tổng hợp cùng prefix trước khi sinh.')
+def seed_synthetic(rows, years, to_date, customers, accounts_per_customer, tasks_per_account, employees, an_chung_ratio,
+                   workers, chunk_size, seed, prefix, reset):
+    """Sinh bộ dữ liệu quy mô production (danh mục, định mức theo ngày hiệu lực, nhân viên, sản lượng) để kiểm thử tải."""
+    if reset:
+        print(f"Đang xóa dữ liệu tổng hợp prefix '{prefix}'...")
+        print(f"  -> Đã xóa {delete_synthetic_data(prefix)} dòng sản lượng")
+        rebuild_productivity_rollups(commit_each_chunk=True)
+        bump_data_version()
+        db.session.commit()
+    elif Customer.query.filter(Customer.customer_code.like(f'{prefix}%')).first() or \
+            Employee.query.filter(Employee.employee_code.like(f'{prefix}%')).first():
+        raise click.ClickException(f"Đã có dữ liệu tổng hợp prefix '{prefix}'. Dùng --reset để tạo lại hoặc đổi --prefix.")
+
+    end = datetime.strptime(to_date, '%Y-%m-%d').date() if to_date else date.today()
+    start = end - timedelta(days=max(1, int(years * 365)) - 1)
+    rng = random.Random(seed)
+    t0 = time.perf_counter()
+    plan = build_synthetic_master(prefix, rng, customers, accounts_per_customer, tasks_per_account, employees, an_chung_ratio, start, end)
+    print(f"Đã tạo danh mục: {customers} khách hàng, {len(plan['accounts'])} account, {employees} nhân viên "
+          f"({start} -> {end}), {time.perf_counter() - t0:.1f}s")
+
+    if workers is None:
+        workers = min(8, os.cpu_count() or 1)
+    if db.engine.dialect.name == 'sqlite':
+        workers = 1
+    chunks = [(k, min(chunk_size, rows - k)) for k in range(0, rows, chunk_size)]
+    done = 0
+    t0 = time.perf_counter()
+
+    def report():
+        elapsed = time.perf_counter() - t0
+        print(f"  -> {done:,}/{rows:,} dòng, {elapsed:.0f}s ({done / elapsed if elapsed else 0:,.0f} dòng/s)")
+
+    if workers <= 1:
+        for start_index, size in chunks:
+            done += seed_synthetic_chunk(plan, start_index, size, seed)
+            report()
+    else:
+        # Mỗi process con có kết nối DB riêng, mỗi lô commit riêng
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = [executor.submit(seed_synthetic_chunk, plan, start_index, size, seed) for start_index, size in chunks]
+            for future in as_completed(futures):
+                done += future.result()
+                report()
+    print(f"Hoàn tất! {done:,} dòng sản lượng trong {time.perf_counter() - t0:.1f}s.")
+    print("Đang dựng lại bảng tổng hợp theo ngày...")
+    rebuild_productivity_rollups(start, end, commit_each_chunk=True)
+    bump_data_version()
+    db.session.commit()
+    print("Hoàn tất!")
+
 @app.cli.command("seed-db")
 def seed_db():
     """Thêm dữ liệu chức vụ ban đầu vào database."""